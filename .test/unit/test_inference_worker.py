@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import inference_worker
+
+
+def fake_predict(calls):
+    """Stand-in model recording its calls. Fails on fold inputs whose file name contains 'fail'."""
+    def predict(json_path, output_dir):
+        calls.append(os.path.basename(json_path))
+        if "fail" in os.path.basename(json_path):
+            raise RuntimeError("fake failure")
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, os.path.basename(json_path)), "w") as f:
+            f.write("ok")
+    return predict
+
+
+def fold_input(tmp_path, name):
+    path = tmp_path / f"{name}.json"
+    path.write_text(json.dumps({"name": name}))
+    return str(path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def results(queue):
+    done = os.path.join(queue, "done")
+    return {name: read_json(os.path.join(done, name)) for name in os.listdir(done)}
+
+
+def claim_for_dead_worker(queue, json_path, output_dir, worker="deadhost-1", attempts=0):
+    """Enqueue a request and leave it claimed by ``worker``, which has no heartbeat."""
+    request_id = inference_worker.enqueue(queue, json_path, output_dir)
+    paths = inference_worker.queue_paths(queue)
+    worker_dir = os.path.join(paths["running"], worker)
+    os.makedirs(worker_dir, exist_ok=True)
+    claimed = inference_worker.claim_next(paths, worker_dir)
+    request = read_json(claimed)
+    request["attempts"] = attempts
+    inference_worker.write_json_atomic(claimed, request)
+    return request_id
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return str(tmp_path / "queue")
+
+
+def test_claim_next_takes_the_oldest_request(tmp_path, queue):
+    first = inference_worker.enqueue(queue, fold_input(tmp_path, "a"), str(tmp_path / "out"))
+    second = inference_worker.enqueue(queue, fold_input(tmp_path, "b"), str(tmp_path / "out"))
+    paths = inference_worker.queue_paths(queue)
+    worker_dir = os.path.join(paths["running"], "w1")
+    os.makedirs(worker_dir)
+
+    assert inference_worker.claim_next(paths, worker_dir) == os.path.join(worker_dir, f"{first}.json")
+    assert os.listdir(paths["pending"]) == [f"{second}.json"]
+    assert inference_worker.claim_next(paths, worker_dir) == os.path.join(worker_dir, f"{second}.json")
+    assert inference_worker.claim_next(paths, worker_dir) is None
+
+
+def test_serve_reports_success(tmp_path, queue):
+    calls = []
+    request_id = inference_worker.enqueue(queue, fold_input(tmp_path, "a"), str(tmp_path / "out"))
+
+    counts = inference_worker.serve(queue, fake_predict(calls), "w1", poll_interval=0, exit_when_drained=True)
+
+    assert counts == {"ok": 1, "failed": 0}
+    assert calls == ["a.json"]
+    assert (tmp_path / "out" / "a.json").read_text() == "ok"
+    result = inference_worker.wait_for_result(queue, request_id, poll_interval=0)
+    assert result["status"] == "ok" and result["worker"] == "w1"
+    assert os.listdir(os.path.join(queue, "running")) == []
+    assert os.listdir(os.path.join(queue, "workers")) == []
+
+
+def test_failing_request_does_not_stop_the_worker(tmp_path, queue):
+    calls = []
+    failing = inference_worker.enqueue(queue, fold_input(tmp_path, "fail"), str(tmp_path / "out"))
+    passing = inference_worker.enqueue(queue, fold_input(tmp_path, "b"), str(tmp_path / "out"))
+
+    counts = inference_worker.serve(queue, fake_predict(calls), "w1", poll_interval=0, exit_when_drained=True)
+
+    assert counts == {"ok": 1, "failed": 1}
+    assert calls == ["fail.json", "b.json"]
+    done = results(queue)
+    assert done[f"{failing}.json"]["status"] == "failed"
+    assert "fake failure" in done[f"{failing}.json"]["error"]
+    assert done[f"{passing}.json"]["status"] == "ok"
+
+
+def test_claim_of_dead_worker_is_retried(tmp_path, queue):
+    calls = []
+    request_id = claim_for_dead_worker(queue, fold_input(tmp_path, "a"), str(tmp_path / "out"))
+
+    counts = inference_worker.serve(queue, fake_predict(calls), "w1", poll_interval=0.01,
+                                    idle_timeout=1, max_attempts=2)
+
+    assert counts == {"ok": 1, "failed": 0}
+    assert calls == ["a.json"]
+    assert results(queue)[f"{request_id}.json"]["status"] == "ok"
+    assert os.listdir(os.path.join(queue, "running")) == []
+
+
+def test_requeue_gives_up_after_max_attempts(tmp_path, queue):
+    request_id = claim_for_dead_worker(queue, fold_input(tmp_path, "a"), str(tmp_path / "out"), attempts=1)
+
+    assert inference_worker.requeue_stale(queue, stale_after=60, max_attempts=2) == 0
+
+    result = results(queue)[f"{request_id}.json"]
+    assert result["status"] == "failed" and result["worker"] == "deadhost-1"
+    assert os.listdir(os.path.join(queue, "pending")) == []
+
+
+def test_requeue_skips_live_workers(tmp_path, queue):
+    claim_for_dead_worker(queue, fold_input(tmp_path, "a"), str(tmp_path / "out"), worker="w2")
+    inference_worker.write_json_atomic(os.path.join(queue, "workers", "w2.json"), {})
+
+    assert inference_worker.requeue_stale(queue, stale_after=60, max_attempts=2) == 0
+    assert os.listdir(os.path.join(queue, "running", "w2"))
+
+
+def test_concurrent_requeue_requeues_each_claim_once(tmp_path, queue):
+    request_ids = [claim_for_dead_worker(queue, fold_input(tmp_path, name), str(tmp_path / "out"))
+                   for name in "abcdefgh"]
+    barrier = threading.Barrier(8)
+    requeued, errors = [], []
+
+    def requeue():
+        barrier.wait()
+        try:
+            requeued.append(inference_worker.requeue_stale(queue, stale_after=60, max_attempts=3))
+        except Exception as e:  # pragma: no cover - reported below
+            errors.append(e)
+
+    threads = [threading.Thread(target=requeue) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sum(requeued) == len(request_ids)
+    pending = os.path.join(queue, "pending")
+    assert sorted(os.listdir(pending)) == sorted(f"{request_id}.json" for request_id in request_ids)
+    assert all(read_json(os.path.join(pending, name))["attempts"] == 1 for name in os.listdir(pending))
+    assert os.listdir(os.path.join(queue, "running")) == []
+
+
+def test_takeover_of_dead_requeuer_is_taken_over_again(tmp_path, queue):
+    request_id = claim_for_dead_worker(queue, fold_input(tmp_path, "a"), str(tmp_path / "out"))
+    running = os.path.join(queue, "running")
+    fresh = f"deadhost-1{inference_worker.REQUEUE_MARK}{time.time_ns()}-abcd"
+    os.rename(os.path.join(running, "deadhost-1"), os.path.join(running, fresh))
+
+    # a takeover in progress is left alone ...
+    assert inference_worker.requeue_stale(queue, stale_after=60, max_attempts=3) == 0
+    assert os.listdir(running) == [fresh]
+
+    # ... until its worker is considered dead too
+    old = f"deadhost-1{inference_worker.REQUEUE_MARK}{time.time_ns() - 120 * 10**9}-abcd"
+    os.rename(os.path.join(running, fresh), os.path.join(running, old))
+    assert inference_worker.requeue_stale(queue, stale_after=60, max_attempts=3) == 1
+    assert read_json(os.path.join(queue, "pending", f"{request_id}.json"))["attempts"] == 1
@@ -0,0 +1,65 @@
+import copy
+
+import merge_mono_and_multi_jsons as merge
+
+
+def uniprot_msa(query, hits):
+    """A3M with the query first and one hit per (accession, species, sequence)."""
+    rows = [f">query\n{query}\n"]
+    rows += [f">tr|{accession}|{accession}_{species}\n{sequence}\n" for accession, species, sequence in hits]
+    return "".join(rows)
+
+
+def protein(chain_id, sequence, paired_msa):
+    entry = {"id": chain_id, "sequence": sequence, "unpairedMsa": "", "templates": []}
+    if paired_msa is not None:
+        entry["pairedMsa"] = paired_msa
+    return {"protein": entry}
+
+
+def heteromer(*chains):
+    return {"name": "job", "sequences": list(chains), "modelSeeds": [1]}
+
+
+def paired_msa_of(data, chain_id):
+    return next(seq["protein"]["pairedMsa"] for seq in data["sequences"] if seq["protein"]["id"] == chain_id)
+
+
+def test_chains_with_shared_species_are_paired(tmp_path):
+    data = heteromer(
+        protein("A", "MKV", uniprot_msa("MKV", [("A0A001", "HUMAN", "MRV"), ("A0A002", "MOUSE", "MKI")])),
+        protein("B", "GSW", uniprot_msa("GSW", [("B0B001", "MOUSE", "GTW")])),
+    )
+
+    merge.pair_chain_msas(data, str(tmp_path))
+
+    assert paired_msa_of(data, "A").split("\n")[2:4] == [">tr|A0A002|A0A002_MOUSE", "MKI"]
+    assert paired_msa_of(data, "B").split("\n")[2:4] == [">tr|B0B001|B0B001_MOUSE", "GTW"]
+
+
+def test_chains_without_paired_msa_are_left_untouched(tmp_path):
+    data = heteromer(
+        protein("A", "MKV", uniprot_msa("MKV", [("A0A002", "MOUSE", "MKI")])),
+        protein("B", "GSW", uniprot_msa("GSW", [("B0B001", "MOUSE", "GTW")])),
+        protein("C", "PLE", ""),
+        protein("D", "YYR", None),
+    )
+
+    merge.pair_chain_msas(data, str(tmp_path))
+
+    assert ">tr|A0A002|A0A002_MOUSE" in paired_msa_of(data, "A")
+    assert ">tr|B0B001|B0B001_MOUSE" in paired_msa_of(data, "B")
+    assert paired_msa_of(data, "C") == ""
+    assert "pairedMsa" not in data["sequences"][3]["protein"]
+
+
+def test_single_chain_with_paired_msa_is_not_paired(tmp_path):
+    data = heteromer(
+        protein("A", "MKV", uniprot_msa("MKV", [("A0A002", "MOUSE", "MKI")])),
+        protein("B", "GSW", ""),
+    )
+    original = copy.deepcopy(data)
+
+    merge.pair_chain_msas(data, str(tmp_path))
+
+    assert data == original
@@ -0,0 +1,69 @@
+import asyncio
+import io
+import json
+import tarfile
+
+import mmseqs_client
+
+
+class FakeResponse:
+    def __init__(self, status, body=b""):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        return json.loads(self.body)
+
+    async def read(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise RuntimeError(f"HTTP {self.status}")
+
+
+class FakeSession:
+    """Replies with the queued responses of every method, in order."""
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        return self.responses[method].pop(0)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+
+def result_tar():
+    a3m_bytes = b">101\nMKV\n>hit\nMKV\n"
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("uniref.a3m")
+        info.size = len(a3m_bytes)
+        tar.addfile(info, io.BytesIO(a3m_bytes))
+    return buffer.getvalue()
+
+
+def status(value, **extra):
+    return FakeResponse(200, json.dumps({"status": value, **extra}).encode())
+
+
+def test_rate_limited_polls_and_downloads_are_retried():
+    session = FakeSession({
+        "POST": [status("PENDING", id="ticket")],
+        "GET": [FakeResponse(429), status("RUNNING"), status("COMPLETE"), FakeResponse(429),
+                FakeResponse(200, result_tar())],
+    })
+
+    results = asyncio.run(mmseqs_client.run_ticket(session, "http://mmseqs", ["MKV"], "all", poll_interval=0))
+
+    assert results == [{"a3m": ">101\nMKV\n>hit\nMKV\n", "m8": []}]
+    assert [url for _, url in session.calls].count("http://mmseqs/result/download/ticket") == 2
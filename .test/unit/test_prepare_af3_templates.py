@@ -0,0 +1,18 @@
+import prepare_af3_templates
+
+
+def test_failed_preparation_leaves_no_directory(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError("cannot align")
+
+    monkeypatch.setattr(prepare_af3_templates, "_align_template", fail)
+    template = tmp_path / "template.cif"
+    template.write_text("data_template\n")
+    cache_dir = tmp_path / "cache"
+    task = (str(template), "A", "MKV")
+
+    failed = prepare_af3_templates.prepare_templates([task], cache_dir=str(cache_dir))
+
+    assert list(failed) == [task]
+    assert "cannot align" in failed[task]
+    assert list(cache_dir.iterdir()) == []
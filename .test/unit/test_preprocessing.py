@@ -0,0 +1,56 @@
+import preprocessing
+
+
+def batches_of(batches_df):
+    return {batch_id: sorted(rows.sample_id) for batch_id, rows in batches_df.groupby("batch_id")}
+
+
+def test_samples_are_batched_by_bucket():
+    batches_df = preprocessing.assign_inference_batches({"a": 100, "b": 200, "c": 250, "d": 1000}, batch_size=2)
+
+    assert batches_of(batches_df) == {"bucket-256_batch-0": ["a", "b"], "bucket-256_batch-1": ["c"],
+                                      "bucket-1024_batch-0": ["d"]}
+
+
+def test_added_samples_do_not_change_previous_batches(tmp_path):
+    batches_file = tmp_path / "inference_batches.tsv"
+    preprocessing.assign_inference_batches({"b": 100, "c": 100, "d": 100}, batch_size=2).to_csv(
+        batches_file, sep="\t", index=False)
+
+    batches_df = preprocessing.assign_inference_batches(
+        {"a": 100, "b": 100, "c": 100, "d": 100, "e": 100}, batch_size=2,
+        previous_batch_of=preprocessing.load_sample_groups(str(batches_file), "batch_id"))
+
+    assert batches_of(batches_df) == {"bucket-256_batch-0": ["b", "c"], "bucket-256_batch-1": ["d"],
+                                      "bucket-256_batch-2": ["a", "e"]}
+
+
+def test_samples_that_change_bucket_get_a_new_batch():
+    batches_df = preprocessing.assign_inference_batches(
+        {"a": 100, "b": 600}, batch_size=2,
+        previous_batch_of={"a": "bucket-256_batch-0", "b": "bucket-256_batch-0"})
+
+    assert batches_of(batches_df) == {"bucket-256_batch-0": ["a"], "bucket-768_batch-0": ["b"]}
+
+
+def chunks_of(chunks_df):
+    return {chunk_id: sorted(rows.sample_id) for chunk_id, rows in chunks_df.groupby("chunk_id")}
+
+
+def test_multimers_sharing_monomers_are_chunked_together():
+    chunks_df = preprocessing.assign_merge_chunks(
+        {"a": ["x", "y"], "b": ["z"], "c": ["x", "y"], "d": ["z", "z"]}, chunk_size=2)
+
+    assert chunks_of(chunks_df) == {"merge-0": ["a", "c"], "merge-1": ["b", "d"]}
+
+
+def test_added_multimers_do_not_change_previous_chunks(tmp_path):
+    chunks_file = tmp_path / "merge_chunks.tsv"
+    preprocessing.assign_merge_chunks({"b": ["x"], "c": ["y"], "d": ["z"]}, chunk_size=2).to_csv(
+        chunks_file, sep="\t", index=False)
+
+    chunks_df = preprocessing.assign_merge_chunks(
+        {"a": ["w"], "b": ["x"], "c": ["y"], "d": ["z"], "e": ["z"]}, chunk_size=2,
+        previous_chunk_of=preprocessing.load_sample_groups(str(chunks_file), "chunk_id"))
+
+    assert chunks_of(chunks_df) == {"merge-0": ["b", "c"], "merge-1": ["d"], "merge-2": ["a", "e"]}
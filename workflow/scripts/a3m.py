@@ -0,0 +1,361 @@
+"""
+A3M toolkit of the CPU-side MSA stages (e.g. pair_msas.py, msa_subsample.py).
+
+An A3M record is a FASTA record whose uppercase letters and '-' are aligned to the query
+columns and whose lowercase letters (and '.') are insertions relative to the query. The first
+record is the query.
+
+Files are memory-mapped and read record by record: A3M / FASTA, MMseqs2 results (one A3M per
+query, separated by NUL bytes) and Stockholm (converted to A3M, the first sequence being the
+query). For filtering, an MSA is encoded as a (rows, query columns) uint8 array of its aligned
+residues, with the counts of its insertions kept apart, on which deduplication, coverage /
+identity filters and Neff are vectorized.
+
+Species are read from the description lines the AF3 data pipeline writes for UniProt hits
+(``sp|P12345|ABC_HUMAN ...``, the same pattern AF3 pairs on) or, failing that, from a
+``TaxID=`` / ``OX=`` taxonomy field (UniRef, UniProt FASTA headers).
+
+As a CLI, reports or filters the MSAs of a directory of ``_data.json`` files in parallel::
+
+    python a3m.py stats <output_dir>/rule_AF3_DATA_PIPELINE --output msa_stats.tsv
+    python a3m.py filter <data_dir> <filtered_dir> --min-coverage 0.5
+"""
+import contextlib
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from typing import Iterator, NamedTuple
+
+import click
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+import json_io
+
+UNIPROT_SPECIES = re.compile(
+    r"^(?:tr|sp)\|[A-Za-z0-9]{6,10}(?:_\d+)?\|[A-Za-z0-9]+_(?P<species>[A-Za-z0-9]{1,5})")
+TAXONOMY_ID = re.compile(r"\b(?:TaxID|OX)=(?P<taxid>\d+)")
+INSERTIONS = str.maketrans("", "", "abcdefghijklmnopqrstuvwxyz.")
+STOCKHOLM_SUFFIXES = (".sto", ".stockholm")
+GAP = ord("-")
+# Elements of the one-hot and identity blocks of :func:`neff`
+NEFF_BLOCK_ELEMENTS = 1 << 24
+
+
+class A3m(NamedTuple):
+    descriptions: list
+    sequences: list
+
+
+class Encoded(NamedTuple):
+    codes: np.ndarray       # (rows, columns) uint8 byte codes of the aligned residues, '-' for gaps
+    insertions: np.ndarray  # (rows, columns + 1) number of residues inserted before each column (last: after it)
+
+
+def parse(text: str) -> A3m:
+    """Descriptions (without '>') and sequences of an A3M / FASTA string."""
+    descriptions, sequences = [], []
+    for record in text.split(">")[1:]:
+        description, _, sequence = record.partition("\n")
+        descriptions.append(description.strip())
+        sequences.append("".join(sequence.split()))
+    return A3m(descriptions, sequences)
+
+
+def to_text(descriptions, sequences) -> str:
+    return "".join(f">{description}\n{sequence}\n" for description, sequence in zip(descriptions, sequences))
+
+
+def select(msa: A3m, rows) -> A3m:
+    return A3m([msa.descriptions[i] for i in rows], [msa.sequences[i] for i in rows])
+
+
+@contextlib.contextmanager
+def mapped(path: str):
+    """Read-only memory map of a file (empty bytes for an empty file)."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def iter_records(data) -> Iterator[tuple]:
+    """(description, sequence) of every record of A3M / FASTA bytes (or a memory map), NUL bytes dropped."""
+    start = data.find(b">")
+    while start != -1:
+        end = data.find(b"\n>", start)
+        record = data[start + 1:end if end != -1 else len(data)].replace(b"\x00", b"")
+        description, _, sequence = record.partition(b"\n")
+        yield description.strip().decode(), b"".join(sequence.split()).decode()
+        start = end + 1 if end != -1 else -1
+
+
+def iter_entries(data) -> Iterator[str]:
+    """The A3M of every query of an MMseqs2 result (entries separated by NUL bytes)."""
+    start = 0
+    while start < len(data):
+        end = data.find(b"\x00", start)
+        end = len(data) if end == -1 else end
+        entry = data[start:end].lstrip()
+        if entry:
+            yield entry.decode()
+        start = end + 1
+
+
+def read_entries(path: str) -> list:
+    """:func:`iter_entries` of an MMseqs2 result file."""
+    with mapped(path) as data:
+        return list(iter_entries(data))
+
+
+def is_stockholm(path: str) -> bool:
+    return str(path).endswith(STOCKHOLM_SUFFIXES)
+
+
+def stockholm_to_a3m(names, rows, descriptions=None) -> A3m:
+    """A3M of aligned Stockholm rows: columns where the query (first row) has a gap become insertions."""
+    descriptions = descriptions or {}
+    query = np.frombuffer(rows[0].encode(), dtype=np.uint8)
+    match = (query != GAP) & (query != ord("."))
+    sequences = []
+    for row in rows:
+        upper = np.frombuffer(row.upper().replace(".", "-").encode(), dtype=np.uint8)
+        lower = np.frombuffer(row.lower().encode(), dtype=np.uint8)
+        keep = match | ((lower != GAP) & (lower != ord(".")))
+        sequences.append(np.where(match, upper, lower)[keep].tobytes().decode())
+    return A3m([f"{name} {descriptions[name]}" if name in descriptions else name for name in names], sequences)
+
+
+def parse_stockholm(data) -> A3m:
+    """A3M of Stockholm bytes (or a memory map); rows of interleaved blocks are concatenated."""
+    rows, descriptions = {}, {}
+    for line in iter(data.readline, b"") if isinstance(data, mmap.mmap) else data.splitlines():
+        line = line.strip()
+        if not line or line.startswith(b"//"):
+            continue
+        if line.startswith(b"#=GS"):
+            fields = line.decode().split(maxsplit=3)
+            if len(fields) == 4 and fields[2] == "DE":
+                descriptions[fields[1]] = fields[3]
+        elif not line.startswith(b"#"):
+            name, row = line.decode().split(maxsplit=1)
+            rows.setdefault(name, []).append(row.strip())
+    if not rows:
+        return A3m([], [])
+    return stockholm_to_a3m(list(rows), ["".join(row) for row in rows.values()], descriptions)
+
+
+def read(path: str) -> A3m:
+    """Records of an A3M / FASTA or (by suffix) Stockholm file, read through a memory map."""
+    with mapped(path) as data:
+        if is_stockholm(path):
+            return parse_stockholm(data)
+        descriptions, sequences = [], []
+        for description, sequence in iter_records(data):
+            descriptions.append(description)
+            sequences.append(sequence)
+    return A3m(descriptions, sequences)
+
+
+def aligned(sequence: str) -> str:
+    """The query-aligned columns of an A3M row (insertions removed)."""
+    return sequence.translate(INSERTIONS)
+
+
+def encode(sequences) -> Encoded:
+    """
+    :class:`Encoded` alignment of A3M rows, the width being the number of query columns. Rows
+    with more aligned columns are truncated, rows with fewer padded with gaps.
+    """
+    sequences = list(sequences)
+    data = np.frombuffer("".join(sequences).encode(), dtype=np.uint8)
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    row_of = np.repeat(np.arange(len(sequences)), lengths)
+    inserted = (data >= ord("a")) & (data <= ord("z"))
+    is_aligned = ~inserted & (data != ord("."))
+    # Column of every residue: aligned columns seen before it in its row
+    column = np.cumsum(is_aligned) - is_aligned
+    column -= np.concatenate([[0], np.cumsum(is_aligned)])[np.cumsum(lengths) - lengths][row_of]
+    width = int(is_aligned[:lengths[0]].sum()) if len(sequences) else 0
+
+    codes = np.full((len(sequences), width), GAP, dtype=np.uint8)
+    in_query = is_aligned & (column < width)
+    codes[row_of[in_query], column[in_query]] = data[in_query]
+    insertions = np.bincount(row_of[inserted] * (width + 1) + np.minimum(column[inserted], width),
+                             minlength=len(sequences) * (width + 1)).reshape(len(sequences), width + 1)
+    return Encoded(codes, insertions.astype(np.uint16 if insertions.max(initial=0) < 1 << 16 else np.uint32))
+
+
+def unique_rows(codes: np.ndarray) -> np.ndarray:
+    """Rows whose aligned residues were not seen in an earlier row, in MSA order (the query first)."""
+    if len(codes) == 0 or codes.shape[1] == 0:
+        return np.arange(min(len(codes), 1))
+    rows = np.ascontiguousarray(codes).view(np.dtype((np.void, codes.shape[1])))[:, 0]
+    _, first = np.unique(rows, return_index=True)
+    return np.sort(first)
+
+
+def passing_rows(codes: np.ndarray, min_coverage: float = 0.0, min_identity: float = 0.0) -> np.ndarray:
+    """
+    Rows covering at least ``min_coverage`` of the query columns with at least ``min_identity``
+    identity to the query over their aligned columns. The query (row 0) always passes.
+    """
+    is_aligned = codes != GAP
+    n_aligned = is_aligned.sum(axis=1)
+    coverage = n_aligned / max(codes.shape[1], 1)
+    identity = ((codes == codes[0]) & is_aligned).sum(axis=1) / np.maximum(n_aligned, 1)
+    passing = (coverage >= min_coverage) & (identity >= min_identity)
+    passing[0] = True
+    return np.flatnonzero(passing)
+
+
+def one_hot(index: np.ndarray, depth: int) -> np.ndarray:
+    """(rows, columns * depth) float32 one-hot encoding of letter indices (-1: gap, all zeros)."""
+    encoded = np.zeros((index.shape[0], index.shape[1] * depth), dtype=np.float32)
+    rows, columns = np.nonzero(index >= 0)
+    encoded[rows, columns * depth + index[rows, columns]] = 1
+    return encoded
+
+
+def neff(codes: np.ndarray, identity_threshold: float = 0.8) -> float:
+    """
+    Number of effective sequences: the sum over rows of 1 / the number of rows (itself included)
+    with at least ``identity_threshold`` identity to it, over the columns aligned in both rows.
+    Pairwise identities are matrix products of one-hot encodings, computed in blocks.
+    """
+    if len(codes) == 0:
+        return 0.0
+    letters = np.setdiff1d(np.unique(codes), [GAP])
+    lookup = np.full(256, -1, dtype=np.int64)
+    lookup[letters] = np.arange(len(letters))
+    index = lookup[codes]
+    is_aligned = (index >= 0).astype(np.float32)
+    n_rows, width = codes.shape
+    row_block = max(1, NEFF_BLOCK_ELEMENTS // n_rows)
+    column_block = max(1, NEFF_BLOCK_ELEMENTS // (n_rows * max(len(letters), 1)))
+    neighbours = np.empty(n_rows, dtype=np.int64)
+    for start in range(0, n_rows, row_block):
+        rows = slice(start, start + row_block)
+        matches = np.zeros((len(codes[rows]), n_rows), dtype=np.float32)
+        for column in range(0, width, column_block):
+            encoded = one_hot(index[:, column:column + column_block], len(letters))
+            matches += encoded[rows] @ encoded.T
+        overlap = is_aligned[rows] @ is_aligned.T
+        neighbours[rows] = (matches >= identity_threshold * np.maximum(overlap, 1)).sum(axis=1)
+    return float((1.0 / np.maximum(neighbours, 1)).sum())
+
+
+def filter_msa(text: str, dedup: bool = True, min_coverage: float = 0.0, min_identity: float = 0.0) -> str:
+    """A3M of the rows of ``text`` passing the filters (the query always does), in their order."""
+    msa = parse(text)
+    if not msa.sequences:
+        return text
+    codes = encode(msa.sequences).codes
+    rows = passing_rows(codes, min_coverage, min_identity)
+    if dedup:
+        rows = np.intersect1d(rows, unique_rows(codes))
+    return to_text(*select(msa, rows))
+
+
+def msa_stats(text: str, identity_threshold: float = 0.8) -> dict:
+    codes = encode(parse(text).sequences).codes
+    unique = unique_rows(codes)
+    return {"depth": len(codes), "unique": len(unique), "columns": codes.shape[1],
+            "neff": round(neff(codes[unique], identity_threshold), 2)}
+
+
+def species_id(description: str) -> str:
+    """Species (UniProt mnemonic, or ``taxid:<n>``) of a hit, '' if the description has none."""
+    match = UNIPROT_SPECIES.match(description)
+    if match:
+        return match.group("species")
+    match = TAXONOMY_ID.search(description)
+    return f"taxid:{match.group('taxid')}" if match else ""
+
+
+def species_ids(descriptions) -> np.ndarray:
+    """:func:`species_id` of every description, as a NumPy string array."""
+    return np.array([species_id(description) for description in descriptions], dtype=str)
+
+
+def chain_msas(data: dict, keys=("unpairedMsa",)) -> Iterator[tuple]:
+    """(chain entry, key) of every inline MSA of a data JSON."""
+    for entry in data["sequences"]:
+        chain = next(iter(entry.values()))
+        for key in keys:
+            if chain.get(key):
+                yield chain, key
+
+
+def data_json_stats(path: str, identity_threshold: float = 0.8) -> list:
+    rows = []
+    for chain, key in chain_msas(json_io.load(path), ("unpairedMsa", "pairedMsa")):
+        rows.append({"file": path, "chain_id": ",".join(chain["id"]) if isinstance(chain["id"], list) else chain["id"],
+                     "msa": key, **msa_stats(chain[key], identity_threshold)})
+    return rows
+
+
+def filter_data_json(path: str, output_path: str, dedup: bool = True, min_coverage: float = 0.0,
+                     min_identity: float = 0.0) -> tuple:
+    """Filter the unpaired MSAs of a data JSON; returns the rows before and after."""
+    data = json_io.load(path)
+    n_before = n_after = 0
+    for chain, key in chain_msas(data):
+        n_before += chain[key].count(">")
+        chain[key] = filter_msa(chain[key], dedup, min_coverage, min_identity)
+        n_after += chain[key].count(">")
+    json_io.dump(data, output_path)
+    return n_before, n_after
+
+
+def find_data_jsons(data_dir: str) -> list:
+    return sorted(glob(os.path.join(data_dir, "**", "*_data.json*"), recursive=True))
+
+
+@click.group()
+def cli():
+    """Inspect and filter the MSAs of AF3 data JSONs."""
+
+
+@cli.command("stats")
+@click.argument("data_dir", type=click.Path(exists=True))
+@click.option("--output", type=click.Path(), required=True, help="TSV of depth, unique rows, columns and Neff of every MSA")
+@click.option("--identity-threshold", type=float, default=0.8, show_default=True, help="Neff sequence identity threshold")
+@click.option("--workers", type=int, default=os.cpu_count(), show_default=True)
+def stats_command(data_dir, output, identity_threshold, workers):
+    """Report the MSAs of the _data.json files under DATA_DIR."""
+    paths = find_data_jsons(data_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = [row for rows in executor.map(data_json_stats, paths, [identity_threshold] * len(paths)) for row in rows]
+    pd.DataFrame(rows, columns=["file", "chain_id", "msa", "depth", "unique", "columns", "neff"]).to_csv(
+        output, sep="\t", index=False)
+    logger.info(f"{len(rows)} MSAs of {len(paths)} data JSONs reported in {output}")
+
+
+@cli.command("filter")
+@click.argument("data_dir", type=click.Path(exists=True))
+@click.argument("output_dir", type=click.Path())
+@click.option("--dedup/--no-dedup", default=True, show_default=True, help="Drop rows repeating earlier aligned rows")
+@click.option("--min-coverage", type=float, default=0.0, show_default=True, help="Minimum fraction of query columns covered")
+@click.option("--min-identity", type=float, default=0.0, show_default=True, help="Minimum identity to the query")
+@click.option("--workers", type=int, default=os.cpu_count(), show_default=True)
+def filter_command(data_dir, output_dir, dedup, min_coverage, min_identity, workers):
+    """
+    Filter the unpaired MSAs of the _data.json files under DATA_DIR into OUTPUT_DIR (same
+    relative paths; OUTPUT_DIR may be DATA_DIR to filter in place).
+    """
+    paths = find_data_jsons(data_dir)
+    outputs = [os.path.join(output_dir, os.path.relpath(path, data_dir)) for path in paths]
+    n = len(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(filter_data_json, paths, outputs, [dedup] * n, [min_coverage] * n, [min_identity] * n))
+    logger.info(f"Filtered {n} data JSONs: {sum(b for b, _ in counts)} -> {sum(a for _, a in counts)} MSA rows")
+
+
+if __name__ == "__main__":
+    cli()
@@ -13,7 +13,10 @@ import requests
 from tqdm.autonotebook import tqdm
 
 import tempfile
-from af3_mmseqs2.af3_script_utils import (
+import a3m
+import mmcif_cache
+import mmseqs_client
+from af3_script_utils import (
     custom_template_argpase_util,
     mmseqs2_argparse_util,
     align_and_map,
@@ -47,29 +50,37 @@ def add_msa_to_json(
     af3_json=None,
     output_json=None,
     to_file=True,
+    host_url=None,
+    cache_dir=None,
+    mmcif_cache_dir=None,
+    pdb_mirror_dir=None,
 ):
     if af3_json is None:
         with open(input_json, "r") as f:
             af3_json = json.load(f)
 
+    # All protein sequences of the json are searched at once (unique sequences only, cached ones skipped)
+    protein_sequences = [x["protein"]["sequence"] for x in af3_json["sequences"] if "protein" in x]
+    results = mmseqs_client.fetch_msas_sync(
+        protein_sequences,
+        host_url=host_url or mmseqs_client.DEFAULT_HOST_URL,
+        cache_dir=cache_dir,
+    )
+    # PDB entries and templates of the template hits are reused across sequences and runs
+    template_cache = (
+        mmcif_cache.MmcifCache(mmcif_cache_dir, pdb_mirror_dir) if templates and mmcif_cache_dir else None
+    )
+
     for sequence in af3_json["sequences"]:
         if "protein" in sequence:
             input_sequence = sequence["protein"]["sequence"]
+            result = results[input_sequence]
             with tempfile.TemporaryDirectory() as tmpdir:
-                
-                logger.info(f'Running MMseqs2 on sequence: {input_sequence}')
-                # Run MMseqs2 to get unpaired MSA
-                if templates:
-                    a3m_lines, templates = run_mmseqs(
-                        input_sequence,
-                        tmpdir,
-                        use_templates=True,
-                        num_templates=num_templates,
-                    )
-
-                else:
-                    a3m_lines = run_mmseqs(input_sequence, tmpdir, use_templates=False)
-                    templates = []
+                chain_templates = (
+                    templates_from_hits(input_sequence, result["m8"], num_templates, tmpdir, template_cache)
+                    if templates
+                    else []
+                )
 
                 if custom_template:
                     if not os.path.exists(custom_template):
@@ -94,9 +105,9 @@ target id so that custom template can be added to the correct sequence"
                     )
 
                 # Add unpaired MSA to the json
-                sequence["protein"]["unpairedMsa"] = a3m_lines[0]
+                sequence["protein"]["unpairedMsa"] = result["a3m"]
                 sequence["protein"]["pairedMsa"] = ""
-                sequence["protein"]["templates"] = templates
+                sequence["protein"]["templates"] = chain_templates
     if to_file:
         if output_json:
             with open(output_json, "w") as f:
@@ -242,70 +253,76 @@ def run_mmseqs(
         with tarfile.open(tar_gz_file) as tar_gz:
             tar_gz.extractall(path)
 
-    # gather a3m lines
+    # gather the a3m entries of every query (NUL separated, first line ">M")
     a3m_lines = {}
     for a3m_file in a3m_files:
-        update_M, M = True, None
-        for line in open(a3m_file, "r"):
-            if len(line) > 0:
-                if "\x00" in line:
-                    line = line.replace("\x00", "")
-                    update_M = True
-                if line.startswith(">") and update_M:
-                    M = int(line[1:].rstrip())
-                    update_M = False
-                    if M not in a3m_lines:
-                        a3m_lines[M] = []
-                a3m_lines[M].append(line)
+        for entry in a3m.read_entries(a3m_file):
+            a3m_lines.setdefault(int(entry[1:entry.index("\n")]), []).append(entry)
 
     a3m_lines = ["".join(a3m_lines[n]) for n in Ms]
 
-    tested_pdbs = []
     templates = []
     if use_templates:
-        logger.info('Finding and preparing templates')
-        count = 0
-        for line in open(f"{path}/pdb70.m8", "r"):
-            template = {}
-            if count < num_templates:
-                p = line.rstrip().split()
-                M, pdb, qid, alilen, tstart, tend = (
-                    p[0],
-                    p[1],
-                    p[2],
-                    p[3],
-                    p[8],
-                    p[9],
-                )
-                coverage = float(alilen) / len(x)
-                pdb_id = pdb.split("_")[0]
-
-                # Use the same template filters as AF3 and only use 1 template per PDB
-                if (
-                    float(qid) == 1.0
-                    and coverage >= 0.95
-                    or coverage < 0.1
-                    or pdb_id in tested_pdbs
-                ):
-                    continue
-
-                pdb_id = pdb.split("_")[0]
+        with open(f"{path}/pdb70.m8", "r") as f:
+            templates = templates_from_hits(x, f.read().splitlines(), num_templates, prefix)
+
+    return (a3m_lines, templates) if use_templates else a3m_lines
+
+
+def templates_from_hits(x, m8_lines, num_templates, prefix, template_cache=None):
+    """
+    AF3 templates of sequence ``x`` from its pdb70 hits (lines of the MMseqs2 pdb70.m8), through
+    ``template_cache`` (an mmcif_cache.MmcifCache) if given.
+    """
+    logger.info('Finding and preparing templates')
+    tested_pdbs = []
+    templates = []
+    count = 0
+    for line in m8_lines:
+        template = {}
+        if count < num_templates:
+            p = line.rstrip().split()
+            pdb, qid, alilen, qstart, qend, tstart, tend = (
+                p[1],
+                p[2],
+                p[3],
+                p[6],
+                p[7],
+                p[8],
+                p[9],
+            )
+            coverage = float(alilen) / len(x)
+            pdb_id = pdb.split("_")[0]
+
+            # Use the same template filters as AF3 and only use 1 template per PDB
+            if (
+                float(qid) == 1.0
+                and coverage >= 0.95
+                or coverage < 0.1
+                or pdb_id in tested_pdbs
+            ):
+                continue
+
+            pdb_id = pdb.split("_")[0]
+            try:
                 cif_str = fetch_mmcif(
-                    pdb_id, pdb.split("_")[1], int(tstart), int(tend), prefix
+                    pdb_id, pdb.split("_")[1], int(tstart), int(tend), prefix, template_cache
                 )
-                template["mmcif"] = cif_str
+            except mmcif_cache.MmcifNotAvailable as e:
+                logger.warning(f"Skipping template {pdb}: {e}")
+                continue
+            template["mmcif"] = cif_str
 
-                template_seq = extract_sequence_from_mmcif(StringIO(cif_str))
-                query_indices, template_indices = align_and_map(x, template_seq)
+            template_seq = extract_sequence_from_mmcif(StringIO(cif_str))
+            query_indices, template_indices = align_and_map(x, template_seq, (int(qstart), int(qend)))
 
-                template["queryIndices"] = query_indices
-                template["templateIndices"] = template_indices
-                templates.append(template)
-                tested_pdbs.append(pdb_id)
-                count += 1
-        logger.info(f'Found the following templates: {tested_pdbs}')
-
-    return (a3m_lines, templates) if use_templates else a3m_lines
+            template["queryIndices"] = query_indices
+            template["templateIndices"] = template_indices
+            templates.append(template)
+            tested_pdbs.append(pdb_id)
+            count += 1
+    logger.info(f'Found the following templates: {tested_pdbs}')
+    return templates
 
 
 def fetch_mmcif(
@@ -314,8 +331,11 @@ def fetch_mmcif(
     start,
     end,
     tmpdir,
+    template_cache=None,
 ):
     """Fetch the mmcif file for a given PDB ID and chain ID and prepare it for use in AlphaFold3"""
+    if template_cache is not None:
+        return template_cache.template(pdb_id, chain_id, start, end, tmpdir)
     pdb_id = pdb_id.lower()
     url_base = "http://www.ebi.ac.uk/pdbe-srv/view/files/"
     url = url_base + pdb_id + ".cif"
@@ -352,4 +372,8 @@ if __name__ == "__main__":
         args.target_id,
         output_json=args.output_json,
         to_file=True,
+        host_url=args.host_url,
+        cache_dir=args.cache_dir,
+        mmcif_cache_dir=args.mmcif_cache_dir,
+        pdb_mirror_dir=args.pdb_mirror_dir,
     )
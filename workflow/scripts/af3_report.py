@@ -21,6 +21,7 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from matplotlib.colors import LinearSegmentedColormap
 from preprocessing import sanitised_name
+import json_io
 
 BLUE_WHITE_CMAP = LinearSegmentedColormap.from_list(
     "blue_white_good",
@@ -90,7 +91,7 @@ def _read_summary_confidences(af3_dir: Path) -> Optional[dict]:
     if not candidates:
         return None
     try:
-        return json.loads(candidates[0].read_text())
+        return json_io.load(str(candidates[0]))
     except Exception:
         return None
 
@@ -424,7 +425,7 @@ def generate_molstar_viewers_for_predictions(
         summary_path = row.get("summary_path")
         if summary_path and Path(summary_path).exists():
             try:
-                summary = json.loads(Path(summary_path).read_text())
+                summary = json_io.load(summary_path)
             except Exception:
                 summary = None
 
@@ -541,7 +542,8 @@ def load_input_descriptions(input_tsv: Optional[Path]) -> dict[str, dict[str, st
 
 
 def get_job_name_from_sample_id(sample_id: str) -> str:
-    return re.sub(r"_seed-\d+$", "", sample_id)
+    # one-seed jobs (<job>_seed-<s>) and seed packs (<job>_seeds-<first>-to-<last>)
+    return re.sub(r"_seeds?-\d+(-to-\d+)?$", "", sample_id)
 
 
 def lookup_chain_description(
@@ -1471,8 +1473,7 @@ def plot_pae_with_chain_breaks(conf: dict, outpath: Path, title: str = "PAE") ->
     return True
 
 def load_json(p: Path) -> dict:
-    with p.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    return json_io.load(str(p))
 
 def pick_conf_for_plot(df_pred: pd.DataFrame) -> Path | None:
     if df_pred.empty:
@@ -1503,24 +1504,29 @@ def make_sample_pred_id(sample_id: str, prediction_id: str, sample: int | None)
         return f"{sample_id}_sample-unknown"
     return f"{sample_id}_sample-{int(sample)}"
 
+def existing_path(p: Path) -> Path | None:
+    """``p`` or its compressed variant (``.json.zst`` with --compress_large_output_files), if present."""
+    found = json_io.find_existing(str(p))
+    return Path(found) if found else None
+
 def resolve_confidences_path(summary_path: Path, layout: str) -> Path | None:
     parent = summary_path.parent
 
     if layout == "nagarnat":
         if summary_path.name == "summary_confidences.json":
             p = parent / "confidences.json"
-            return p if p.exists() else None
+            return existing_path(p)
 
         if summary_path.name.endswith("_summary_confidences.json"):
             p = parent / summary_path.name.replace("_summary_confidences.json", "_confidences.json")
-            return p if p.exists() else None
+            return existing_path(p)
 
         return None
 
     if layout == "dm":
         if summary_path.name.endswith("_summary_confidences.json"):
             p = parent / summary_path.name.replace("_summary_confidences.json", "_confidences.json")
-            return p if p.exists() else None
+            return existing_path(p)
         return None
 
     raise ValueError(f"Unknown layout: {layout}")
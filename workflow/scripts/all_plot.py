@@ -93,7 +93,7 @@ def plot_tm_score_distribution(
         d["TM_max"] = d["TM2"]
     # ────────────────────────────────────────────────────────────────────────
 
-    d["name"] = d["sample_id"].str.split("_seed-").str[0].astype(str).replace("nan", "N/A")
+    d["name"] = d["sample_id"].str.split(r"_seeds?-", regex=True).str[0].astype(str).replace("nan", "N/A")
     if "seed" not in d.columns or d["seed"].astype(str).eq("").all():
         d["seed"] = d["sample_id"].str.extract(r"_seed-(\d+)", expand=False).fillna("N/A")
     else:
@@ -332,7 +332,7 @@ def plot_chain_pair_iptm_cumulative(
         return False
 
     # ---- derive helper columns ----
-    d["name"] = d["sample_id"].str.split("_seed-").str[0].astype(str).replace("nan", "N/A")
+    d["name"] = d["sample_id"].str.split(r"_seeds?-", regex=True).str[0].astype(str).replace("nan", "N/A")
 
     if "seed" not in d.columns or d["seed"].astype(str).isin(["", "N/A", "nan"]).all():
         d["seed"] = d["sample_id"].str.extract(r"_seed-(\d+)", expand=False).fillna("N/A")
@@ -0,0 +1,365 @@
+"""
+Long-lived AF3 inference worker and its thin client.
+
+A worker is started once per GPU inside the AF3 container. It loads the model weights
+once and then serves fold inputs from a queue directory shared with the clients, so the
+JIT compilation of every token bucket is paid once per worker instead of once per job.
+
+Layout of a queue directory::
+
+    <queue>/pending/<request>.json            # enqueued by ``submit``
+    <queue>/running/<worker>/<request>.json   # claimed by a worker (atomic rename)
+    <queue>/running/<worker>.requeue-<...>/   # claims of a dead worker, being requeued
+    <queue>/done/<request>.json               # result: {"status": "ok" | "failed", ...}
+    <queue>/workers/<worker>.json             # heartbeat of every live worker
+
+A worker exits once the queue stayed empty for ``--idle-timeout`` seconds (or as soon as
+it is drained with ``--exit-when-drained``). Requests claimed by a worker that stopped
+heartbeating are put back in the queue, up to ``--max-attempts`` times.
+
+Fold inputs may be compressed (``.json.gz`` / ``.json.zst``, see json_io.py); a worker decompresses
+them to a temporary directory just before predicting.
+
+The model is any callable ``predict(json_path, output_dir)``; ``--model-callable`` selects
+a stand-in (e.g. ``inference_worker:placeholder_model``) to exercise the queue without a GPU.
+
+Stdlib only: runs inside the AF3 container.
+"""
+import argparse
+import importlib
+import inspect
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from typing import Callable, Optional
+
+import json_io
+
+logger = logging.getLogger("inference_worker")
+
+SUBDIRS = ("pending", "running", "done", "workers")
+REQUEUE_MARK = ".requeue-"
+
+
+def queue_paths(queue_dir: str) -> dict:
+    paths = {name: os.path.join(queue_dir, name) for name in SUBDIRS}
+    for path in paths.values():
+        os.makedirs(path, exist_ok=True)
+    return paths
+
+
+def write_json_atomic(path: str, payload: dict) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def sanitised_name(name: str) -> str:
+    """Output directory name AF3 uses for a fold input name."""
+    return re.sub(r"[^\w\-.]", "", name.lower().replace(" ", "_"))
+
+
+# --------------------------------------------------------------------------- client
+
+def enqueue(queue_dir: str, json_path: str, output_dir: str) -> str:
+    """Add a fold input to the queue. Returns the request ID (FIFO order)."""
+    paths = queue_paths(queue_dir)
+    stem = re.sub(r"\.json(\.gz|\.zst)?$", "", os.path.basename(json_path))
+    request_id = f"{time.time_ns():020d}-{stem}-{uuid.uuid4().hex[:8]}"
+    write_json_atomic(os.path.join(paths["pending"], f"{request_id}.json"), {
+        "json_path": os.path.abspath(json_path),
+        "output_dir": os.path.abspath(output_dir),
+        "attempts": 0,
+    })
+    return request_id
+
+
+def live_workers(queue_dir: str, stale_after: float) -> list:
+    workers_dir = os.path.join(queue_dir, "workers")
+    now = time.time()
+    alive = []
+    for name in os.listdir(workers_dir):
+        try:
+            if now - os.path.getmtime(os.path.join(workers_dir, name)) < stale_after:
+                alive.append(name.removesuffix(".json"))
+        except FileNotFoundError:  # worker exited meanwhile
+            continue
+    return alive
+
+
+def wait_for_result(queue_dir: str, request_id: str, poll_interval: float = 5.0,
+                    no_worker_timeout: float = 600.0, stale_after: float = 120.0) -> dict:
+    """
+    Block until ``request_id`` is done and return its result.
+
+    Raises RuntimeError if no worker heartbeat was seen for ``no_worker_timeout`` seconds
+    while the request was still waiting.
+    """
+    result_path = os.path.join(queue_dir, "done", f"{request_id}.json")
+    last_worker_seen = time.time()
+    while not os.path.exists(result_path):
+        if live_workers(queue_dir, stale_after):
+            last_worker_seen = time.time()
+        elif time.time() - last_worker_seen > no_worker_timeout:
+            raise RuntimeError(f"No live inference worker on {queue_dir} for {no_worker_timeout:.0f} s")
+        time.sleep(poll_interval)
+    with open(result_path) as f:
+        result = json.load(f)
+    os.unlink(result_path)
+    return result
+
+
+# --------------------------------------------------------------------------- worker
+
+def load_model_callable(spec: str, model_dir: str, af3_flags: list) -> Callable[[str, str], None]:
+    """
+    Resolve ``module:attribute``. Factories (callables accepting ``model_dir`` and ``af3_flags``)
+    are called once to build the model; anything else is used as ``predict`` directly.
+    """
+    module_name, attribute = spec.split(":", 1)
+    target = getattr(importlib.import_module(module_name), attribute)
+    if {"model_dir", "af3_flags"} <= set(inspect.signature(target).parameters):
+        return target(model_dir=model_dir, af3_flags=af3_flags)
+    return target
+
+
+def af3_model(model_dir: str, af3_flags: list) -> Callable[[str, str], None]:
+    """
+    Load AlphaFold 3 once (``/app/alphafold/run_alphafold.py`` of the AF3 container) and return
+    a ``predict(json_path, output_dir)`` that runs inference only, like
+    ``run_alphafold.py --run_data_pipeline=false``.
+
+    :param af3_flags: extra ``run_alphafold.py`` flags (e.g. ``--num_diffusion_samples=10``)
+    """
+    sys.path.insert(0, "/app/alphafold")
+    import pathlib
+
+    import jax
+    import run_alphafold
+    from alphafold3.common import folding_input
+
+    flags = run_alphafold.flags.FLAGS
+    flags(["run_alphafold.py", f"--model_dir={model_dir}", "--run_data_pipeline=false", *af3_flags])
+    model_runner = run_alphafold.ModelRunner(
+        config=run_alphafold.make_model_config(
+            flash_attention_implementation=flags.flash_attention_implementation,
+            num_diffusion_samples=flags.num_diffusion_samples,
+            num_recycles=flags.num_recycles,
+            return_embeddings=flags.save_embeddings,
+        ),
+        device=jax.local_devices(backend="gpu")[flags.gpu_device],
+        model_dir=pathlib.Path(model_dir),
+    )
+    process_parameters = inspect.signature(run_alphafold.process_fold_input).parameters
+    buckets = tuple(int(bucket) for bucket in flags.buckets)
+
+    def predict(json_path: str, output_dir: str) -> None:
+        for fold_input in folding_input.load_fold_inputs_from_path(pathlib.Path(json_path)):
+            kwargs = {"buckets": buckets, "force_output_dir": flags.force_output_dir}
+            run_alphafold.process_fold_input(
+                fold_input=fold_input,
+                data_pipeline_config=None,
+                model_runner=model_runner,
+                output_dir=os.path.join(output_dir, fold_input.sanitised_name()),
+                **{k: v for k, v in kwargs.items() if k in process_parameters},
+            )
+
+    return predict
+
+
+def placeholder_model(json_path: str, output_dir: str) -> None:
+    """Stand-in model: writes an empty ``<name>_model.cif``. Fails on fold inputs named ``*fail*``."""
+    with open(json_path) as f:
+        name = sanitised_name(json.load(f)["name"])
+    if "fail" in name:
+        raise RuntimeError(f"placeholder_model failure for {name}")
+    os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+    with open(os.path.join(output_dir, name, f"{name}_model.cif"), "w") as f:
+        f.write(f"data_{name}\n")
+
+
+def requeue_stale(queue_dir: str, stale_after: float, max_attempts: int) -> int:
+    """
+    Give back requests claimed by workers without a recent heartbeat. Returns #requeued.
+
+    The claims of a dead worker are first taken over atomically, by renaming its running
+    directory to ``<worker>.requeue-<time_ns>-<id>``, so that concurrent idle workers never
+    requeue the same claim twice. A takeover left behind by a worker that died while requeuing
+    is taken over again once it is ``stale_after`` seconds old.
+    """
+    paths = queue_paths(queue_dir)
+    alive = set(live_workers(queue_dir, stale_after))
+    requeued = 0
+    for worker in os.listdir(paths["running"]):
+        dead_worker, mark, takeover = worker.partition(REQUEUE_MARK)
+        if mark:
+            if time.time_ns() - int(takeover.split("-")[0]) < stale_after * 1e9:
+                continue  # being requeued by another worker
+        elif worker in alive:
+            continue
+        own_dir = os.path.join(paths["running"], f"{dead_worker}{REQUEUE_MARK}{time.time_ns()}-{uuid.uuid4().hex[:8]}")
+        try:
+            os.rename(os.path.join(paths["running"], worker), own_dir)
+        except FileNotFoundError:  # taken over by another worker
+            continue
+        for name in sorted(os.listdir(own_dir)):
+            if not name.endswith(".json"):
+                continue
+            claimed = os.path.join(own_dir, name)
+            with open(claimed) as f:
+                request = json.load(f)
+            request["attempts"] += 1
+            if request["attempts"] >= max_attempts:
+                write_json_atomic(os.path.join(paths["done"], name), {
+                    "status": "failed", "worker": dead_worker,
+                    "error": f"worker {dead_worker} died ({request['attempts']} attempts)",
+                })
+                os.unlink(claimed)
+                logger.error(f"Giving up on {name} after {request['attempts']} attempts")
+            else:
+                write_json_atomic(claimed, request)
+                os.rename(claimed, os.path.join(paths["pending"], name))
+                logger.warning(f"Requeued {name} from dead worker {dead_worker}")
+                requeued += 1
+        shutil.rmtree(own_dir, ignore_errors=True)
+    return requeued
+
+
+def claim_next(paths: dict, worker_dir: str) -> Optional[str]:
+    """Atomically move the oldest pending request into ``worker_dir``. Returns its path or None."""
+    for name in sorted(os.listdir(paths["pending"])):
+        if not name.endswith(".json"):
+            continue
+        claimed = os.path.join(worker_dir, name)
+        try:
+            os.rename(os.path.join(paths["pending"], name), claimed)
+        except FileNotFoundError:  # claimed by another worker
+            continue
+        return claimed
+    return None
+
+
+def serve(queue_dir: str, predict: Callable[[str, str], None], worker_id: str,
+          idle_timeout: float = 600.0, poll_interval: float = 2.0, exit_when_drained: bool = False,
+          stale_after: float = 120.0, max_attempts: int = 2) -> dict:
+    """
+    Serve requests from ``queue_dir`` until it is idle (or drained). A failing request is reported
+    to its client and does not stop the worker. Returns the number of succeeded / failed requests.
+    """
+    paths = queue_paths(queue_dir)
+    heartbeat = os.path.join(paths["workers"], f"{worker_id}.json")
+    worker_dir = os.path.join(paths["running"], worker_id)
+    counts = {"ok": 0, "failed": 0}
+    stopped = threading.Event()
+
+    def beat():  # keeps beating while a long prediction runs
+        while not stopped.wait(stale_after / 4):
+            write_json_atomic(heartbeat, {"pid": os.getpid(), "host": socket.gethostname(), **counts})
+
+    # Heartbeat first, so that other workers never take our claims for those of a dead worker
+    write_json_atomic(heartbeat, {"pid": os.getpid(), "host": socket.gethostname(), **counts})
+    os.makedirs(worker_dir, exist_ok=True)
+    beat_thread = threading.Thread(target=beat, daemon=True)
+    beat_thread.start()
+    last_busy = time.time()
+    try:
+        while True:
+            claimed = claim_next(paths, worker_dir)
+            if claimed is None:
+                requeue_stale(queue_dir, stale_after, max_attempts)
+                if exit_when_drained or time.time() - last_busy > idle_timeout:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            name = os.path.basename(claimed)
+            with open(claimed) as f:
+                request = json.load(f)
+            start = time.time()
+            try:
+                # compressed fold inputs are decompressed to node-local scratch for the model
+                with tempfile.TemporaryDirectory(prefix="af3_input_") as scratch:
+                    predict(json_io.decompress(request["json_path"], scratch), request["output_dir"])
+                result = {"status": "ok"}
+            except Exception:
+                result = {"status": "failed", "error": traceback.format_exc()}
+                logger.error(f"{name} failed:\n{result['error']}")
+            result.update(worker=worker_id, seconds=round(time.time() - start, 1))
+            counts[result["status"]] += 1
+            write_json_atomic(os.path.join(paths["done"], name), result)
+            os.unlink(claimed)
+            logger.info(f"{name}: {result['status']} in {result['seconds']} s")
+            last_busy = time.time()
+    finally:
+        stopped.set()
+        beat_thread.join()
+        shutil.rmtree(worker_dir, ignore_errors=True)
+        os.unlink(heartbeat)
+    logger.info(f"Worker {worker_id} exiting: {counts['ok']} succeeded, {counts['failed']} failed")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Run a worker (one per GPU)")
+    serve_parser.add_argument("--queue", required=True, help="Queue directory shared with the clients")
+    serve_parser.add_argument("--model-dir", default="/root/models", help="AF3 model weights")
+    serve_parser.add_argument("--model-callable", default="inference_worker:af3_model",
+                              help="module:attribute of the model (or of a factory building it)")
+    serve_parser.add_argument("--gpu", default=None, help="Pin the worker to this GPU (CUDA_VISIBLE_DEVICES)")
+    serve_parser.add_argument("--idle-timeout", type=float, default=600, help="Exit after this many idle seconds")
+    serve_parser.add_argument("--exit-when-drained", action="store_true", help="Exit as soon as the queue is empty")
+    serve_parser.add_argument("--poll-interval", type=float, default=2)
+    serve_parser.add_argument("--stale-after", type=float, default=120,
+                              help="Seconds without heartbeat after which a worker is considered dead")
+    serve_parser.add_argument("--max-attempts", type=int, default=2,
+                              help="Attempts of a request whose worker died before giving up")
+    serve_parser.add_argument("af3_flags", nargs="*", help="Extra run_alphafold.py flags (after --)")
+
+    submit_parser = commands.add_parser("submit", help="Enqueue a fold input (and wait for its result)")
+    submit_parser.add_argument("--queue", required=True)
+    submit_parser.add_argument("--json-path", required=True, help="Fold input JSON")
+    submit_parser.add_argument("--output-dir", required=True, help="AF3 output directory (--output_dir)")
+    submit_parser.add_argument("--wait", action="store_true", help="Block until done; exit 1 if it failed")
+    submit_parser.add_argument("--poll-interval", type=float, default=5)
+    submit_parser.add_argument("--no-worker-timeout", type=float, default=600,
+                               help="Fail if no worker is alive for this many seconds while waiting")
+    submit_parser.add_argument("--stale-after", type=float, default=120)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "submit":
+        request_id = enqueue(args.queue, args.json_path, args.output_dir)
+        logger.info(f"Enqueued {args.json_path} as {request_id}")
+        if args.wait:
+            result = wait_for_result(args.queue, request_id, args.poll_interval,
+                                     args.no_worker_timeout, args.stale_after)
+            if result["status"] != "ok":
+                logger.error(f"{request_id} failed on worker {result.get('worker')}:\n{result.get('error')}")
+                sys.exit(1)
+            logger.info(f"{request_id} done on worker {result['worker']} in {result['seconds']} s")
+        return
+
+    if args.gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    predict = load_model_callable(args.model_callable, args.model_dir, args.af3_flags)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}" + (f"-gpu{args.gpu}" if args.gpu is not None else "")
+    serve(args.queue, predict, worker_id, args.idle_timeout, args.poll_interval, args.exit_when_drained,
+          args.stale_after, args.max_attempts)
+
+
+if __name__ == "__main__":
+    main()
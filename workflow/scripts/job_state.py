@@ -0,0 +1,168 @@
+"""
+Durable state of AF3 inference jobs, kept in one SQLite database next to the outputs.
+
+Every inference job is recorded as ``queued`` (waiting for a GPU), ``running``, ``done`` or
+``failed``, with its host, number of attempts, exit code and timestamps. ``AF3_INFERENCE``
+wraps ``run_alphafold.py`` in ``job_state.py run``; ``GET_DONE_OUTPUTS`` and
+``COLLECT_AF3_PREDICTIONS`` read the finished jobs back from the database. A job that is
+``done`` and whose output is still present is not run again when it is resubmitted.
+
+The database is opened in WAL mode with a generous busy timeout, so that the concurrent
+jobs of a node can update it without blocking readers.
+
+Stdlib only: runs inside the AF3 container.
+"""
+import argparse
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from typing import Optional
+
+logger = logging.getLogger("job_state")
+
+STATUSES = ("queued", "running", "done", "failed")
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=120)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            exit_code INTEGER,
+            host TEXT,
+            output TEXT,
+            queued_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+        """
+    )
+    return conn
+
+
+def set_status(conn: sqlite3.Connection, job: str, status: str, **fields) -> None:
+    """Record ``status`` of ``job`` (creating it if needed) together with any other column in ``fields``."""
+    if status not in STATUSES:
+        raise ValueError(f"Unknown job status {status!r}, expected one of {STATUSES}")
+    now = time.time()
+    fields = {"status": status, "updated_at": now, **fields}
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO jobs (job, status, updated_at) VALUES (?, ?, ?)", (job, status, now))
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in fields)} WHERE job = ?",
+                     (*fields.values(), job))
+
+
+def get_job(conn: sqlite3.Connection, job: str) -> Optional[dict]:
+    conn.row_factory = sqlite3.Row
+    row = conn.execute("SELECT * FROM jobs WHERE job = ?", (job,)).fetchone()
+    conn.row_factory = None
+    return dict(row) if row is not None else None
+
+
+def jobs_with_status(conn: sqlite3.Connection, status: str) -> list:
+    return [job for job, in conn.execute("SELECT job FROM jobs WHERE status = ? ORDER BY job", (status,))]
+
+
+def is_finished(conn: sqlite3.Connection, job: str, output: Optional[str] = None) -> bool:
+    """True if ``job`` is done and its recorded (or given) output still exists."""
+    state = get_job(conn, job)
+    if state is None or state["status"] != "done":
+        return False
+    output = output or state["output"]
+    return output is None or os.path.exists(output)
+
+
+def run_job(conn: sqlite3.Connection, job: str, command: list, output: Optional[str] = None) -> int:
+    """
+    Run ``command`` as ``job`` and record its outcome. Finished jobs are skipped.
+
+    :param output: file the job produces; a done job is only skipped if it still exists
+    :return: exit code of the command (0 if skipped)
+    """
+    if is_finished(conn, job, output):
+        logger.info(f"{job} is already done, skipping it")
+        return 0
+    attempts = (get_job(conn, job) or {}).get("attempts", 0) + 1
+    set_status(conn, job, "running", attempts=attempts, host=socket.gethostname(), output=output,
+               exit_code=None, started_at=time.time(), finished_at=None)
+    try:
+        exit_code = subprocess.run(command).returncode
+    except BaseException:
+        set_status(conn, job, "failed", exit_code=-1, finished_at=time.time())
+        raise
+    if exit_code == 0 and output is not None and not os.path.exists(output):
+        logger.error(f"{job} exited successfully but did not write {output}")
+        exit_code = 1
+    set_status(conn, job, "done" if exit_code == 0 else "failed", exit_code=exit_code, finished_at=time.time())
+    return exit_code
+
+
+def summary(conn: sqlite3.Connection) -> dict:
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    return {status: counts.get(status, 0) for status in STATUSES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", required=True, help="Job state database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    mark_parser = commands.add_parser("mark", help="Set the status of a job")
+    mark_parser.add_argument("--job", required=True)
+    mark_parser.add_argument("--status", required=True, choices=STATUSES)
+    mark_parser.add_argument("--output", default=None, help="File the job produces")
+
+    run_parser = commands.add_parser("run", help="Run a job's command (after --) and record its outcome")
+    run_parser.add_argument("--job", required=True)
+    run_parser.add_argument("--output", default=None, help="File the job produces")
+    run_parser.add_argument("cmd", nargs=argparse.REMAINDER)
+
+    flags_parser = commands.add_parser("done-flags", help="Touch <dir>/<job>.done.txt for every done job")
+    flags_parser.add_argument("flag_dir")
+
+    commands.add_parser("status", help="Print the number of jobs per status and the failed jobs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    conn = connect(args.db)
+    if args.command == "mark":
+        fields = {"queued_at": time.time()} if args.status == "queued" else {}
+        if args.status in ("done", "failed"):
+            fields["finished_at"] = time.time()
+        if args.output:
+            fields["output"] = args.output
+        if not (args.status == "queued" and is_finished(conn, args.job)):
+            set_status(conn, args.job, args.status, **fields)
+    elif args.command == "run":
+        command = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+        if not command:
+            parser.error("run: no command given after --")
+        sys.exit(run_job(conn, args.job, command, args.output))
+    elif args.command == "done-flags":
+        os.makedirs(args.flag_dir, exist_ok=True)
+        done = [job for job in jobs_with_status(conn, "done") if is_finished(conn, job)]
+        for job in done:
+            open(os.path.join(args.flag_dir, f"{job}.done.txt"), "a").close()
+        logger.info(f"{len(done)} done jobs flagged in {args.flag_dir}")
+    else:
+        for status, count in summary(conn).items():
+            print(f"{status}\t{count}")
+        for job in jobs_with_status(conn, "failed"):
+            state = get_job(conn, job)
+            print(f"failed\t{job}\texit_code={state['exit_code']}\thost={state['host']}\tattempts={state['attempts']}")
+
+
+if __name__ == "__main__":
+    main()
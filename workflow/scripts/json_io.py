@@ -0,0 +1,137 @@
+"""
+Shared JSON I/O: transparent compression and a fast codec when available.
+
+The compression of a file is given by its name: ``.json.gz`` (gzip, stdlib) or ``.json.zst``
+(zstandard, needs the ``zstandard`` package); anything else is plain JSON. Files are always
+written without indentation, atomically, and with ``orjson`` when it is installed.
+
+Stdlib only (``orjson`` and ``zstandard`` are optional): also runs inside the AF3 container,
+e.g. to decompress an inference input just before ``run_alphafold.py`` reads it::
+
+    python json_io.py decompress <input>.json.zst <scratch_dir>   # prints the plain JSON path
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {"gz": ".gz", "zst": ".zst"}
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+
+def compression_of(path: str) -> Optional[str]:
+    """'gz', 'zst' or None (plain JSON), from the file name."""
+    return next((name for name, suffix in COMPRESSION_SUFFIXES.items() if str(path).endswith(suffix)), None)
+
+
+def with_compression(path: str, compression: Optional[str]) -> str:
+    """``path`` with the suffix of ``compression`` ('gz', 'zst', or None/'none' for plain JSON)."""
+    if not compression or compression == "none":
+        return path
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown JSON compression {compression!r}, expected one of none, {', '.join(COMPRESSION_SUFFIXES)}")
+    return path + COMPRESSION_SUFFIXES[compression]
+
+
+def find_existing(path: str) -> Optional[str]:
+    """``path``, or its compressed variant (e.g. AF3's ``--compress_large_output_files``), whichever exists."""
+    return next((candidate for candidate in (path, *(path + suffix for suffix in COMPRESSION_SUFFIXES.values()))
+                 if os.path.exists(candidate)), None)
+
+
+def _require_zstandard() -> None:
+    if zstandard is None:
+        raise RuntimeError("Reading or writing .zst files requires the 'zstandard' package")
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read()
+    compression = compression_of(path)
+    if compression == "gz":
+        return gzip.decompress(data)
+    if compression == "zst":
+        _require_zstandard()
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def write_bytes(path: str, data: bytes) -> None:
+    """Write ``data`` to ``path`` (compressed according to its name) through a temporary file."""
+    compression = compression_of(path)
+    if compression == "gz":
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    elif compression == "zst":
+        _require_zstandard()
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact JSON as UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def load(path: str) -> Any:
+    return loads(read_bytes(path))
+
+
+def dump(obj: Any, path: str) -> None:
+    write_bytes(path, dumps(obj))
+
+
+def decompress(path: str, dest_dir: str) -> str:
+    """Plain JSON copy of ``path`` in ``dest_dir`` (``path`` itself if it is not compressed)."""
+    compression = compression_of(path)
+    if compression is None:
+        return path
+    plain_path = os.path.join(dest_dir, os.path.basename(path)[:-len(COMPRESSION_SUFFIXES[compression])])
+    write_bytes(plain_path, read_bytes(path))
+    return plain_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    decompress_parser = commands.add_parser("decompress", help="Write a plain copy of a compressed JSON, print its path")
+    decompress_parser.add_argument("path")
+    decompress_parser.add_argument("dest_dir")
+    compress_parser = commands.add_parser("compress", help="Rewrite a JSON file compactly (and compressed)")
+    compress_parser.add_argument("path")
+    compress_parser.add_argument("output")
+    args = parser.parse_args()
+
+    if args.command == "decompress":
+        print(decompress(args.path, args.dest_dir))
+    else:
+        dump(load(args.path), args.output)
+        print(args.output, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
 import pandas as pd
 import pdb
-import json
 import os
 from pathlib import Path
 import copy
+import functools
+import hashlib
 import click
 
+import a3m
+import json_io
+import msa_subsample
+import pair_msas
+import token_estimator
+
 MSA_KEYS = {"unpairedMsa", "unpairedMsaPath", "pairedMsa", "pairedMsaPath", "templates"}
 IDENTITY_KEYS = ["sequence", "ccdCodes", "smiles"]
 
@@ -16,15 +23,250 @@ def get_chain_identity(s: dict):
             return (k, tuple(v) if isinstance(v, list) else v)
     raise KeyError(f"No identity key found in sequence entry: {s.keys()}")
 
+DEFAULT_CACHE_SIZE = 32
+DIGEST_SIZE = 20
+
+
+def store_payload(text, store_dir, suffix):
+    """Write ``text`` once to the content-addressed ``store_dir`` and return its path."""
+    digest = hashlib.blake2b(text.encode(), digest_size=DIGEST_SIZE).hexdigest()
+    path = os.path.join(store_dir, digest[:2], f"{digest}{suffix}")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    return path
+
+
+def parse_path_map(items):
+    """``HOST=CONTAINER`` prefixes (e.g. the bind mounts of run_workflow.sh), longest host prefix first."""
+    pairs = [item.split("=", 1) for item in items]
+    return tuple(sorted(((os.path.abspath(host), container.rstrip("/")) for host, container in pairs),
+                        key=lambda pair: -len(pair[0])))
+
+
+def map_path(path, path_map=()):
+    """Absolute path of ``path`` as seen inside the container."""
+    path = os.path.abspath(path)
+    for host, container in path_map:
+        if path == host or path.startswith(host + os.sep):
+            return container + path[len(host):]
+    return path
+
+
+def externalize_payloads(entry, store_dir, path_map=()):
+    """
+    Replace the inline MSAs and template mmCIFs of a sequence entry by ``unpairedMsaPath``,
+    ``pairedMsaPath`` and ``mmcifPath`` references into the store (in place). Empty MSAs stay
+    inline, as they mean "no MSA" to AF3.
+    """
+    for key in ("unpairedMsa", "pairedMsa"):
+        if entry.get(key):
+            entry[f"{key}Path"] = map_path(store_payload(entry.pop(key), store_dir, ".a3m"), path_map)
+    for template in entry.get("templates") or []:
+        if template.get("mmcif"):
+            template["mmcifPath"] = map_path(store_payload(template.pop("mmcif"), store_dir, ".cif"), path_map)
+    return entry
+
+
+def load_monomer_entries(monomer_file, store_dir=None, path_map=()):
+    """
+    Sequence entries of a monomer data JSON, keyed by chain identity. With ``store_dir``, their
+    MSAs and templates are moved to the store and referenced by path (see :func:`externalize_payloads`).
+    """
+    sequences = json_io.load(monomer_file)["sequences"]
+    entries = {get_chain_identity(s)[1]: s for s in (next(iter(entry.values())) for entry in sequences)}
+    if store_dir:
+        for entry in entries.values():
+            externalize_payloads(entry, store_dir, path_map)
+    return entries
+
+
+def msa_source(entry, key, store_dir=None):
+    """
+    Digest and loader of the ``key`` MSA ('unpairedMsa' / 'pairedMsa') of a chain, inline or
+    referenced by path. MSAs referenced in ``store_dir`` (container paths) are named after their
+    digest and read from it.
+    """
+    path = entry.get(f"{key}Path")
+    if path and store_dir:
+        stored = os.path.join(store_dir, os.path.basename(os.path.dirname(path)), os.path.basename(path))
+        if os.path.exists(stored):
+            return Path(stored).stem, Path(stored).read_text
+    text = Path(path).read_text() if path else entry.get(key) or ""
+    return pair_msas.msa_digest(text), lambda: text
+
+
+def set_msa(entry, key, text, store_dir=None, path_map=()):
+    """Set the ``key`` MSA of a chain, by reference into ``store_dir`` if given."""
+    entry.pop(key, None)
+    entry.pop(f"{key}Path", None)
+    if store_dir:
+        entry[f"{key}Path"] = map_path(store_payload(text, store_dir, ".a3m"), path_map)
+    else:
+        entry[key] = text
+
+
+@functools.lru_cache(maxsize=8)
+def deduplicated(text):
+    """Unpaired MSA without repeated aligned rows (a3m.py), shared by the multimers of a monomer."""
+    return a3m.filter_msa(text)
+
+
+def dedup_chain_msas(multimer_data, store_dir=None, path_map=()):
+    """Drop the rows of the unpaired MSA of every chain that repeat an earlier row (in place)."""
+    for seq in multimer_data["sequences"]:
+        s = next(iter(seq.values()))
+        if not (s.get("unpairedMsa") or s.get("unpairedMsaPath")):
+            continue
+        _, load = msa_source(s, "unpairedMsa", store_dir)
+        text = load()
+        unique = deduplicated(text)
+        if len(unique) < len(text):
+            set_msa(s, "unpairedMsa", unique, store_dir, path_map)
+    return multimer_data
+
+
+def subsample_chain_msas(multimer_data, max_rows=None, depth_budget=None, min_coverage=0.0, min_identity=0.0,
+                         store_dir=None, path_map=()):
+    """
+    Cap the unpaired MSA of every chain (in place) at ``max_rows`` and/or ``depth_budget`` divided by
+    the tokens of the job, keeping a diverse subset of the rows (msa_subsample.py). Logs the
+    original and retained depths.
+    """
+    depth = msa_subsample.job_depth(token_estimator.fold_input_tokens(multimer_data), max_rows, depth_budget)
+    for seq in multimer_data["sequences"]:
+        s = next(iter(seq.values()))
+        if depth is None or not (s.get("unpairedMsa") or s.get("unpairedMsaPath")):
+            continue
+        _, load = msa_source(s, "unpairedMsa", store_dir)
+        msa_ranking = msa_subsample.ranking(load(), min_coverage, min_identity)
+        text = msa_ranking.subsample(depth)
+        n_kept = text.count(">")
+        if n_kept < msa_ranking.depth:
+            set_msa(s, "unpairedMsa", text, store_dir, path_map)
+        chain_ids = ",".join(s["id"]) if isinstance(s["id"], list) else s["id"]
+        print(f"{multimer_data['name']} chain {chain_ids}: MSA depth {msa_ranking.depth} -> {n_kept}")
+    return multimer_data
+
+
+def pair_chain_msas(multimer_data, pair_cache_dir, store_dir=None, path_map=()):
+    """
+    Replace the UniProt MSAs of the protein chains of a heteromer by MSAs paired across its
+    chains (pair_msas.py), in place. Copies of a chain share its paired MSA; homomers and
+    chains without shared species are left untouched, and so are chains whose ``pairedMsa`` is
+    empty or missing (run without an MSA on purpose).
+    """
+    entities = {}
+    for seq in multimer_data["sequences"]:
+        if "protein" in seq and (seq["protein"].get("pairedMsa") or seq["protein"].get("pairedMsaPath")):
+            entities.setdefault(seq["protein"]["sequence"], []).append(seq["protein"])
+    if len(entities) < 2:
+        return multimer_data
+    sources = [msa_source(chains[0], "pairedMsa", store_dir) for chains in entities.values()]
+    paired = pair_msas.cached_pair_msas(pair_cache_dir, [digest for digest, _ in sources], list(entities),
+                                        lambda: [load() for _, load in sources])
+    for chains, msa in zip(entities.values(), paired or []):
+        for s in chains:
+            set_msa(s, "pairedMsa", msa, store_dir, path_map)
+    return multimer_data
+
+
+def merge_multimer(multimer_data, monomer_files, load_monomer=load_monomer_entries, stages=()):
+    """
+    Copy the MSA and template fields of the matching monomer chains into every chain of the
+    multimer fold input (in place). Chains without a matching monomer lose their MSA fields.
+
+    :param load_monomer: parser of a monomer file (e.g. an LRU-cached :func:`load_monomer_entries`);
+        its results are only read, so they can be shared between multimers
+    :param stages: applied in order to the merged multimer (e.g. :func:`dedup_chain_msas`,
+        :func:`subsample_chain_msas`, :func:`pair_chain_msas`)
+    """
+    monomer_lookup = {}
+    for mf in monomer_files:
+        monomer_lookup.update(load_monomer(mf))
+
+    for seq in multimer_data["sequences"]:
+        s = next(iter(seq.values()))
+        _, identity = get_chain_identity(s)
+        for k in MSA_KEYS:
+            s.pop(k, None)
+        if identity in monomer_lookup:
+            monomer_s = monomer_lookup[identity]
+            s.update({k: monomer_s[k] for k in MSA_KEYS if k in monomer_s})
+    for stage in stages:
+        stage(multimer_data)
+    return multimer_data
+
+
+def write_merged(merged_multimer, output_file):
+    """Write the merged JSON (with all its model seeds) with one serialization, compressed if ``output_file`` ends in .gz/.zst."""
+    json_io.dump(merged_multimer, output_file)
+
+
+def merge_batch(batch_spec, cache_size=DEFAULT_CACHE_SIZE, store_dir=None, path_map=(), stages=()):
+    """
+    Merge every multimer of ``batch_spec`` (TSV: multimer_file, monomer_files (comma separated),
+    output_file) in one process. Each monomer JSON is parsed once while it stays in the LRU cache,
+    so order the spec such that multimers sharing monomers are adjacent.
+    """
+    load_monomer = functools.lru_cache(maxsize=cache_size)(
+        functools.partial(load_monomer_entries, store_dir=store_dir, path_map=path_map))
+    spec_df = pd.read_csv(batch_spec, sep="\t", dtype=str)
+    for row in spec_df.itertuples(index=False):
+        multimer_data = json_io.load(row.multimer_file)
+        merge_multimer(multimer_data, row.monomer_files.split(","), load_monomer, stages)
+        write_merged(multimer_data, row.output_file)
+    info = load_monomer.cache_info()
+    print(f"Merged {len(spec_df)} multimers from {info.misses} monomer JSON parses ({info.hits} cache hits)")
+
+
 @click.command()
-@click.argument("multimer_file", type=click.Path(exists=True))
+@click.argument("multimer_file", type=click.Path(exists=True), required=False)
 @click.argument("monomer_file", type=click.Path(exists=True), nargs=-1)
-@click.argument("output_file", type=click.Path())  # where merged JSON will be saved
+@click.argument("output_file", type=click.Path(), required=False)  # where merged JSON will be saved
 @click.option("--inference-to-data-map", type=click.Path())  # where merged JSON will be saved
-def main(multimer_file, monomer_file, output_file, inference_to_data_map):
+@click.option("--batch-spec", type=click.Path(exists=True),
+              help="TSV of multimer_file, monomer_files (comma separated), output_file to merge in one process")
+@click.option("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, show_default=True,
+              help="Number of parsed monomer JSONs kept in memory in --batch-spec mode")
+@click.option("--msa-store", type=click.Path(), default=None,
+              help="Write MSAs and template mmCIFs once to this content-addressed directory and reference them by path")
+@click.option("--path-map", multiple=True,
+              help="HOST=CONTAINER prefix used to rewrite --msa-store paths for the AF3 container (repeatable)")
+@click.option("--pair-cache-dir", type=click.Path(), default=None,
+              help="Pair the UniProt MSAs of heteromer chains by species (pair_msas.py), caching the pairings here")
+@click.option("--msa-dedup", is_flag=True, default=False, help="Drop repeated rows of every unpaired MSA")
+@click.option("--msa-max-rows", type=int, default=None, help="Cap every unpaired MSA at this many rows")
+@click.option("--msa-depth-budget", type=int, default=None,
+              help="Cap every unpaired MSA at this budget divided by the tokens of the job (token x depth)")
+@click.option("--msa-min-coverage", type=float, default=0.0, show_default=True,
+              help="When capping, drop rows covering less than this fraction of the query")
+@click.option("--msa-min-identity", type=float, default=0.0, show_default=True,
+              help="When capping, drop rows with a lower identity to the query")
+def main(multimer_file, monomer_file, output_file, inference_to_data_map, batch_spec, cache_size, msa_store, path_map,
+         pair_cache_dir, msa_dedup, msa_max_rows, msa_depth_budget, msa_min_coverage, msa_min_identity):
     """
-    Merge monomer JSONs into a multimer JSON for a given sample.
+    Merge monomer JSONs into a multimer JSON for a given sample (or for every sample of --batch-spec).
     """
+    path_map = parse_path_map(path_map)
+    stages = []
+    if msa_dedup:
+        stages.append(functools.partial(dedup_chain_msas, store_dir=msa_store, path_map=path_map))
+    if msa_max_rows or msa_depth_budget:
+        stages.append(functools.partial(subsample_chain_msas, max_rows=msa_max_rows, depth_budget=msa_depth_budget,
+                                        min_coverage=msa_min_coverage, min_identity=msa_min_identity,
+                                        store_dir=msa_store, path_map=path_map))
+    if pair_cache_dir:
+        stages.append(functools.partial(pair_chain_msas, pair_cache_dir=pair_cache_dir, store_dir=msa_store,
+                                        path_map=path_map))
+    if batch_spec:
+        merge_batch(batch_spec, cache_size, msa_store, path_map, stages)
+        return
+    if not multimer_file or not output_file:
+        raise click.UsageError("MULTIMER_FILE and OUTPUT_FILE are required without --batch-spec")
 
     if inference_to_data_map:
         inference_to_data_map_df = pd.read_csv(inference_to_data_map,sep="\t")
@@ -32,8 +274,7 @@ def main(multimer_file, monomer_file, output_file, inference_to_data_map):
         input_multimer_file = job_map_df.multimer_file.unique()[0]
         grouped = job_map_df.groupby('multimer_file')
         for input_multimer_file_, group in grouped:
-            with open(input_multimer_file, "r") as f:
-                multimer_data = json.load(f)
+            multimer_data = json_io.load(input_multimer_file)
     
             merged_multimer = copy.deepcopy(multimer_data)
     
@@ -49,65 +290,28 @@ def main(multimer_file, monomer_file, output_file, inference_to_data_map):
                 monomer_input_file = row["monomer_file"]
                 target_chain_id = row["monomer_chain_id"]  # e.g., "B"
     
-                with open(monomer_input_file, "r") as f:
-                    monomer_data = json.load(f)
-                    # Extract the source content (the first sequence in the monomer file)
-                    source_content = list(monomer_data['sequences'][0].values())[0]
+                monomer_data = json_io.load(monomer_input_file)
+                # Extract the source content (the first sequence in the monomer file)
+                source_content = list(monomer_data['sequences'][0].values())[0]
     
-                    if target_chain_id in target_map:
-                        # Store the original ID to prevent it from being overwritten
-                        original_id = target_map[target_chain_id]['id']
+                if target_chain_id in target_map:
+                    # Store the original ID to prevent it from being overwritten
+                    original_id = target_map[target_chain_id]['id']
     
-                        # INJECT: Update the multimer's dict with monomer's data
-                        target_map[target_chain_id].update(source_content)
+                    # INJECT: Update the multimer's dict with monomer's data
+                    target_map[target_chain_id].update(source_content)
     
-                        # RESTORE: Ensure the ID remains 'B' even if source was 'A'
-                        target_map[target_chain_id]['id'] = original_id
-                        
+                    # RESTORE: Ensure the ID remains 'B' even if source was 'A'
+                    target_map[target_chain_id]['id'] = original_id
+                    
 
-    # 1️⃣ Load multimer JSON
+    # 1️⃣ Load multimer JSON and merge the MSA keys of the matching monomers into each chain
     else:
-            with open(multimer_file, "r") as f:
-                multimer_data = json.load(f)
-    
-            merged_multimer = copy.deepcopy(multimer_data)
-    
-            # Build identity -> (monomer_file, monomer_chain_id) lookup from all monomer files
-            # Build identity -> (monomer_file, monomer_chain_id, monomer_seq_dict) lookup
-            monomer_lookup = {}
-            for mf in monomer_file:
-                for entry in json.load(open(mf))["sequences"]:
-                    s = next(iter(entry.values()))
-                    _, identity = get_chain_identity(s)
-                    monomer_lookup[identity] = (mf, s["id"], s)
-            
-            # Map each multimer chain to its matching monomer entry
-            chain_map = {}
-            for entry in merged_multimer["sequences"]:
-                s = next(iter(entry.values()))
-                _, identity = get_chain_identity(s)
-                if identity in monomer_lookup:
-                    chain_map[(multimer_file, tuple(s["id"]))] = monomer_lookup[identity]
-            
-            # Merge MSA keys from matched monomer into each multimer chain
-            for seq in merged_multimer["sequences"]:
-                s = next(iter(seq.values()))
-                for k in MSA_KEYS:
-                    s.pop(k, None)
-                chain_id = s["id"]
-                if (multimer_file, tuple(chain_id)) not in chain_map:
-                    continue
-                _, _, monomer_s = chain_map[(multimer_file, tuple(chain_id))]
-                s.update({k: monomer_s[k] for k in MSA_KEYS if k in monomer_s})
+            merged_multimer = merge_multimer(json_io.load(multimer_file), monomer_file, functools.partial(
+                load_monomer_entries, store_dir=msa_store, path_map=path_map), stages)
 
-    
-        # 4️⃣ For each model seed, write a separate merged JSON
-    for s in merged_multimer["modelSeeds"]:
-        seed_merged_multimer = copy.deepcopy(merged_multimer)
-        seed_merged_multimer["modelSeeds"] = [s]
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        with open(output_file, "w") as f:
-            json.dump(seed_merged_multimer, f, indent=4)
+    # 4️⃣ Write the merged JSON with all its model seeds (one seed, or a pack of seeds)
+    write_merged(merged_multimer, output_file)
     print(f"Merged JSON written to {output_file}")
 
 if __name__ == "__main__":
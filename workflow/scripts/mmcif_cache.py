@@ -0,0 +1,189 @@
+"""
+Persistent, content-addressed cache of the PDB mmCIF entries and templates fetched for MMseqs2
+template hits (add_mmseqs_msa.py).
+
+Full entries are looked up in the cache, then in an optional local PDB mirror (the wwPDB
+``mmCIF/<ab>/<pdb_id>.cif.gz`` layout, or flat ``<pdb_id>.cif[.gz]`` files) and only then
+downloaded. Every template extracted from an entry is indexed by (pdb_id, chain, start, end),
+so a repeated template hit is a dictionary lookup: no download and no mmCIF parsing. With a
+populated mirror (or a cache seeded from it) no network access is needed.
+
+Layout of a cache directory::
+
+    <cache_dir>/index.sqlite                 # entries (pdb_id) and templates (pdb_id, chain, start, end)
+    <cache_dir>/objects/<ab>/<digest>.cif.gz # entries and templates, by content
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+from glob import glob
+from io import StringIO
+from typing import Optional
+
+import click
+import requests
+from loguru import logger
+
+import json_io
+from af3_script_utils import get_mmcif
+
+DEFAULT_URL = "http://www.ebi.ac.uk/pdbe-srv/view/files/{pdb_id}.cif"
+DIGEST_SIZE = 20
+
+
+class MmcifNotAvailable(KeyError):
+    pass
+
+
+def connect(cache_dir: str) -> sqlite3.Connection:
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            pdb_id TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            source TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS templates (
+            pdb_id TEXT NOT NULL,
+            chain_id TEXT NOT NULL,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (pdb_id, chain_id, start, end)
+        );
+        """
+    )
+    return conn
+
+
+def object_path(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, "objects", digest[:2], f"{digest}.cif.gz")
+
+
+def mirror_path(mirror_dir: str, pdb_id: str) -> Optional[str]:
+    """File of ``pdb_id`` in a local PDB mirror (divided or flat layout, .cif or .cif.gz), or None."""
+    for name in (pdb_id.lower(), pdb_id.upper()):
+        for directory in (os.path.join(mirror_dir, name[1:3].lower()), mirror_dir):
+            for suffix in (".cif.gz", ".cif"):
+                path = os.path.join(directory, f"{name}{suffix}")
+                if os.path.exists(path):
+                    return path
+    return None
+
+
+class MmcifCache:
+    """mmCIF entries and extracted templates of a cache directory, with its index held in memory."""
+
+    def __init__(self, cache_dir: str, mirror_dir: Optional[str] = None, url: Optional[str] = DEFAULT_URL):
+        """
+        :param mirror_dir: local PDB mirror, searched before downloading
+        :param url: download URL template (``{pdb_id}``); None to never download
+        """
+        self.cache_dir, self.mirror_dir, self.url = cache_dir, mirror_dir, url
+        self.conn = connect(cache_dir)
+        self.entries = dict(self.conn.execute("SELECT pdb_id, digest FROM entries"))
+        self.templates = {(pdb_id, chain_id, start, end): digest for pdb_id, chain_id, start, end, digest
+                          in self.conn.execute("SELECT pdb_id, chain_id, start, end, digest FROM templates")}
+        # Template strings returned by this process
+        self.template_texts = {}
+
+    def _read(self, digest: str) -> Optional[str]:
+        path = object_path(self.cache_dir, digest)
+        return json_io.read_bytes(path).decode() if os.path.exists(path) else None
+
+    def _write(self, text: str) -> str:
+        digest = hashlib.blake2b(text.encode(), digest_size=DIGEST_SIZE).hexdigest()
+        path = object_path(self.cache_dir, digest)
+        if not os.path.exists(path):
+            json_io.write_bytes(path, text.encode())
+        return digest
+
+    def add_entry(self, pdb_id: str, text: str, source: str) -> None:
+        digest = self._write(text)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (pdb_id, digest, source, time.time()))
+        self.entries[pdb_id] = digest
+
+    def entry(self, pdb_id: str) -> str:
+        """Full mmCIF of ``pdb_id``, from the cache, the mirror or the download URL (in this order)."""
+        pdb_id = pdb_id.lower()
+        text = self._read(self.entries[pdb_id]) if pdb_id in self.entries else None
+        if text is not None:
+            return text
+        path = mirror_path(self.mirror_dir, pdb_id) if self.mirror_dir else None
+        if path:
+            text, source = json_io.read_bytes(path).decode(), path
+        elif self.url:
+            source = self.url.format(pdb_id=pdb_id)
+            response = requests.get(source, timeout=120)
+            response.raise_for_status()
+            text = response.text
+        else:
+            raise MmcifNotAvailable(f"{pdb_id} is neither cached nor in the PDB mirror {self.mirror_dir}")
+        self.add_entry(pdb_id, text, source)
+        return text
+
+    def template(self, pdb_id: str, chain_id: str, start: int, end: int, tmpdir: Optional[str] = None) -> str:
+        """mmCIF of residues ``start``-``end`` of chain ``chain_id`` of ``pdb_id`` (af3_script_utils.get_mmcif)."""
+        key = (pdb_id.lower(), chain_id, int(start), int(end))
+        text = self.template_texts.get(key)
+        if text is not None:
+            return text
+        text = self._read(self.templates[key]) if key in self.templates else None
+        if text is None:
+            with tempfile.TemporaryDirectory(dir=tmpdir) as scratch:
+                text = get_mmcif(StringIO(self.entry(pdb_id)), pdb_id.lower(), chain_id, int(start), int(end), scratch)
+            digest = self._write(text)
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?, ?)", (*key, digest))
+            self.templates[key] = digest
+        self.template_texts[key] = text
+        return text
+
+
+@click.group()
+def cli():
+    """Persistent, content-addressed cache of PDB mmCIF entries and MMseqs2 templates."""
+
+
+@cli.command("seed")
+@click.argument("cache_dir", type=click.Path())
+@click.argument("mirror_dir", type=click.Path(exists=True))
+@click.option("--pdb-ids", type=click.Path(exists=True), default=None,
+              help="File of the PDB IDs to import (one per line); default: the whole mirror")
+def seed_command(cache_dir, mirror_dir, pdb_ids):
+    """Import entries of the local PDB mirror MIRROR_DIR into the cache, e.g. before running offline."""
+    cache = MmcifCache(cache_dir, mirror_dir, url=None)
+    if pdb_ids:
+        with open(pdb_ids) as f:
+            ids = [line.strip().lower() for line in f if line.strip()]
+    else:
+        paths = glob(os.path.join(mirror_dir, "**", "*.cif*"), recursive=True)
+        ids = sorted({os.path.basename(path).split(".")[0].lower() for path in paths})
+    missing = []
+    for pdb_id in ids:
+        if pdb_id in cache.entries:
+            continue
+        try:
+            cache.entry(pdb_id)
+        except MmcifNotAvailable:
+            missing.append(pdb_id)
+    logger.info(f"{len(cache.entries)} entries cached; {len(missing)} not in the mirror: {' '.join(missing[:20])}")
+
+
+@cli.command("stats")
+@click.argument("cache_dir", type=click.Path(exists=True))
+def stats_command(cache_dir):
+    """Report the number of cached entries and templates."""
+    conn = connect(cache_dir)
+    for table in ("entries", "templates"):
+        click.echo(f"{table}\t{conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,206 @@
+"""
+Asynchronous client of the ColabFold MMseqs2 API (``/ticket/msa``) with a local result cache.
+
+All unique sequences of a campaign are looked up in the cache first; the others are submitted
+in batched tickets over one pooled HTTP session, with a bounded number of tickets in flight and
+exponential backoff while the server rate-limits or is busy. The result of every sequence is
+stored in the cache, keyed by sequence and mode::
+
+    <cache_dir>/<ab>/<key>.a3m     # UniRef (+ environmental) A3M, as run_mmseqs returns it
+    <cache_dir>/<ab>/<key>.m8      # pdb70 template hits of the sequence
+
+The server URL is configurable (``--host-url``, or the ``MMSEQS_SERVER_URL`` environment
+variable), e.g. to use a local MMseqs2 server on an air-gapped cluster or in tests.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import random
+import tarfile
+from pathlib import Path
+from typing import Iterable, Optional
+
+import aiohttp
+import click
+from loguru import logger
+
+import a3m
+import json_io
+
+DEFAULT_HOST_URL = os.environ.get("MMSEQS_SERVER_URL", "https://a3m.mmseqs.com")
+MODES = ("env", "all", "env-nofilter", "nofilter")
+DIGEST_SIZE = 20
+FIRST_QUERY_ID = 101
+ENV_A3M = "bfd.mgnify30.metaeuk30.smag30.a3m"
+RETRY_STATUSES = {"UNKNOWN", "RATELIMIT"}
+WAIT_STATUSES = {"UNKNOWN", "RUNNING", "PENDING", "RATELIMIT"}
+
+
+class MMseqs2Error(RuntimeError):
+    pass
+
+
+def mode_of(use_env: bool = True, use_filter: bool = True) -> str:
+    """API mode of the ``use_env`` / ``use_filter`` options of ``run_mmseqs``."""
+    if use_filter:
+        return "env" if use_env else "all"
+    return "env-nofilter" if use_env else "nofilter"
+
+
+def cache_paths(cache_dir: str, sequence: str, mode: str) -> tuple:
+    key = hashlib.blake2b(f"{mode}\n{sequence}".encode(), digest_size=DIGEST_SIZE).hexdigest()
+    prefix = os.path.join(cache_dir, key[:2], key)
+    return f"{prefix}.a3m", f"{prefix}.m8"
+
+
+def read_cached(cache_dir: str, sequence: str, mode: str) -> Optional[dict]:
+    a3m_path, m8_path = cache_paths(cache_dir, sequence, mode)
+    if not (os.path.exists(a3m_path) and os.path.exists(m8_path)):
+        return None
+    return {"a3m": Path(a3m_path).read_text(), "m8": Path(m8_path).read_text().splitlines()}
+
+
+def write_cached(cache_dir: str, sequence: str, mode: str, result: dict) -> None:
+    """Store a result (the .m8 last, as it marks the entry complete)."""
+    a3m_path, m8_path = cache_paths(cache_dir, sequence, mode)
+    json_io.write_bytes(a3m_path, result["a3m"].encode())
+    json_io.write_bytes(m8_path, "".join(f"{line}\n" for line in result["m8"]).encode())
+
+
+def parse_result(tar_bytes: bytes, n_queries: int, use_env: bool) -> list:
+    """A3M and template hits of every query of a downloaded ticket result, in query order."""
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        members = {os.path.basename(member.name): member for member in tar.getmembers() if member.isfile()}
+
+        def read(name):
+            return tar.extractfile(members[name]).read() if name in members else b""
+
+        a3m_entries = {}
+        for name in ["uniref.a3m", *([ENV_A3M] if use_env else [])]:
+            for entry in a3m.iter_entries(read(name)):
+                a3m_entries.setdefault(int(entry[1:entry.index("\n")]), []).append(entry)
+        m8_lines = {}
+        for line in read("pdb70.m8").decode().splitlines():
+            if line.strip():
+                m8_lines.setdefault(int(line.split()[0]), []).append(line)
+    # Query IDs depend on the position in the ticket: every result is relabelled as the first query
+    results = []
+    for i in range(FIRST_QUERY_ID, FIRST_QUERY_ID + n_queries):
+        bodies = [entry.partition("\n")[2] for entry in a3m_entries.get(i, [])]
+        a3m_text = "".join(f">{FIRST_QUERY_ID}\n{body}" for body in bodies)
+        m8 = [f"{FIRST_QUERY_ID}\t{line.split(None, 1)[1]}" for line in m8_lines.get(i, [])]
+        results.append({"a3m": a3m_text, "m8": m8})
+    return results
+
+
+async def _request_json(session: aiohttp.ClientSession, method: str, url: str, **kwargs) -> dict:
+    async with session.request(method, url, **kwargs) as response:
+        if response.status == 429:
+            return {"status": "RATELIMIT"}
+        try:
+            return await response.json(content_type=None)
+        except ValueError:
+            logger.error(f"Server didn't reply with json: {await response.text()}")
+            return {"status": "ERROR"}
+
+
+async def run_ticket(session: aiohttp.ClientSession, host_url: str, sequences: list, mode: str,
+                     poll_interval: float = 5.0, max_backoff: float = 120.0) -> list:
+    """Submit one ticket for ``sequences``, wait for it and return the result of every sequence."""
+    query = "".join(f">{FIRST_QUERY_ID + i}\n{sequence}\n" for i, sequence in enumerate(sequences))
+    delay = poll_interval
+    while True:
+        out = await _request_json(session, "POST", f"{host_url}/ticket/msa", data={"q": query, "mode": mode})
+        if out["status"] not in RETRY_STATUSES:
+            break
+        logger.warning(f"Resubmitting {len(sequences)} sequences in {delay:.1f} s. Reason: {out['status']}")
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+        delay = min(2 * delay, max_backoff)
+    if out["status"] in ("ERROR", "MAINTENANCE"):
+        raise MMseqs2Error(f"MMseqs2 API replied {out['status']} to a ticket of {len(sequences)} sequences")
+
+    ticket, delay = out["id"], poll_interval
+    while out["status"] in WAIT_STATUSES:
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+        delay = min(1.5 * delay, max_backoff)
+        out = await _request_json(session, "GET", f"{host_url}/ticket/{ticket}")
+    if out["status"] != "COMPLETE":
+        raise MMseqs2Error(f"MMseqs2 ticket {ticket} ended with status {out['status']}")
+
+    delay = poll_interval
+    while True:
+        async with session.get(f"{host_url}/result/download/{ticket}") as response:
+            if response.status != 429:
+                response.raise_for_status()
+                tar_bytes = await response.read()
+                break
+        logger.warning(f"Downloading the result of ticket {ticket} again in {delay:.1f} s. Reason: RATELIMIT")
+        await asyncio.sleep(delay + random.uniform(0, delay / 2))
+        delay = min(2 * delay, max_backoff)
+    return parse_result(tar_bytes, len(sequences), use_env=mode.startswith("env"))
+
+
+async def fetch_msas(sequences: Iterable[str], mode: str = "env", host_url: str = DEFAULT_HOST_URL,
+                     cache_dir: Optional[str] = None, batch_size: int = 16, max_concurrency: int = 4,
+                     poll_interval: float = 5.0) -> dict:
+    """
+    Results (``{"a3m": str, "m8": [str]}``) of every unique sequence, from the cache or the server.
+
+    :param batch_size: sequences per ticket
+    :param max_concurrency: tickets (and HTTP connections) in flight
+    """
+    unique = list(dict.fromkeys(sequences))
+    results = {}
+    if cache_dir:
+        for sequence in unique:
+            cached = read_cached(cache_dir, sequence, mode)
+            if cached is not None:
+                results[sequence] = cached
+    missing = [sequence for sequence in unique if sequence not in results]
+    logger.info(f"{len(unique)} unique sequences: {len(unique) - len(missing)} cached, {len(missing)} to search")
+    if not missing:
+        return results
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def run(batch):
+            async with semaphore:
+                batch_results = await run_ticket(session, host_url.rstrip("/"), batch, mode, poll_interval)
+            for sequence, result in zip(batch, batch_results):
+                if cache_dir:
+                    write_cached(cache_dir, sequence, mode, result)
+                results[sequence] = result
+
+        await asyncio.gather(*(run(missing[i:i + batch_size]) for i in range(0, len(missing), batch_size)))
+    return results
+
+
+def fetch_msas_sync(sequences: Iterable[str], **kwargs) -> dict:
+    """:func:`fetch_msas` from synchronous code."""
+    return asyncio.run(fetch_msas(sequences, **kwargs))
+
+
+@click.command()
+@click.argument("fold_inputs", type=click.Path(exists=True), nargs=-1, required=True)
+@click.option("--cache-dir", type=click.Path(), required=True, help="Cache of MMseqs2 results")
+@click.option("--host-url", default=DEFAULT_HOST_URL, show_default=True, help="MMseqs2 server (or $MMSEQS_SERVER_URL)")
+@click.option("--mode", type=click.Choice(MODES), default="env", show_default=True)
+@click.option("--batch-size", type=int, default=16, show_default=True, help="Sequences per ticket")
+@click.option("--max-concurrency", type=int, default=4, show_default=True, help="Tickets in flight")
+@click.option("--poll-interval", type=float, default=5.0, show_default=True, help="Initial seconds between status polls")
+def main(fold_inputs, cache_dir, host_url, mode, batch_size, max_concurrency, poll_interval):
+    """
+    Search the MSAs of all unique protein sequences of the given fold input JSONs, e.g. to fill
+    the cache for a whole campaign before add_mmseqs_msa.py runs on each fold input.
+    """
+    sequences = [entry["protein"]["sequence"] for fold_input in fold_inputs
+                 for entry in json_io.load(fold_input)["sequences"] if "protein" in entry]
+    fetch_msas_sync(sequences, mode=mode, host_url=host_url, cache_dir=cache_dir, batch_size=batch_size,
+                    max_concurrency=max_concurrency, poll_interval=poll_interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Local MMseqs2 search backend of the data pipeline (``msa_backend: mmseqs_local``).
+
+The unique protein sequences of all monomer fold inputs of a campaign are searched in one
+batched ``mmseqs`` invocation, ColabFold-style, and every fold input is written out as an AF3
+data JSON (``<name>_data.json``): protein chains get the A3M of their search as ``unpairedMsa``,
+an empty ``pairedMsa`` and no templates; MSAs and templates already given in the fold input are
+kept. RNA chains get empty MSAs, mmseqs_local searches proteins only.
+
+Against a ColabFold database (``<db>``, ``<db>_seq`` and ``<db>_aln``, e.g. ``uniref30_2302_db``)
+the cluster profiles are searched iteratively, the hits expanded to the cluster members and
+realigned. Against a plain sequence database (``mmseqs createdb``, e.g. a small test database
+written by ``build-test-db``) the search results are converted to A3M directly.
+
+The search time of the batch is reported per unique sequence, apportioned by sequence length.
+"""
+import os
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Sequence
+
+import click
+import pandas as pd
+from loguru import logger
+
+import a3m
+import json_io
+
+QUERY_DESCRIPTION = "query"
+
+
+def run_mmseqs(mmseqs: str, *args) -> None:
+    cmd = [mmseqs, *map(str, args)]
+    logger.info(" ".join(cmd))
+    subprocess.run(cmd, check=True)
+
+
+def is_expandable(db: str) -> bool:
+    """Whether ``db`` is a ColabFold database (cluster profiles with member sequences and alignments)."""
+    return all(os.path.exists(f"{db}{suffix}.dbtype") for suffix in ("_seq", "_aln"))
+
+
+def search_msas(sequences: Sequence[str], db: str, work_dir: str, mmseqs: str = "mmseqs", threads: int = 1,
+                sensitivity: float = 8.0, num_iterations: int = 3) -> list:
+    """A3M of every sequence (query first, described as 'query'), from one search of all sequences."""
+    fasta = os.path.join(work_dir, "queries.fasta")
+    Path(fasta).write_text("".join(f">{i}\n{sequence}\n" for i, sequence in enumerate(sequences)))
+    qdb, res, msa, tmp = (os.path.join(work_dir, name) for name in ("qdb", "res", "msa", "tmp"))
+    threads = ["--threads", threads]
+
+    run_mmseqs(mmseqs, "createdb", fasta, qdb, "--shuffle", 0)
+    run_mmseqs(mmseqs, "search", qdb, db, res, tmp, "--num-iterations", num_iterations, "-s", sensitivity,
+               "-a", "-e", 0.1, "--max-seqs", 10000, *threads)
+    if is_expandable(db):
+        prof_res, res_exp = os.path.join(work_dir, "prof_res"), os.path.join(work_dir, "res_exp")
+        run_mmseqs(mmseqs, "mvdb", os.path.join(tmp, "latest", "profile_1"), prof_res)
+        run_mmseqs(mmseqs, "lndb", f"{qdb}_h", f"{prof_res}_h")
+        run_mmseqs(mmseqs, "expandaln", qdb, f"{db}_seq", res, f"{db}_aln", res_exp, "--expansion-mode", 0,
+                   "-e", "inf", "--expand-filter-clusters", 1, "--max-seq-id", 0.95, *threads)
+        run_mmseqs(mmseqs, "align", prof_res, f"{db}_seq", res_exp, f"{res_exp}_realign", "-e", 10,
+                   "--max-accept", 100000, "--alt-ali", 10, "-a", *threads)
+        run_mmseqs(mmseqs, "filterresult", qdb, f"{db}_seq", f"{res_exp}_realign", f"{res_exp}_realign_filter",
+                   "--qid", 0, "--qsc", 0.8, "--diff", 0, "--max-seq-id", 1.0, "--filter-min-enable", 100, *threads)
+        run_mmseqs(mmseqs, "result2msa", qdb, f"{db}_seq", f"{res_exp}_realign_filter", msa, "--msa-format-mode", 6,
+                   "--filter-msa", 1, "--filter-min-enable", 1000, "--diff", 3000, "--qid", "0.0,0.2,0.4,0.6,0.8,1.0",
+                   "--qsc", 0, "--max-seq-id", 0.95, *threads)
+    else:
+        run_mmseqs(mmseqs, "result2msa", qdb, db, res, msa, "--msa-format-mode", 6, *threads)
+    unpacked = os.path.join(work_dir, "a3m")
+    run_mmseqs(mmseqs, "unpackdb", msa, unpacked, "--unpack-name-mode", 0, "--unpack-suffix", ".a3m")
+
+    msas = []
+    for i, sequence in enumerate(sequences):
+        path = os.path.join(unpacked, f"{i}.a3m")
+        text = Path(path).read_text().replace("\x00", "") if os.path.exists(path) else ""
+        descriptions, rows = a3m.parse(text)
+        # The query is relabelled, its ID depends on its position in the batch
+        msas.append(a3m.to_text([QUERY_DESCRIPTION, *descriptions[1:]], [sequence, *rows[1:]]))
+    return msas
+
+
+def needs_msa(chain: dict) -> bool:
+    return chain.get("unpairedMsa") is None and chain.get("unpairedMsaPath") is None
+
+
+def add_msas(fold_input: dict, msas: dict) -> dict:
+    """``fold_input`` as a data JSON, with the MSAs (by sequence) of its protein chains."""
+    for entry in fold_input["sequences"]:
+        if "protein" in entry:
+            chain = entry["protein"]
+            if needs_msa(chain):
+                chain["unpairedMsa"] = msas[chain["sequence"]]
+            if chain.get("pairedMsa") is None and chain.get("pairedMsaPath") is None:
+                chain["pairedMsa"] = ""
+            if chain.get("templates") is None:
+                chain["templates"] = []
+        elif "rna" in entry and needs_msa(entry["rna"]):
+            entry["rna"]["unpairedMsa"] = ""
+    return fold_input
+
+
+@click.group()
+def cli():
+    """Local MMseqs2 search backend of the data pipeline."""
+
+
+@cli.command("search")
+@click.argument("fold_inputs", type=click.Path(exists=True), nargs=-1, required=True)
+@click.option("--db", required=True, help="MMseqs2 database (ColabFold database or plain sequence database)")
+@click.option("--output-dir", type=click.Path(), required=True, help="Writes <name>_data.json for every fold input")
+@click.option("--times", type=click.Path(), default=None, help="TSV of the search time of every unique sequence")
+@click.option("--mmseqs", default="mmseqs", show_default=True, help="MMseqs2 binary")
+@click.option("--threads", type=int, default=1, show_default=True)
+@click.option("--tmp-dir", type=click.Path(), default=None, help="Parent of the working directory (default: $TMPDIR)")
+@click.option("--sensitivity", type=float, default=8.0, show_default=True)
+@click.option("--num-iterations", type=int, default=3, show_default=True)
+def search_command(fold_inputs, db, output_dir, times, mmseqs, threads, tmp_dir, sensitivity, num_iterations):
+    """Search the MSAs of the protein chains of the monomer FOLD_INPUTS and write their data JSONs."""
+    fold_input_data = {path: json_io.load(path) for path in fold_inputs}
+    samples = {}
+    for path, data in fold_input_data.items():
+        for entry in data["sequences"]:
+            if "protein" in entry and needs_msa(entry["protein"]):
+                samples.setdefault(entry["protein"]["sequence"], []).append(Path(path).stem)
+    sequences = list(samples)
+
+    msas, seconds = {}, 0.0
+    if sequences:
+        if tmp_dir:
+            os.makedirs(tmp_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(prefix="mmseqs_local_", dir=tmp_dir) as work_dir:
+            start = time.perf_counter()
+            msas = dict(zip(sequences, search_msas(sequences, db, work_dir, mmseqs, threads, sensitivity, num_iterations)))
+            seconds = time.perf_counter() - start
+        logger.info(f"Searched {len(sequences)} unique sequences in {seconds:.1f} s "
+                    f"({seconds / len(sequences):.2f} s per sequence)")
+
+    for path, data in fold_input_data.items():
+        json_io.dump(add_msas(data, msas), os.path.join(output_dir, f"{Path(path).stem}_data.json"))
+
+    if times:
+        total_length = sum(len(sequence) for sequence in sequences) or 1
+        os.makedirs(os.path.dirname(times) or ".", exist_ok=True)
+        pd.DataFrame([
+            {"samples": ",".join(samples[sequence]), "length": len(sequence), "msa_depth": msas[sequence].count(">"),
+             "search_seconds": round(seconds * len(sequence) / total_length, 3)}
+            for sequence in sequences
+        ], columns=["samples", "length", "msa_depth", "search_seconds"]).to_csv(times, sep="\t", index=False)
+
+
+@cli.command("build-test-db")
+@click.argument("fasta", type=click.Path(exists=True))
+@click.argument("db", type=click.Path())
+@click.option("--mmseqs", default="mmseqs", show_default=True, help="MMseqs2 binary")
+def build_test_db_command(fasta, db, mmseqs):
+    """Build a plain sequence database DB from FASTA, e.g. to run mmseqs_local offline on a few targets."""
+    os.makedirs(os.path.dirname(db) or ".", exist_ok=True)
+    run_mmseqs(mmseqs, "createdb", fasta, db)
+
+
+if __name__ == "__main__":
+    cli()
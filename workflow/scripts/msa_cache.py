@@ -0,0 +1,245 @@
+"""
+Persistent, content-addressed cache of AF3 data-pipeline outputs (``<mono>_data.json``).
+
+Entries are keyed by a stable digest of everything that determines the data pipeline
+result of a monomer: entity type, sequence, MSA settings (inline, uploaded or auto),
+templates and the version of the genetic databases. Uploaded MSA and template files
+are keyed by their content, not their path.
+
+Layout of a cache directory::
+
+    <cache_dir>/index.sqlite                 # entries + hit/miss counters (each key once per campaign)
+    <cache_dir>/objects/<ab>/<key>_data.json
+
+The cache is bounded in size; least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any, Mapping, Optional
+
+import click
+from loguru import logger
+
+import json_io
+
+KEY_FIELDS = [
+    "sequence", "modifications", "unpairedMsa", "unpairedMsaPath", "pairedMsa", "pairedMsaPath", "templates"
+]
+PATH_FIELDS = {"unpairedMsaPath", "pairedMsaPath", "mmcifPath"}
+DIGEST_SIZE = 20
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _resolve_paths(value: Any) -> Any:
+    """Replace file references by the digest of their content so that keys do not depend on paths."""
+    if isinstance(value, dict):
+        return {
+            k: (f"blake2b:{file_digest(v)}" if k in PATH_FIELDS and isinstance(v, str) and os.path.isfile(v)
+                else _resolve_paths(v))
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [_resolve_paths(v) for v in value]
+    return value
+
+
+def cache_key(entity_type: str, entry: Mapping[str, Any], db_version: str = "") -> str:
+    """
+    Stable key of a monomer data-pipeline run.
+
+    :param entity_type: 'protein', 'rna', ...
+    :param entry: the sequence entry of the monomer fold input (e.g. ``json["sequences"][0]["protein"]``)
+    :param db_version: free-form version tag of the genetic databases used by the data pipeline
+    """
+    payload = {
+        "type": entity_type,
+        "db_version": db_version,
+        **{k: _resolve_paths(entry[k]) for k in KEY_FIELDS if k in entry},
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode(), digest_size=DIGEST_SIZE).hexdigest()
+
+
+def cache_key_from_fold_input(fold_input: str, db_version: str = "") -> str:
+    """Key of a single-chain fold input JSON (``rule_PREPROCESSING/monomers/<mono>.json``)."""
+    sequence = json_io.load(fold_input)["sequences"][0]
+    entity_type, entry = next(iter(sequence.items()))
+    return cache_key(entity_type, entry, db_version)
+
+
+def connect(cache_dir: str) -> sqlite3.Connection:
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+        CREATE TABLE IF NOT EXISTS lookups (
+            key TEXT NOT NULL,
+            campaign TEXT NOT NULL,
+            hit INTEGER NOT NULL,
+            PRIMARY KEY (key, campaign)
+        );
+        """
+    )
+    return conn
+
+
+def object_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, "objects", key[:2], f"{key}_data.json")
+
+
+def lookup(conn: sqlite3.Connection, cache_dir: str, key: str, campaign: str = "") -> Optional[str]:
+    """
+    Return the cached data JSON for ``key``, or None.
+
+    The hit/miss is recorded once per ``campaign`` (e.g. the output directory of a run): looking
+    the same key up again when PREPROCESSING is rerun does not count again.
+    """
+    path = object_path(cache_dir, key)
+    row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+    hit = row is not None and os.path.exists(path)
+    with conn:
+        first_lookup = conn.execute(
+            "INSERT OR IGNORE INTO lookups (key, campaign, hit) VALUES (?, ?, ?)", (key, campaign, int(hit))
+        ).rowcount == 1
+        if hit:
+            conn.execute("UPDATE entries SET last_access = ?, hits = hits + ? WHERE key = ?",
+                         (time.time(), int(first_lookup), key))
+        elif row is not None:  # object removed behind our back
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if first_lookup:
+            conn.execute("UPDATE counters SET value = value + 1 WHERE name = ?", ("hits" if hit else "misses",))
+    return path if hit else None
+
+
+def store(conn: sqlite3.Connection, cache_dir: str, key: str, data_json: str, max_bytes: Optional[int] = None) -> str:
+    """Copy ``data_json`` into the cache under ``key`` (no-op if present) and enforce the size bound."""
+    path = object_path(cache_dir, key)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(data_json, tmp_path)
+        os.replace(tmp_path, path)
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO entries (key, path, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, os.path.relpath(path, cache_dir), os.path.getsize(path), now, now),
+        )
+    if max_bytes:
+        evict(conn, cache_dir, max_bytes)
+    return path
+
+
+def evict(conn: sqlite3.Connection, cache_dir: str, max_bytes: int) -> int:
+    """Drop least recently used entries until the cache holds at most ``max_bytes``. Returns #evicted."""
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+    evicted = 0
+    for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+        if total <= max_bytes:
+            break
+        Path(object_path(cache_dir, key)).unlink(missing_ok=True)
+        with conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        total -= size
+        evicted += 1
+    if evicted:
+        logger.info(f"Evicted {evicted} entries from MSA cache {cache_dir}")
+    return evicted
+
+
+def link_into(cached: str, destination: str) -> None:
+    """
+    Materialize a cache hit at ``destination`` as a hardlink, or as a copy across filesystems
+    (a symlink would dangle once the entry is evicted).
+
+    The file is touched so that it is newer than the fold input it was derived from and
+    Snakemake does not consider it outdated.
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    try:
+        os.link(cached, destination)
+    except OSError:
+        tmp_path = f"{destination}.{os.getpid()}.tmp"
+        shutil.copyfile(cached, tmp_path)
+        os.replace(tmp_path, destination)
+    os.utime(destination)
+
+
+def stats(conn: sqlite3.Connection) -> dict:
+    counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    n_entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+    lookups = counters["hits"] + counters["misses"]
+    return {
+        "entries": n_entries,
+        "size_gb": round(size / 1e9, 3),
+        "hits": counters["hits"],
+        "misses": counters["misses"],
+        "hit_rate": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+    }
+
+
+def gb_to_bytes(max_size_gb: Optional[float]) -> Optional[int]:
+    return int(max_size_gb * 1e9) if max_size_gb else None
+
+
+@click.group()
+def cli():
+    """Persistent, content-addressed cache of AF3 data-pipeline outputs."""
+
+
+@cli.command("store")
+@click.argument("cache_dir", type=click.Path())
+@click.argument("fold_input", type=click.Path(exists=True))
+@click.argument("data_json", type=click.Path(exists=True))
+@click.option("--db-version", default="", help="Version tag of the genetic databases used by the data pipeline")
+@click.option("--max-size-gb", type=float, default=None, help="Evict least recently used entries beyond this size")
+def store_command(cache_dir, fold_input, data_json, db_version, max_size_gb):
+    """Add the data-pipeline output DATA_JSON of the monomer FOLD_INPUT to the cache."""
+    key = cache_key_from_fold_input(fold_input, db_version)
+    conn = connect(cache_dir)
+    path = store(conn, cache_dir, key, data_json, gb_to_bytes(max_size_gb))
+    logger.info(f"Cached {data_json} as {path}")
+
+
+@cli.command("evict")
+@click.argument("cache_dir", type=click.Path(exists=True))
+@click.option("--max-size-gb", type=float, required=True)
+def evict_command(cache_dir, max_size_gb):
+    """Evict least recently used entries until the cache is below --max-size-gb."""
+    evict(connect(cache_dir), cache_dir, gb_to_bytes(max_size_gb))
+
+
+@cli.command("stats")
+@click.argument("cache_dir", type=click.Path(exists=True))
+def stats_command(cache_dir):
+    """Report size, number of entries and hit rate of the cache."""
+    for name, value in stats(connect(cache_dir)).items():
+        click.echo(f"{name}\t{value}")
+
+
+if __name__ == "__main__":
+    cli()
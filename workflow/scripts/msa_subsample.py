@@ -0,0 +1,90 @@
+"""
+Depth capping of MSAs with diversity-preserving subsampling.
+
+Rows are first filtered by their coverage of the query and their identity to it, then ranked by
+greedy max-min (farthest point) selection: starting from the query, the next row is always the
+one farthest from all rows selected so far. Distances are Hamming distances between the aligned
+rows, i.e. (half) the L1 distances of their one-hot encodings, computed on the byte codes of
+the rows (a3m.encode) so that a deep MSA never needs a (rows x columns x alphabet) array.
+
+The ranking is a prefix order: the first ``k`` ranked rows are the ``k``-row subsample, so one
+ranking serves every depth (e.g. per-job depths derived from a token x depth budget).
+"""
+import functools
+from typing import Optional
+
+import click
+import numpy as np
+from loguru import logger
+
+import a3m
+
+class MaxMinRanking:
+    """Greedy max-min ranking of the rows of an MSA, extended on demand."""
+
+    def __init__(self, text: str, min_coverage: float = 0.0, min_identity: float = 0.0):
+        self.msa = a3m.parse(text)
+        codes = a3m.encode(self.msa.sequences).codes
+        self.candidates = a3m.passing_rows(codes, min_coverage, min_identity) if len(codes) else np.array([], dtype=int)
+        self.codes = codes[self.candidates]
+        self.order = [0] if len(self.candidates) else []
+        self.min_distance = (np.count_nonzero(self.codes != self.codes[0], axis=1).astype(np.int64)
+                             if len(self.candidates) else np.array([], dtype=np.int64))
+        if len(self.min_distance):
+            self.min_distance[0] = -1
+
+    @property
+    def depth(self) -> int:
+        return len(self.msa.sequences)
+
+    def top(self, k: int) -> np.ndarray:
+        """MSA row indices of the ``k`` best ranked rows (fewer if fewer rows pass the filters)."""
+        k = min(k, len(self.candidates))
+        while len(self.order) < k:
+            farthest = int(np.argmax(self.min_distance))
+            self.order.append(farthest)
+            np.minimum(self.min_distance, np.count_nonzero(self.codes != self.codes[farthest], axis=1),
+                       out=self.min_distance)
+            self.min_distance[farthest] = -1
+        return self.candidates[self.order[:k]]
+
+    def subsample(self, k: int) -> str:
+        """A3M of the ``k`` best ranked rows, in their original order (query first)."""
+        rows = np.sort(self.top(k))
+        return a3m.to_text([self.msa.descriptions[i] for i in rows], [self.msa.sequences[i] for i in rows])
+
+
+@functools.lru_cache(maxsize=8)
+def ranking(text: str, min_coverage: float = 0.0, min_identity: float = 0.0) -> MaxMinRanking:
+    """Shared :class:`MaxMinRanking` of an MSA (e.g. of a monomer reused by many multimers)."""
+    return MaxMinRanking(text, min_coverage, min_identity)
+
+
+def job_depth(n_tokens: int, max_rows: Optional[int] = None, depth_budget: Optional[int] = None) -> Optional[int]:
+    """MSA depth allowed for a job of ``n_tokens`` tokens: ``max_rows`` and/or ``depth_budget // n_tokens``."""
+    depths = [max_rows] if max_rows else []
+    if depth_budget:
+        depths.append(max(1, depth_budget // max(n_tokens, 1)))
+    return min(depths) if depths else None
+
+
+@click.command()
+@click.argument("input_a3m", type=click.Path(exists=True))
+@click.argument("output_a3m", type=click.Path())
+@click.option("--max-rows", type=int, required=True, help="Rows to keep, query included")
+@click.option("--min-coverage", type=float, default=0.0, show_default=True, help="Minimum fraction of query columns covered")
+@click.option("--min-identity", type=float, default=0.0, show_default=True, help="Minimum identity to the query")
+def main(input_a3m, output_a3m, max_rows, min_coverage, min_identity):
+    """
+    Cap the depth of an A3M file with diversity-preserving subsampling.
+    """
+    with open(input_a3m) as f:
+        msa_ranking = MaxMinRanking(f.read(), min_coverage, min_identity)
+    text = msa_ranking.subsample(max_rows)
+    with open(output_a3m, "w") as f:
+        f.write(text)
+    logger.info(f"MSA depth {msa_ranking.depth} -> {text.count('>')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Vectorized expansion of job pairs into combined multimer jobs.
+
+The chains of every job are located once (a stable sort on the job codes), after
+which any number of (job_1, job_2) pairs is expanded with index arithmetic and a
+single ``iloc`` gather. Memory use is proportional to the expanded output, so large
+campaigns are expanded chunk by chunk (``iter_*_pairs``).
+"""
+import itertools
+import string
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def chain_id_letters() -> np.ndarray:
+    """Chain IDs in AF3 order: A..Z followed by AA..ZZ."""
+    letters = list(string.ascii_uppercase)
+    letters = letters + [''.join(pair) for pair in itertools.product(letters, repeat=2)]
+    return np.array(letters, dtype=object)
+
+
+def index_jobs(jobs_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Group the rows of ``jobs_df`` by job name without copying any row data.
+
+    :return: (job_names, row_order, starts, counts) where the rows of job ``k`` are
+        ``row_order[starts[k]:starts[k] + counts[k]]`` (positional, original order kept).
+    """
+    codes, job_names = pd.factorize(jobs_df["job_name"], sort=False)
+    row_order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(job_names))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return np.asarray(job_names, dtype=object), row_order, starts, counts
+
+
+def _gather_rows(job_codes, row_order, starts, counts):
+    """Positional rows of each job in ``job_codes`` (concatenated) plus the owning pair index."""
+    lengths = counts[job_codes]
+    pair_idx = np.repeat(np.arange(len(job_codes)), lengths)
+    block_starts = np.cumsum(lengths) - lengths
+    within = np.arange(lengths.sum()) - np.repeat(block_starts, lengths)
+    rows = row_order[np.repeat(starts[job_codes], lengths) + within]
+    return rows, pair_idx
+
+
+def expand_pairs(jobs_df: pd.DataFrame, codes_1: np.ndarray, codes_2: np.ndarray, index=None) -> pd.DataFrame:
+    """
+    Build one combined job per pair ``(codes_1[i], codes_2[i])``.
+
+    The chains of the first job come first (``side='left'``), followed by the chains of
+    the second job (``side='right'``). Combined jobs are named ``<job_1>_<job_2>`` and get
+    fresh chain IDs (A, B, C, ...) unique within each combined job.
+
+    :param jobs_df: original jobs DataFrame
+    :param codes_1: job codes (positions in ``index[0]``) of the left side of every pair
+    :param codes_2: job codes of the right side of every pair
+    :param index: output of :func:`index_jobs` for ``jobs_df``; computed if not given
+    :return: combined jobs DataFrame
+    """
+    job_names, row_order, starts, counts = index_jobs(jobs_df) if index is None else index
+    codes_1 = np.asarray(codes_1, dtype=np.int64)
+    codes_2 = np.asarray(codes_2, dtype=np.int64)
+
+    left_rows, left_pair = _gather_rows(codes_1, row_order, starts, counts)
+    right_rows, right_pair = _gather_rows(codes_2, row_order, starts, counts)
+
+    # Interleave the two sides so that every pair is contiguous: left chains, then right chains
+    pair_idx = np.concatenate([left_pair, right_pair])
+    side_is_right = np.concatenate([np.zeros(len(left_rows), bool), np.ones(len(right_rows), bool)])
+    order = np.lexsort((side_is_right, pair_idx))
+    rows = np.concatenate([left_rows, right_rows])[order]
+    pair_idx = pair_idx[order]
+    side_is_right = side_is_right[order]
+
+    combined_names = (
+        pd.Series(job_names[codes_1], dtype=object) + "_" + pd.Series(job_names[codes_2], dtype=object)
+    ).to_numpy(dtype=object)
+
+    combined_jobs_df = jobs_df.iloc[rows].reset_index(drop=True)
+    combined_jobs_df["side"] = np.where(side_is_right, "right", "left")
+    combined_jobs_df["original_job_name"] = combined_jobs_df["job_name"]
+    combined_jobs_df["original_id"] = combined_jobs_df["id"]
+    combined_jobs_df["job_name"] = combined_names[pair_idx]
+
+    # Vectorized cumcount: position of each chain within its (contiguous) combined job
+    pair_lengths = counts[codes_1] + counts[codes_2]
+    pair_starts = np.cumsum(pair_lengths) - pair_lengths
+    cumcount = np.arange(len(rows)) - pair_starts[pair_idx]
+    combined_jobs_df["id"] = chain_id_letters()[cumcount]
+    return combined_jobs_df
+
+
+def all_vs_all_pairs(n_jobs: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Job code pairs in ``itertools.combinations_with_replacement`` order."""
+    return np.triu_indices(n_jobs)
+
+
+def pulldown_pairs(jobs_df: pd.DataFrame, job_names: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Job code pairs between every two ``bait_or_target`` groups (group order, then
+    ``itertools.product`` order of the jobs within the two groups).
+    """
+    code_of = pd.Index(job_names)
+    group_to_jobs = jobs_df.groupby("bait_or_target")["job_name"].unique()
+    group_codes = [code_of.get_indexer(jobs) for jobs in group_to_jobs]
+
+    codes_1, codes_2 = [], []
+    for jobs1, jobs2 in itertools.combinations(group_codes, 2):
+        codes_1.append(np.repeat(jobs1, len(jobs2)))
+        codes_2.append(np.tile(jobs2, len(jobs1)))
+    if not codes_1:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(codes_1), np.concatenate(codes_2)
+
+
+def _chunked_pairs(blocks: Iterable[Tuple[np.ndarray, np.ndarray]], chunk_size: int
+                   ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Concatenate blocks of job code pairs into chunks of at least ``chunk_size`` pairs (except the last)."""
+    codes_1, codes_2, n_pairs = [], [], 0
+    for block_1, block_2 in blocks:
+        codes_1.append(block_1)
+        codes_2.append(block_2)
+        n_pairs += len(block_1)
+        if n_pairs >= chunk_size:
+            yield np.concatenate(codes_1), np.concatenate(codes_2)
+            codes_1, codes_2, n_pairs = [], [], 0
+    if n_pairs:
+        yield np.concatenate(codes_1), np.concatenate(codes_2)
+
+
+def iter_all_vs_all_pairs(n_jobs: int, chunk_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """:func:`all_vs_all_pairs` in chunks, without materializing all pairs."""
+    blocks = ((np.full(n_jobs - i, i, dtype=np.int64), np.arange(i, n_jobs, dtype=np.int64)) for i in range(n_jobs))
+    return _chunked_pairs(blocks, chunk_size)
+
+
+def iter_pulldown_pairs(jobs_df: pd.DataFrame, job_names: np.ndarray, chunk_size: int
+                        ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """:func:`pulldown_pairs` in chunks, without materializing all pairs."""
+    code_of = pd.Index(job_names)
+    group_to_jobs = jobs_df.groupby("bait_or_target")["job_name"].unique()
+    group_codes = [code_of.get_indexer(jobs).astype(np.int64) for jobs in group_to_jobs]
+    blocks = (
+        (np.full(len(jobs2), job1, dtype=np.int64), jobs2)
+        for jobs1, jobs2 in itertools.combinations(group_codes, 2)
+        for job1 in jobs1
+    )
+    return _chunked_pairs(blocks, chunk_size)
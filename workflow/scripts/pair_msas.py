@@ -0,0 +1,138 @@
+"""
+Paired MSAs of the chains of a multimer, built on the CPU from the MSAs of its monomers.
+
+The UniProt MSAs (``pairedMsa``) of the chains of a heteromer are paired by species (see
+a3m.py): for every species with a hit in at least two chains, the best ranked hit of each chain
+(its first hit in the A3M) goes into the same row, and chains without a hit of that species get
+a gap row. Rows pairing more chains come first, then rows whose hits rank best.
+
+Results are cached by the digests of the chain MSAs and sequences (independent of the chain
+order), so that every combination of monomers is paired once, e.g. across all pairs of a
+pulldown screen::
+
+    <cache_dir>/<ab>/<key>.json.gz     # {"chains": [...], "paired": [<a3m>, ...] or null}
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Callable, Optional, Sequence
+
+import click
+import numpy as np
+from loguru import logger
+
+import a3m
+import json_io
+
+# Same digest as the MSA store of merge_mono_and_multi_jsons.py
+DIGEST_SIZE = 20
+# Paired rows AF3 keeps at most (max_paired_sequences of its featurisation)
+MAX_PAIRED_ROWS = 8191
+
+
+def msa_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=DIGEST_SIZE).hexdigest()
+
+
+def best_hits(species: np.ndarray) -> tuple:
+    """Species of an MSA (sorted) and the row of the best ranked (first) hit of each; the query row is skipped."""
+    rows = np.flatnonzero(species != "")
+    rows = rows[rows > 0]
+    unique, first = np.unique(species[rows], return_index=True)
+    return unique, rows[first]
+
+
+def pair_rows(species_per_chain: Sequence[np.ndarray], max_rows: int = MAX_PAIRED_ROWS) -> np.ndarray:
+    """
+    Rows of every chain MSA that make up the paired MSA.
+
+    :param species_per_chain: species of every row of every chain MSA (:func:`a3m.species_ids`)
+    :return: (n_paired_rows, n_chains) row indices, -1 where a chain has no hit of the species
+    """
+    hits = [best_hits(species) for species in species_per_chain]
+    all_species, n_chains_with_hit = np.unique(np.concatenate([unique for unique, _ in hits]), return_counts=True)
+    shared = all_species[n_chains_with_hit >= 2]
+    rows = np.full((len(shared), len(hits)), -1, dtype=np.int64)
+    for chain, (unique, first_rows) in enumerate(hits):
+        if len(unique) == 0:
+            continue
+        positions = np.minimum(np.searchsorted(unique, shared), len(unique) - 1)
+        found = unique[positions] == shared
+        rows[found, chain] = first_rows[positions[found]]
+    present = rows >= 0
+    depth = max(len(species) for species in species_per_chain)
+    rank = np.where(present, rows, depth).sum(axis=1)
+    return rows[np.lexsort((rank, -present.sum(axis=1)))][:max_rows]
+
+
+def pair_msas(msas: Sequence[str], query_sequences: Sequence[str], max_rows: int = MAX_PAIRED_ROWS) -> Optional[list]:
+    """
+    Paired A3M of every chain (query first), or None if no species has hits in two chains.
+
+    :param msas: UniProt A3M of every chain ('' for none)
+    :param query_sequences: sequence of every chain, for the query and the gap rows
+    """
+    parsed = [a3m.parse(msa) for msa in msas]
+    rows = pair_rows([a3m.species_ids(msa.descriptions) for msa in parsed], max_rows)
+    if len(rows) == 0:
+        return None
+    paired = []
+    for chain, (msa, query) in enumerate(zip(parsed, query_sequences)):
+        gap = "-" * len(query)
+        chain_rows = rows[:, chain].tolist()
+        descriptions = ["query", *(msa.descriptions[row] if row >= 0 else "gap" for row in chain_rows)]
+        sequences = [query, *(msa.sequences[row] if row >= 0 else gap for row in chain_rows)]
+        paired.append(a3m.to_text(descriptions, sequences))
+    return paired
+
+
+def cached_pair_msas(cache_dir: str, digests: Sequence[str], query_sequences: Sequence[str],
+                     load_msas: Callable[[], Sequence[str]]) -> Optional[list]:
+    """
+    :func:`pair_msas` through the cache in ``cache_dir``.
+
+    :param digests: :func:`msa_digest` of the MSA of every chain
+    :param load_msas: returns the MSA of every chain; only called on a cache miss
+    """
+    chain_keys = [f"{digest}:{sequence}" for digest, sequence in zip(digests, query_sequences)]
+    order = sorted(range(len(chain_keys)), key=chain_keys.__getitem__)
+    key = msa_digest("\n".join(chain_keys[i] for i in order))
+    path = os.path.join(cache_dir, key[:2], f"{key}.json.gz")
+    if os.path.exists(path):
+        paired = json_io.load(path)["paired"]
+    else:
+        msas = load_msas()
+        paired = pair_msas([msas[i] for i in order], [query_sequences[i] for i in order])
+        json_io.dump({"chains": [digests[i] for i in order], "paired": paired}, path)
+    if paired is None:
+        return None
+    return [paired[order.index(i)] for i in range(len(order))]
+
+
+@click.command()
+@click.argument("monomer_files", type=click.Path(exists=True), nargs=-1, required=True)
+@click.option("--output-dir", type=click.Path(), required=True, help="Writes <monomer>_paired.a3m for every monomer")
+@click.option("--cache-dir", type=click.Path(), default=None, help="Cache of paired MSAs")
+def main(monomer_files, output_dir, cache_dir):
+    """
+    Pair the UniProt MSAs of the (first) protein chain of the given monomer data JSONs.
+    """
+    chains = [next(iter(json_io.load(f)["sequences"][0].values())) for f in monomer_files]
+    msas = [chain.get("pairedMsa") or "" for chain in chains]
+    queries = [chain["sequence"] for chain in chains]
+    if cache_dir:
+        paired = cached_pair_msas(cache_dir, [msa_digest(msa) for msa in msas], queries, lambda: msas)
+    else:
+        paired = pair_msas(msas, queries)
+    if paired is None:
+        logger.warning("No species is shared by two chains, no paired MSA written")
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    for monomer_file, msa in zip(monomer_files, paired):
+        path = os.path.join(output_dir, f"{Path(monomer_file).name.split('_data.json')[0]}_paired.a3m")
+        Path(path).write_text(msa)
+    logger.info(f"{msa.count('>') - 1} paired rows written to {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
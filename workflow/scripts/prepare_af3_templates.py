@@ -4,10 +4,14 @@ import re
 import sys
 import json
 import gzip
+import shutil
+import hashlib
 import pickle
 import tempfile
 import traceback
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
 from pathlib import Path
 from string import ascii_uppercase, ascii_lowercase
 from argparse import ArgumentParser
@@ -22,6 +26,13 @@ from Bio.PDB import MMCIFParser, PDBParser, Superimposer
 
 ascii_upperlower = ascii_uppercase + ascii_lowercase
 
+DEFAULT_TEMPLATE_CACHE_DIR = os.path.join("tmp", "template_cache")
+# Bump when the output of prepare_template changes, so that cached results are not reused
+TEMPLATE_CACHE_VERSION = 1
+
+_FILE_DIGESTS = {}
+_TEMPLATES = {}
+
 
 def parse_args():
     parser = ArgumentParser(
@@ -544,6 +555,132 @@ def merge_json_data(new_json, old_json):
     return merged_json
 
 
+def alignment_indices(alignment):
+    """queryIndices / templateIndices of the aligned (non-gap) positions of a (template, query) alignment."""
+    query_indices, template_indices = [], []
+    query_i = temp_i = 0
+    for temp_aa, query_aa in zip(*alignment):
+        if temp_aa != "-" and query_aa != "-":
+            query_indices.append(query_i)
+            template_indices.append(temp_i)
+        if temp_aa != "-":
+            temp_i += 1
+        if query_aa != "-":
+            query_i += 1
+    return query_indices, template_indices
+
+
+def file_digest(path):
+    """blake2b of a file's content, memoized by (path, size, mtime)."""
+    stat = os.stat(path)
+    memo_key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _FILE_DIGESTS:
+        h = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _FILE_DIGESTS[memo_key] = h.hexdigest()
+    return _FILE_DIGESTS[memo_key]
+
+
+def template_task_key(template_path, template_chain, target_sequence, align_tool="blast",
+                      inpaint_clashes=False, revision_date="2100-01-01"):
+    """Key of a template preparation: the template file's content, not its path, is part of it."""
+    payload = json.dumps([TEMPLATE_CACHE_VERSION, file_digest(template_path), template_chain, str(target_sequence),
+                          align_tool, inpaint_clashes, revision_date])
+    return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+
+def _align_template(template_path, template_chain, target_sequence, out_dir, mmcif_path, align_tool,
+                    inpaint_clashes, revision_date):
+    """
+    Same as ``main`` with a FASTA target of one chain and ``--align``, without the CLI and files
+    around it: writes the template mmCIF of ``template_chain`` into ``out_dir`` and returns the
+    AF3 ``templates`` entry, whose mmcifPath is ``mmcif_path``.
+    """
+    template_model = load_PDB(template_path)
+    remove_extra_chains(template_model, [template_chain])
+    remove_hetatms(template_model)
+    if inpaint_clashes:
+        _, template_model = detect_and_remove_clashes(template_model)
+    template_sequence = get_fastaseq(template_model, template_chain)
+
+    written_path = os.path.join(out_dir, os.path.basename(mmcif_path))
+    io = MMCIFIO()
+    io.set_structure(template_model[template_chain])
+    io.save(written_path)
+    fix_mmcif(written_path, [template_chain], [template_sequence], revision_date)
+
+    template = {"mmcifPath": mmcif_path}
+    if template_chain != "-":
+        alignment = do_align(template_sequence, template_model, target_sequence, None, alignment_type=align_tool)
+        template["queryIndices"], template["templateIndices"] = alignment_indices(alignment)
+    return [template]
+
+
+def prepare_template(template_path, template_chain, target_sequence, cache_dir=DEFAULT_TEMPLATE_CACHE_DIR,
+                     align_tool="blast", inpaint_clashes=False, revision_date="2100-01-01"):
+    """
+    Align ``target_sequence`` to chain ``template_chain`` of ``template_path`` and return the AF3
+    ``templates`` entry of the target chain.
+
+    Results are memoized in the process and on disk (``<cache_dir>/<key>/``, see
+    :func:`template_task_key`), so a template is parsed and aligned once per distinct
+    (template, chain, sequence), whichever job, worker process or run asks for it.
+    """
+    key = template_task_key(template_path, template_chain, target_sequence, align_tool, inpaint_clashes,
+                            revision_date)
+    if key not in _TEMPLATES:
+        task_dir = os.path.realpath(os.path.join(cache_dir, key))
+        result_path = os.path.join(task_dir, "templates.json")
+        if not os.path.exists(result_path):
+            # Prepared in a private directory that is renamed into place, so concurrent preparations
+            # of the same key never see each other's partial files
+            os.makedirs(os.path.dirname(task_dir), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix=f"{key}.", dir=os.path.dirname(task_dir))
+            mmcif_path = os.path.join(task_dir, f"0000_{template_chain}.cif")
+            try:
+                templates = _align_template(template_path, template_chain, target_sequence, tmp_dir, mmcif_path,
+                                            align_tool, inpaint_clashes, revision_date)
+                with open(os.path.join(tmp_dir, "templates.json"), "w") as out:
+                    json.dump(templates, out)
+            except Exception:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            try:
+                os.rename(tmp_dir, task_dir)
+            except OSError:  # prepared concurrently by another process
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        with open(result_path) as f:
+            _TEMPLATES[key] = json.load(f)
+    return deepcopy(_TEMPLATES[key])
+
+
+def _prepare_template_task(task, cache_dir, align_tool):
+    try:
+        prepare_template(*task, cache_dir=cache_dir, align_tool=align_tool)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+def prepare_templates(tasks, cache_dir=DEFAULT_TEMPLATE_CACHE_DIR, align_tool="blast", workers=1):
+    """
+    Prepare the distinct ``(template_path, template_chain, target_sequence)`` tasks into the cache
+    of :func:`prepare_template`, in a pool of ``workers`` processes.
+
+    :return: the tasks that failed, with their traceback
+    """
+    tasks = sorted(set(tasks))
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(_prepare_template_task, tasks, [cache_dir] * len(tasks),
+                                       [align_tool] * len(tasks)))
+    else:
+        errors = [_prepare_template_task(task, cache_dir, align_tool) for task in tasks]
+    return {task: error for task, error in zip(tasks, errors) if error is not None}
+
+
 def main():
     args = parse_args()
     fasta_target = is_fasta(args.target[0])
@@ -677,17 +814,8 @@ def main():
                     alignment_type=args.align_tool,
                 )
 
-                templates[target_chain][0]["queryIndices"] = []
-                templates[target_chain][0]["templateIndices"] = []
-                query_i = temp_i = 0
-                for temp_aa, query_aa in zip(*alignment):
-                    if temp_aa != "-" and query_aa != "-":
-                        templates[target_chain][0]["queryIndices"].append(query_i)
-                        templates[target_chain][0]["templateIndices"].append(temp_i)
-                    if temp_aa != "-":
-                        temp_i += 1
-                    if query_aa != "-":
-                        query_i += 1
+                (templates[target_chain][0]["queryIndices"],
+                 templates[target_chain][0]["templateIndices"]) = alignment_indices(alignment)
 
     target_sequences_dict = []
     for target_chain, target_sequence in zip(target_chains, target_sequences):
@@ -1,9 +1,9 @@
 # Adapted from https://github.com/Hanziwww/AlphaFold3-GUI/blob/main/afusion/api.py
 
 import pdb
-import sys
-from collections import defaultdict
-from copy import deepcopy
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import os
 import json
@@ -11,11 +11,14 @@ import pandas as pd
 import string
 from loguru import logger
 import click
+import hashlib
 import itertools
 from pathlib import Path
 from typing import (
     Any,
+    Callable,
     Iterable,
+    Iterator,
     Mapping,
     Optional,
     Sequence,
@@ -24,12 +27,24 @@ from typing import (
     Tuple
 )
 
+import a3m
+import json_io
+import msa_cache
+import pair_expansion
 import prepare_af3_templates
+import token_estimator
 from typing import Optional
 
 import math
 
 
+# Pairs of jobs expanded (and written) at a time in the all-vs-all and pulldown modes
+PAIR_CHUNK_SIZE = 5000
+# Columns of the chain rows of stoichio-screen jobs
+STOICHIO_ROW_COLUMNS = ['job_name', 'type', 'id', 'sequence', 'modifications', 'ccd_codes', 'smiles', 'msa_option',
+                        'unpaired_msa', 'paired_msa', 'templates', 'model_seeds', 'bonded_atom_pairs', 'user_ccd']
+
+
 def slice_sequence_by_range(seq: str, roi: Optional[str], seq_type: str) -> str:
     if seq_type.lower() not in {"rna", "dna", "protein"}:
         return seq  # skip ligands and other non-sequence types
@@ -181,233 +196,377 @@ def transform_vds_to_af3(df,n_seeds=None) -> pd.DataFrame:
     return pd.DataFrame(rows)
 
 
-def transform_stoichio_screen_to_af3(df: pd.DataFrame, n_seeds: Optional[int] = None) -> Tuple[
-    pd.DataFrame, pd.DataFrame]:
-    rows = []
-    summary_data = []
+def iter_stoichiometries(
+        ranges: Sequence[Sequence[int]],
+        chain_tokens: Sequence[int],
+        is_ligand: Sequence[bool],
+        max_chains: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        max_ligand_copies: Optional[int] = None,
+) -> Iterator[Tuple[int, Tuple[int, ...]]]:
+    """
+    Lazily enumerate the stoichiometries of ``itertools.product(*ranges)`` that satisfy the budgets.
 
-    # 1. Group by parent job name
-    for parent_job, group in df.groupby('job_name'):
+    The product is walked depth-first. A subtree is pruned as soon as the counts chosen so far plus
+    the smallest counts of the remaining entities exceed ``max_chains`` or ``max_tokens``, so
+    combinations far beyond the budget are never generated.
 
-        sequences_metadata = []
-        ranges = []
-        monomer_labels = [f"monomer_{i + 1}" for i in range(len(group))]
+    :param ranges: allowed copy numbers of every entity (ascending)
+    :param chain_tokens: estimated tokens of one copy of every entity
+    :param is_ligand: whether every entity is a ligand (its copies are capped by ``max_ligand_copies``)
+    :return: iterator over ``(product index, counts)``; the index is the position of the combination in
+        the full ``itertools.product`` so that job names do not depend on the budgets
+    """
+    n = len(ranges)
+    strides = [math.prod(len(r) for r in ranges[i + 1:]) for i in range(n)]
+    ranges = [
+        [c for c in r if not (is_ligand[i] and max_ligand_copies is not None and c > max_ligand_copies)]
+        for i, r in enumerate(ranges)
+    ]
+    # Smallest number of chains/tokens the entities from position i onward can still add
+    min_chains = [0] * (n + 1)
+    min_tokens = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        smallest = min(ranges[i], default=0)
+        min_chains[i] = min_chains[i + 1] + smallest
+        min_tokens[i] = min_tokens[i + 1] + smallest * chain_tokens[i]
+    positions = [{c: k for k, c in enumerate(r)} for r in ranges]
+
+    def walk(i, combo, index, n_chains, n_tokens):
+        if i == n:
+            yield index, tuple(combo)
+            return
+        for count in ranges[i]:
+            chains = n_chains + count
+            tokens = n_tokens + count * chain_tokens[i]
+            # Ranges are ascending, so larger counts at this level cannot fit either
+            if max_chains is not None and chains + min_chains[i + 1] > max_chains:
+                break
+            if max_tokens is not None and tokens + min_tokens[i + 1] > max_tokens:
+                break
+            combo.append(count)
+            yield from walk(i + 1, combo, index + positions[i][count] * strides[i], chains, tokens)
+            combo.pop()
+
+    if all(ranges):
+        yield from walk(0, [], 0, 0, 0)
+
+
+def parse_count_range(count_val: Any) -> list[int]:
+    """Parse a stoichio-screen count (e.g. "1,5" or "1") into the list of allowed copy numbers."""
+    count_val = str(count_val)
+    if ',' in count_val:
+        start, end = map(int, count_val.split(','))
+        return list(range(start, end + 1))
+    return [int(count_val)]
+
+
+def _stoichio_entity_row(row: Mapping[str, Any], n_seeds: Optional[int]) -> dict:
+    """Chain template (everything but job name and chain ID) of one stoichio-screen entity."""
+    data_val = str(row['data'])
+    sequence = ""
+    smiles = ""
+    ccd_codes = ""
+    bonded_atom_pairs = None
+    user_ccd = None
+
+    # Handle model_seeds: n_seeds arg takes priority over df column
+    model_seeds = n_seeds
+    if model_seeds is None and pd.notna(row.get('model_seeds')):
+        model_seeds = parse_list_field(row.get('model_seeds'), data_type=int)
+    if pd.notna(row.get('bonded_atom_pairs')):
+        bonded_atom_pairs = parse_json_field(row.get('bonded_atom_pairs'))
+    if pd.notna(row.get('user_ccd')):
+        user_ccd = row.get('user_ccd')
+
+    if row['type'] in ['protein', 'dna', 'rna']:
+        sequence = data_val
+    elif row['type'] == 'ligand':
+        if any(char in data_val for char in "=#()123"):
+            smiles = data_val
+        else:
+            ccd_codes = data_val
+
+    if n_seeds is not None:
+        model_seeds = ",".join([str(i) for i in list(range(1, n_seeds + 1))])
+
+    return {
+        'type': row['type'],
+        'sequence': sequence,
+        'modifications': parse_json_field(row.get('modifications')),
+        'ccd_codes': ccd_codes,
+        'smiles': smiles,
+        'msa_option': row.get('msa_option', 'auto'),
+        'unpaired_msa': row.get('unpaired_msa'),
+        'paired_msa': row.get('paired_msa'),
+        'templates': parse_json_field(row.get('templates')),
+        'model_seeds': model_seeds,
+        'bonded_atom_pairs': bonded_atom_pairs,
+        'user_ccd': user_ccd
+    }
 
-        for _, row in group.iterrows():
-            sequences_metadata.append(row.to_dict())
-
-            # Parse count string (e.g., "1,5" or "1")
-            count_val = str(row.get('count', '1'))
-            if ',' in count_val:
-                start, end = map(int, count_val.split(','))
-                ranges.append(list(range(start, end + 1)))
-            else:
-                ranges.append([int(count_val)])
-
-        # 2. Generate Cartesian Product of all stoichiometry possibilities
-        for combo_idx, combo in enumerate(itertools.product(*ranges)):
+
+def iter_stoichio_screen_jobs(
+        df: pd.DataFrame,
+        n_seeds: Optional[int] = None,
+        max_chains: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        max_ligand_copies: Optional[int] = None,
+) -> Iterator[Tuple[dict, list[dict]]]:
+    """
+    Lazily yield ``(summary, chain rows)`` for every stoichiometry of every parent job that fits the
+    budgets. Combination ``k`` of ``itertools.product`` over the count ranges of a parent job is
+    named ``<parent_job>_c<k>``.
+    """
+    chain_ids = pair_expansion.chain_id_letters()
+    for parent_job, group in df.groupby('job_name'):
+        sequences_metadata = [row.to_dict() for _, row in group.iterrows()]
+        monomer_labels = [f"monomer_{i + 1}" for i in range(len(group))]
+        ranges = [parse_count_range(row.get('count', '1')) for row in sequences_metadata]
+        templates = [_stoichio_entity_row(row, n_seeds) for row in sequences_metadata]
+        chain_tokens = [
+            token_estimator.estimate_tokens(t['type'], t['sequence'], t['smiles'], t['ccd_codes'], t['modifications'])
+            for t in templates
+        ]
+        prefixes = []
+        for row in sequences_metadata:
+            # Fingerprint: First 10 chars
+            f_seq = str(row['data'])
+            prefixes.append((f_seq[:10] + '...') if len(f_seq) > 10 else f_seq)
+
+        for combo_idx, combo in iter_stoichiometries(
+                ranges, chain_tokens, [t['type'] == 'ligand' for t in templates],
+                max_chains=max_chains, max_tokens=max_tokens, max_ligand_copies=max_ligand_copies):
             specific_job_id = f"{parent_job}_c{combo_idx}"
+            summary = {'job_name': specific_job_id, 'parent_job': parent_job}
+            summary.update(zip(monomer_labels, combo))
+            summary.update({f"{label}_prefix": prefix for label, prefix in zip(monomer_labels, prefixes)})
+
+            # Chain IDs (A, B, C...) restart for every combination
+            chain_idx = itertools.count()
+            rows = [
+                {'job_name': specific_job_id, 'id': chain_ids[next(chain_idx)], **template}
+                for template, count in zip(templates, combo)
+                for _ in range(count)
+            ]
+            yield summary, rows
 
-            # Populate Metadata Summary
-            current_summary = {'job_name': specific_job_id, 'parent_job': parent_job}
-            for i, count in enumerate(combo):
-                label = monomer_labels[i]
-                current_summary[label] = count
-                # Fingerprint: First 10 chars
-                f_seq = str(sequences_metadata[i]['data'])
-                current_summary[f"{label}_prefix"] = (f_seq[:10] + '...') if len(f_seq) > 10 else f_seq
-            summary_data.append(current_summary)
-
-            # Reset Chain IDs (A, B, C...) for this combination
-            letters = list(string.ascii_uppercase)
-            letters = letters + [''.join(pair) for pair in itertools.product(letters, repeat=2)]
-            id_generator = iter(letters)
-
-            # 3. Expand chains based on counts using your specific logic
-            for i, count in enumerate(combo):
-                row = sequences_metadata[i]
-
-                for _ in range(count):
-                    entity_id = next(id_generator)
-
-                    # --- YOUR REQUESTED LOGIC ---
-                    data_val = str(row['data'])
-                    sequence = ""
-                    smiles = ""
-                    ccd_codes = ""
-                    bonded_atom_pairs = None
-                    user_ccd = None
-                    model_seeds = None
-                    modifications = parse_json_field(row.get('modifications'))
-                    msa_option = row.get('msa_option', 'auto')
-                    unpaired_msa = row.get('unpaired_msa')
-                    paired_msa = row.get('paired_msa')
-                    templates = parse_json_field(row.get('templates'))
-
-                    # Handle model_seeds: n_seeds arg takes priority over df column
-                    model_seeds = n_seeds
-                    if model_seeds is None and pd.notna(row.get('model_seeds')):
-                        model_seeds = parse_list_field(row.get('model_seeds'), data_type=int)
-
-                    if bonded_atom_pairs is None and pd.notna(row.get('bonded_atom_pairs')):
-                        bonded_atom_pairs = parse_json_field(row.get('bonded_atom_pairs'))
-                    if user_ccd is None and pd.notna(row.get('user_ccd')):
-                        user_ccd = row.get('user_ccd')
-
-                    if row['type'] in ['protein', 'dna', 'rna']:
-                        sequence = data_val
-                    elif row['type'] == 'ligand':
-                        if any(char in data_val for char in "=#()123"):
-                            smiles = data_val
-                        else:
-                            ccd_codes = data_val
-
-                    if n_seeds is not None:
-                        model_seeds = ",".join([str(i) for i in list(range(1, n_seeds + 1))])
-
-
-                    rows.append({
-                        'job_name': specific_job_id,
-                        'type': row['type'],
-                        'id': entity_id,
-                        'sequence': sequence,
-                        'modifications': modifications,
-                        'ccd_codes': ccd_codes,
-                        'smiles': smiles,
-                        'msa_option': msa_option,
-                        'unpaired_msa': unpaired_msa,
-                        'paired_msa': paired_msa,
-                        'templates': templates,
-                        'model_seeds': model_seeds,
-                        'bonded_atom_pairs': bonded_atom_pairs,
-                        'user_ccd': user_ccd
-                    })
-
-    df_af3 = pd.DataFrame(rows)
-    df_summary = pd.DataFrame(summary_data)
-
-    # Sort columns for the summary CSV
-    count_cols = [c for c in df_summary.columns if c.startswith('monomer_') and not c.endswith('_prefix')]
-    prefix_cols = [c for c in df_summary.columns if c.endswith('_prefix')]
-    df_summary = df_summary[['job_name', 'parent_job'] + count_cols + prefix_cols].fillna(0)
-
-    return df_af3, df_summary
-
-def create_all_vs_all_df(jobs_df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Create combined jobs with letter IDs unique within each combined job.
-
-    Parameters:
-    - jobs_df: original jobs DataFrame
-
-    Returns:
-    - combined_jobs_df: DataFrame with new combined jobs and IDs added to the original jobs DataFrame
-    """
-
-    unique_jobs = jobs_df['job_name'].unique()
-    pairs = list(itertools.combinations_with_replacement(unique_jobs, 2))
-    pairing_df = pd.DataFrame(pairs, columns=['job_name_1', 'job_name_2'])
-    letters = list(string.ascii_uppercase)
-    letters = letters + [''.join(pair) for pair in itertools.product(letters, repeat=2)]
-
-    pairs_df = pairing_df.copy()
-    pairs_df['combined_job_name'] = pairs_df['job_name_1'] + '_' + pairs_df['job_name_2']
-
-    combined_list = []
-
-    for _, row in pairs_df.iterrows():
-        job1 = row['job_name_1']
-        job2 = row['job_name_2']
-        combined_name = row['combined_job_name']
-
-        df1 = jobs_df[jobs_df['job_name'] == job1].copy()
-        df2 = jobs_df[jobs_df['job_name'] == job2].copy()
-
-        # Tag sides for tracking
-        df1['side'] = 'left'
-        df2['side'] = 'right'
-
-        # Keep original info
-        df1['original_job_name'] = df1['job_name']
-        df1['original_id'] = df1['id']
-        df2['original_job_name'] = df2['job_name']
-        df2['original_id'] = df2['id']
-
-        # Assign combined job name
-        df1['job_name'] = combined_name
-        df2['job_name'] = combined_name
 
-        # Concatenate both sides
-        combined_list.append(pd.concat([df1, df2], ignore_index=True))
+def transform_stoichio_screen_to_af3(
+        df: pd.DataFrame,
+        summary_file: str,
+        n_seeds: Optional[int] = None,
+        max_chains: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        max_ligand_copies: Optional[int] = None,
+        chunk_size: int = 10000,
+) -> Iterator[pd.DataFrame]:
+    """
+    Expand a stoichio-screen sample sheet into one job per stoichiometry that fits the budgets.
+
+    Combinations are enumerated lazily (see :func:`iter_stoichiometries`) and yielded as DataFrames
+    of ``chunk_size`` combinations, so only one chunk is held in memory; the summary CSV is
+    appended chunk by chunk.
+
+    :return: iterator over the chain rows of the kept combinations (AF3 sample sheet columns)
+    """
+    n_monomers = int(df.groupby('job_name').size().max()) if not df.empty else 0
+    count_cols = [f"monomer_{i + 1}" for i in range(n_monomers)]
+    summary_columns = ['job_name', 'parent_job'] + count_cols + [f"{c}_prefix" for c in count_cols]
+    pd.DataFrame(columns=summary_columns).to_csv(summary_file, index=False)
 
-    combined_jobs_df = pd.concat(combined_list, ignore_index=True)
+    n_combinations = 0
+    jobs = iter_stoichio_screen_jobs(df, n_seeds=n_seeds, max_chains=max_chains, max_tokens=max_tokens,
+                                     max_ligand_copies=max_ligand_copies)
+    for chunk in _batched(jobs, chunk_size):
+        summary_chunk = pd.DataFrame([summary for summary, _ in chunk], columns=summary_columns).fillna(0)
+        summary_chunk.to_csv(summary_file, mode='a', header=False, index=False)
+        n_combinations += len(chunk)
+        yield pd.DataFrame([row for _, rows in chunk for row in rows], columns=STOICHIO_ROW_COLUMNS)
 
-    # Assign new letter IDs unique within each combined job
-    combined_jobs_df['id'] = combined_jobs_df.groupby('job_name').cumcount().map(lambda x: letters[x])
-    # Create mapping
-    return combined_jobs_df
+    logger.info(f"Stoichio-screen: {n_combinations} combinations within budget written to {summary_file}")
 
 
-def create_pulldown_df(jobs_df: pd.DataFrame) -> pd.DataFrame:
+def iter_all_vs_all_dfs(jobs_df: pd.DataFrame, chunk_size: int = PAIR_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
     """
-    Create combined jobs only for pairs of jobs belonging to different groups.
+    Lazily yield the combined jobs of all pairs of jobs, ``chunk_size`` pairs at a time.
     Letter IDs are unique within each combined job.
     """
+    index = pair_expansion.index_jobs(jobs_df)
+    for codes_1, codes_2 in pair_expansion.iter_all_vs_all_pairs(len(index[0]), chunk_size):
+        yield pair_expansion.expand_pairs(jobs_df, codes_1, codes_2, index=index)
 
-    # Group jobs by group
-    group_to_jobs = jobs_df.groupby("bait_or_target")["job_name"].unique()
 
-    # Generate cross-group job pairs efficiently
-    pairs = [
-        (job1, job2)
-        for (_, jobs1), (_, jobs2)
-        in itertools.combinations(group_to_jobs.items(), 2)
-        for job1, job2 in itertools.product(jobs1, jobs2)
-    ]
+def iter_pulldown_dfs(jobs_df: pd.DataFrame, chunk_size: int = PAIR_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Lazily yield the combined jobs of pairs of jobs belonging to different groups, ``chunk_size``
+    pairs at a time. Letter IDs are unique within each combined job.
+    """
+    index = pair_expansion.index_jobs(jobs_df)
+    for codes_1, codes_2 in pair_expansion.iter_pulldown_pairs(jobs_df, index[0], chunk_size):
+        yield pair_expansion.expand_pairs(jobs_df, codes_1, codes_2, index=index)
+
+
+def iter_job_groups(df: pd.DataFrame) -> Iterator[Tuple[str, list]]:
+    """
+    Lazily yield ``(job_name, rows)`` for every job, in sorted job name order.
+
+    Only the rows of the current job are materialized as dicts, so callers can stream
+    over campaigns of any size.
+    """
+    if df.empty:
+        return
+    for job_name, positions in sorted(df.groupby("job_name").indices.items()):
+        yield job_name, df.iloc[positions].to_dict("records")
+
+
+def build_fold_inputs(
+        job_name: str,
+        rows: Sequence[Mapping[str, Any]],
+        output_dir: Union[str, Path],
+        mode: str = "custom",
+        n_seeds: Optional[int] = None,
+        is_fold_independent: Optional[bool] = False,
+        template_cache_dir: str = prepare_af3_templates.DEFAULT_TEMPLATE_CACHE_DIR,
+) -> Tuple[list[Tuple[str, str]], int]:
+    """
+    Build the fold input(s) of a single job.
+
+    :return: list of (path, compact JSON text) pairs, empty if the job is not written in this mode,
+        and the estimated number of tokens of every fold input of the job
+    """
+    entities = []
+    model_seeds = None
+    bonded_atom_pairs = None
+    user_ccd = None
+
+    for row in rows:
+        entity_type = row['type']
+        entity_id = row['id']
+        sequence = row.get('sequence', '')
 
-    pairing_df = pd.DataFrame(pairs, columns=["job_name_1", "job_name_2"])
+        # Parse optional fields
+        modifications = parse_json_field(row.get('modifications'))
+        msa_option = row.get('msa_option', 'auto')
+        unpaired_msa = row.get('unpaired_msa')
+        paired_msa = row.get('paired_msa')
 
-    # Letter pool
-    letters = list(string.ascii_uppercase)
-    letters += [''.join(p) for p in itertools.product(letters, repeat=2)]
+        templates = parse_json_field(row.get('templates'))
+
+        # Create sequence data based on entity type
+        if entity_type == 'protein':
+            sequence_data = create_protein_sequence_data(
+                sequence=sequence,
+                sequence_id=entity_id,
+                modifications=modifications,
+                msa_option=msa_option,
+                unpaired_msa=unpaired_msa,
+                paired_msa=paired_msa,
+                templates=templates,
+                template_cache_dir=template_cache_dir
+            )
+        elif entity_type == 'rna':
+            sequence_data = create_rna_sequence_data(
+                sequence=sequence,
+                modifications=modifications,
+                msa_option=msa_option,
+                unpaired_msa=unpaired_msa
+            )
+        elif entity_type == 'dna':
+            sequence_data = create_dna_sequence_data(
+                sequence=sequence,
+                modifications=modifications
+            )
+        elif entity_type == 'ligand':
+            ccd_codes = parse_list_field(row.get('ccd_codes'))
+            smiles = row.get('smiles')
+            sequence_data = create_ligand_sequence_data(
+                ccd_codes=ccd_codes,
+                smiles=smiles
+            )
+        else:
+            logger.error(f"Unknown entity type: {entity_type}")
+            continue
 
-    pairing_df["combined_job_name"] = (
-            pairing_df["job_name_1"] + "_" + pairing_df["job_name_2"]
+        entities.append({
+            'type': entity_type,
+            'id': entity_id,
+            'sequence_data': sequence_data
+        })
+
+        # Job-level parameters (assumed consistent within group)
+        if model_seeds is None and pd.notna(row.get('model_seeds')):
+            model_seeds = parse_list_field(row.get('model_seeds'), data_type=int)
+        if bonded_atom_pairs is None and pd.notna(row.get('bonded_atom_pairs')):
+            bonded_atom_pairs = parse_json_field(row.get('bonded_atom_pairs'))
+        if user_ccd is None and pd.notna(row.get('user_ccd')):
+            user_ccd = row.get('user_ccd')
+
+    if model_seeds is None:
+        model_seeds = [1]  # default seed
+    if n_seeds is not None:
+        model_seeds = list(range(1, n_seeds + 1))
+
+    # Determine monomer vs multimer
+    n_polymers = sum(row['type'] not in ("ligand", "dna") for row in rows)
+    order = "multimers" if n_polymers > 1 else "monomers"
+    if order == "monomers" and mode == "all-vs-all":
+        return [], 0
+
+    task = create_batch_task(
+        job_name=job_name,
+        entities=entities,
+        model_seeds=model_seeds,
+        bonded_atom_pairs=bonded_atom_pairs,
+        user_ccd=user_ccd
     )
+    n_tokens = token_estimator.fold_input_tokens(task)
 
-    combined_list = []
+    output_dir_ = os.path.join(output_dir + "/rule_PREPROCESSING", order)
+    if order == "monomers" and not is_fold_independent:
+        return [(os.path.join(output_dir_, f"{job_name}.json"), dump_compact_json(task))], n_tokens
 
-    for _, row in pairing_df.iterrows():
-        job1 = row["job_name_1"]
-        job2 = row["job_name_2"]
-        combined_name = row["combined_job_name"]
+    # Multimers (and independent monomers, which are folded as their own "multimer") get one file per seed
+    output_dir_ = output_dir_.replace("monomers", "multimers")
+    original_name = task["name"]
+    fold_inputs = []
+    for s in model_seeds:
+        task["modelSeeds"] = [s]
+        task["name"] = original_name + f"_seed-{s}"
+        fold_inputs.append((os.path.join(output_dir_, job_name + f"_seed-{s}.json"), dump_compact_json(task)))
+    return fold_inputs, n_tokens
 
-        df1 = jobs_df[jobs_df["job_name"] == job1].copy()
-        df2 = jobs_df[jobs_df["job_name"] == job2].copy()
 
-        df1["side"] = "left"
-        df2["side"] = "right"
+def dump_compact_json(obj: Any) -> str:
+    """Serialize without indentation or padding whitespace."""
+    return json_io.dumps(obj).decode()
 
-        df1["original_job_name"] = df1["job_name"]
-        df1["original_id"] = df1["id"]
-        df2["original_job_name"] = df2["job_name"]
-        df2["original_id"] = df2["id"]
 
-        df1["job_name"] = combined_name
-        df2["job_name"] = combined_name
+def _build_fold_input_batch(batch: Sequence[Tuple[str, list]],
+                            build_kwargs: Mapping[str, Any]) -> list[Tuple[str, list[Tuple[str, str]], int]]:
+    """Build the fold inputs of a batch of jobs: ``(job_name, [(path, text), ...], estimated tokens)``."""
+    built = []
+    for job_name, rows in batch:
+        fold_inputs, n_tokens = build_fold_inputs(job_name, rows, **build_kwargs)
+        built.append((job_name, fold_inputs, n_tokens))
+    return built
 
-        combined_list.append(pd.concat([df1, df2], ignore_index=True))
 
-    combined_jobs_df = pd.concat(combined_list, ignore_index=True)
+def _batched(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
 
-    # Assign new letter IDs unique within each combined job
-    combined_jobs_df["id"] = (
-        combined_jobs_df.groupby("job_name")
-        .cumcount()
-        .map(lambda x: letters[x])
-    )
 
-    return combined_jobs_df
+def _bounded_map(executor: Executor, fn, items: Iterable, max_pending: int) -> Iterator[Any]:
+    """Like ``executor.map`` but never submits more than ``max_pending`` items ahead of the consumer."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def write_fold_inputs(
@@ -416,125 +575,196 @@ def write_fold_inputs(
         mode: str = "custom",
         n_seeds: Optional[int] = None,
         is_fold_independent: Optional[bool] = False,
+        workers: int = 1,
+        batch_size: int = 256,
+        executor: Optional[Executor] = None,
+        manifest: Optional[dict] = None,
+        previous_manifest: Optional[Mapping] = None,
+        token_counts: Optional[dict] = None,
+        template_cache_dir: str = prepare_af3_templates.DEFAULT_TEMPLATE_CACHE_DIR,
 ) -> None:
-    grouped = df.groupby('job_name')
-    for job_name, group in grouped:
-        entities = []
-        model_seeds = None
-        bonded_atom_pairs = None
-        user_ccd = None
+    """
+    Stream the jobs of ``df`` through :func:`build_fold_inputs` and write the results.
+
+    Jobs are consumed lazily in batches of ``batch_size``. With ``workers > 1`` the batches are
+    serialized in a process pool with a bounded number of batches in flight, so peak memory
+    does not grow with the size of the campaign.
+
+    :param executor: process pool shared by the calls of a run; by default a pool of ``workers``
+        processes is started for this call
+    :param manifest: if given, the digest and fold inputs of every job are recorded in it
+        (see :func:`load_fold_input_manifest`)
+    :param previous_manifest: manifest of a previous run. Jobs whose digest did not change and
+        whose fold inputs still exist are not rewritten, so their files keep their mtimes.
+    :param token_counts: if given, the estimated number of tokens of every fold input is stored in it
+    :param template_cache_dir: cache of prepared custom templates (see :func:`set_templates`)
+    """
+    if df.empty:
+        return
+    # Downstream rules expect the monomers directory, also when every job is written as a multimer
+    os.makedirs(os.path.join(f"{output_dir}", "rule_PREPROCESSING", "monomers"), exist_ok=True)
+    call = f"{mode},{n_seeds},{int(bool(is_fold_independent))}"
+    digests = job_input_digests(df) if manifest is not None else None
+    n_unchanged = 0
+    if digests is not None and previous_manifest:
+        unchanged = []
+        for job_name, digest in digests.items():
+            known = manifest.get((job_name, call)) or previous_manifest.get((job_name, call))
+            if known is not None and known[0] == digest and all(os.path.exists(f) for f in known[1]):
+                manifest[(job_name, call)] = known
+                unchanged.append(job_name)
+                if token_counts is not None:
+                    token_counts.update(dict.fromkeys(known[1], known[2]))
+        n_unchanged = len(unchanged)
+        df = df[~df["job_name"].isin(unchanged)]
+
+    batches = _batched(iter_job_groups(df), batch_size)
+    build = partial(
+        _build_fold_input_batch,
+        build_kwargs=dict(output_dir=output_dir, mode=mode, n_seeds=n_seeds, is_fold_independent=is_fold_independent,
+                          template_cache_dir=template_cache_dir),
+    )
 
-        for _, row in group.iterrows():
-            entity_type = row['type']
-            entity_id = row['id']
-            sequence = row.get('sequence', '')
-
-            # Parse optional fields
-            modifications = parse_json_field(row.get('modifications'))
-            msa_option = row.get('msa_option', 'auto')
-            unpaired_msa = row.get('unpaired_msa')
-            paired_msa = row.get('paired_msa')
-
-            templates = parse_json_field(row.get('templates'))
-
-            # Create sequence data based on entity type
-            if entity_type == 'protein':
-                sequence_data = create_protein_sequence_data(
-                    sequence=sequence,
-                    sequence_id=entity_id,
-                    modifications=modifications,
-                    msa_option=msa_option,
-                    unpaired_msa=unpaired_msa,
-                    paired_msa=paired_msa,
-                    templates=templates
-                )
-            elif entity_type == 'rna':
-                sequence_data = create_rna_sequence_data(
-                    sequence=sequence,
-                    modifications=modifications,
-                    msa_option=msa_option,
-                    unpaired_msa=unpaired_msa
-                )
-            elif entity_type == 'dna':
-                sequence_data = create_dna_sequence_data(
-                    sequence=sequence,
-                    modifications=modifications
-                )
-            elif entity_type == 'ligand':
-                ccd_codes = parse_list_field(row.get('ccd_codes'))
-                smiles = row.get('smiles')
-                sequence_data = create_ligand_sequence_data(
-                    ccd_codes=ccd_codes,
-                    smiles=smiles
-                )
-            else:
-                logger.error(f"Unknown entity type: {entity_type}")
-                continue
+    created_dirs = set()
+    n_files = 0
+
+    def write_batch(job_fold_inputs):
+        nonlocal n_files
+        for job_name, fold_inputs, n_tokens in job_fold_inputs:
+            for fold_input, text in fold_inputs:
+                fold_input_dir = os.path.dirname(fold_input)
+                if fold_input_dir not in created_dirs:
+                    os.makedirs(fold_input_dir, exist_ok=True)
+                    created_dirs.add(fold_input_dir)
+                with open(fold_input, "w") as f:
+                    f.write(text)
+            n_files += len(fold_inputs)
+            if digests is not None:
+                manifest[(job_name, call)] = (digests[job_name], [fold_input for fold_input, _ in fold_inputs], n_tokens)
+            if token_counts is not None:
+                token_counts.update((fold_input, n_tokens) for fold_input, _ in fold_inputs)
+
+    own_executor = executor is None and workers > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        if executor is not None:
+            for job_fold_inputs in _bounded_map(executor, build, batches, max_pending=2 * workers):
+                write_batch(job_fold_inputs)
+                logger.debug(f"Wrote {n_files} fold inputs so far")
+        else:
+            for batch in batches:
+                write_batch(build(batch))
+    finally:
+        if own_executor:
+            executor.shutdown()
 
-            entities.append({
-                'type': entity_type,
-                'id': entity_id,
-                'sequence_data': sequence_data
-            })
-
-            # Job-level parameters (assumed consistent within group)
-            if model_seeds is None and pd.notna(row.get('model_seeds')):
-                model_seeds = parse_list_field(row.get('model_seeds'), data_type=int)
-            if bonded_atom_pairs is None and pd.notna(row.get('bonded_atom_pairs')):
-                bonded_atom_pairs = parse_json_field(row.get('bonded_atom_pairs'))
-            if user_ccd is None and pd.notna(row.get('user_ccd')):
-                user_ccd = row.get('user_ccd')
-
-        if model_seeds is None:
-            model_seeds = [1]  # default seed
-        if n_seeds is not None:
-            model_seeds = list(range(1, n_seeds + 1))
-
-        task = create_batch_task(
-            job_name=job_name,
-            entities=entities,
-            model_seeds=model_seeds,
-            bonded_atom_pairs=bonded_atom_pairs,
-            user_ccd=user_ccd
-        )
-
-        # Determine monomer vs multimer
-        group_types = group.groupby("type").size()
-        n_polymers = group_types.drop(labels=["ligand", "dna"], errors="ignore").sum()
-        order = "multimers" if n_polymers > 1 else "monomers"
-        if order == "monomers" and mode == "all-vs-all":
-            continue
+    n_jobs = df["job_name"].nunique() if not df.empty else 0
+    logger.info(f"Wrote {n_files} fold inputs for {n_jobs} jobs to {output_dir}/rule_PREPROCESSING"
+                + (f" ({n_unchanged} unchanged jobs skipped)" if n_unchanged else ""))
 
-        output_dir_ = os.path.join(output_dir + "/rule_PREPROCESSING", order)
-        os.makedirs(output_dir_, exist_ok=True)
-
-        if order == "multimers" or is_fold_independent:
-            original_name = task["name"]  # Save original once
-            for s in model_seeds:
-                bname = job_name + f"_seed-{s}.json" if not is_fold_independent else job_name + f"_seed-{s}_chain-{entity_id.lower()}.json"
-                fold_input = os.path.join(output_dir_, bname)
-                task["modelSeeds"] = [s]
-                task["name"] = original_name + f"_seed-{s}"  if not is_fold_independent else original_name + f"_seed-{s}_chain-{entity_id.lower()}" # Set from original, not append
-                if not is_fold_independent:
-                    with open(fold_input, "w") as f:
-                        json.dump(task, f, indent=4)
-                else:
-                    output_dir_ = output_dir_.replace("monomers","multimers")
-                    if not os.path.exists(output_dir_):
-                        os.makedirs(output_dir_, exist_ok=True)
-                    bname = job_name + f"_seed-{s}.json"
-                    fold_input = os.path.join(output_dir_, bname)
-                    task["modelSeeds"] = [s]
-                    task["name"] = original_name + f"_seed-{s}"
-                    with open(fold_input, "w") as f:
-                        json.dump(task, f, indent=4)
 
+def load_fold_input_manifest(path: str) -> dict:
+    """
+    Read a fold input manifest: ``{(job_name, call): (digest, [fold_input, ...], n_tokens)}``, where
+    ``call`` identifies the :func:`write_fold_inputs` parameters the job was written with.
+    """
+    if not os.path.exists(path):
+        return {}
+    manifest_df = pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False)
+    if "n_tokens" not in manifest_df.columns:  # manifests written before token estimates
+        return {}
+    return {
+        (row.job_name, row.call): (row.digest, [f for f in row.fold_inputs.split(",") if f], int(row.n_tokens))
+        for row in manifest_df.itertuples(index=False)
+    }
 
 
-        else:
-            fold_input = os.path.join(output_dir_, f"{job_name}.json")
-            with open(fold_input, "w") as f:
-                json.dump(task, f, indent=4)
+def save_fold_input_manifest(path: str, manifest: Mapping) -> None:
+    """Write ``manifest``, keeping only fold inputs that still exist."""
+    records = [
+        {"job_name": job_name, "call": call, "digest": digest,
+         "fold_inputs": ",".join(f for f in fold_inputs if os.path.exists(f)), "n_tokens": n_tokens}
+        for (job_name, call), (digest, fold_inputs, n_tokens) in sorted(manifest.items())
+    ]
+    pd.DataFrame(records, columns=["job_name", "call", "digest", "fold_inputs", "n_tokens"]).to_csv(
+        path, sep="\t", index=False)
+
+
+def fold_input_names(directory: str) -> list[str]:
+    """Stems of the fold input JSONs in ``directory`` (empty if it does not exist)."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(entry.name[:-len(".json")] for entry in os.scandir(directory)
+                  if entry.is_file() and entry.name.endswith(".json"))
+
+
+def write_preprocessing_manifest(path: str, output_dir: str, multimer_to_monomer_df: pd.DataFrame,
+                                 job_tokens_df: pd.DataFrame, inference_batches_df: Optional[pd.DataFrame] = None,
+                                 msa_cache_df: Optional[pd.DataFrame] = None,
+                                 merge_chunks_df: Optional[pd.DataFrame] = None) -> dict:
+    """
+    Write everything the Snakefile needs from PREPROCESSING to one compact JSON, so that it is read
+    once per checkpoint instead of globbing the fold input directories and re-reading the metadata
+    tables in every input function.
+
+    Keys: ``multimers`` and ``monomers`` (fold input stems), ``chains`` (multimer -> {chain id: monomer
+    data JSON}), ``tokens`` and ``seeds`` (per fold input), ``batches`` (batch id -> bucket and multimers),
+    ``merge_chunks`` (chunk id -> multimers) and ``msa_cache_misses`` and ``msa_cache_hits`` (monomers to
+    store in, and linked from, the MSA cache).
+    """
+    chains = {}
+    for sample_id, chain_id, monomer_file in multimer_to_monomer_df[
+            ["sample_id", "monomer_chain_id", "monomer_file"]].itertuples(index=False):
+        chains.setdefault(sample_id, {})[str(chain_id)] = monomer_file
+    preprocessing_manifest = {
+        "multimers": fold_input_names(os.path.join(output_dir, "rule_PREPROCESSING", "multimers")),
+        "monomers": fold_input_names(os.path.join(output_dir, "rule_PREPROCESSING", "monomers")),
+        "chains": chains,
+        "tokens": {sample_id: int(n) for sample_id, n in zip(job_tokens_df.sample_id, job_tokens_df.n_tokens)},
+        "seeds": {sample_id: int(n) for sample_id, n in zip(job_tokens_df.sample_id, job_tokens_df.n_seeds) if n != 1},
+        "batches": ({batch_id: {"bucket": int(rows.bucket.max()), "samples": rows.sample_id.tolist()}
+                     for batch_id, rows in inference_batches_df.groupby("batch_id", sort=False)}
+                    if inference_batches_df is not None else {}),
+        "merge_chunks": ({chunk_id: rows.sample_id.tolist()
+                          for chunk_id, rows in merge_chunks_df.groupby("chunk_id", sort=False)}
+                         if merge_chunks_df is not None else {}),
+        "msa_cache_misses": (msa_cache_df.loc[~msa_cache_df.cache_hit, "sample_id"].tolist()
+                             if msa_cache_df is not None else []),
+        "msa_cache_hits": (msa_cache_df.loc[msa_cache_df.cache_hit, "sample_id"].tolist()
+                           if msa_cache_df is not None else []),
+    }
+    json_io.dump(preprocessing_manifest, path)
+    return preprocessing_manifest
+
+
+def remove_stale_fold_inputs(output_dir: str, previous_manifest: Mapping, manifest: Mapping,
+                             log_file: str) -> pd.DataFrame:
+    """
+    Delete fold inputs that no current job produces (e.g. jobs removed from the sample sheet)
+    and report them, together with the jobs they belonged to, in ``log_file``.
+    """
+    current = {os.path.normpath(f) for _, fold_inputs, _ in manifest.values() for f in fold_inputs}
+    owner = {os.path.normpath(f): job_name
+             for (job_name, _), (_, fold_inputs, _) in previous_manifest.items() for f in fold_inputs}
+    records = []
+    for order in ["monomers", "multimers"]:
+        fold_input_dir = os.path.join(output_dir, "rule_PREPROCESSING", order)
+        if not os.path.isdir(fold_input_dir):
+            continue
+        for name in sorted(os.listdir(fold_input_dir)):
+            fold_input = os.path.normpath(os.path.join(fold_input_dir, name))
+            if name.endswith(".json") and fold_input not in current:
+                Path(fold_input).unlink()
+                records.append({"job_name": owner.get(fold_input, ""), "fold_input": fold_input})
+
+    removed_df = pd.DataFrame(records, columns=["job_name", "fold_input"])
+    removed_df.to_csv(log_file, sep="\t", index=False)
+    removed_jobs = {job_name for job_name, _ in previous_manifest} - {job_name for job_name, _ in manifest}
+    if removed_jobs or not removed_df.empty:
+        logger.info(f"{len(removed_jobs)} jobs are no longer in the sample sheet; "
+                    f"removed {len(removed_df)} stale fold inputs (see {log_file})")
+    return removed_df
 
 
 def extract_multimer_jobs(
@@ -618,6 +848,98 @@ def extract_monomer_jobs(
     return monomers.reset_index(drop=True)
 
 
+# Columns of the rows that map every chain of a multimer to the data JSON of its monomer
+MULTIMER_TO_MONOMER_COLUMNS = ["fold_input_x", "model_seeds", "id_y", "fold_input_mono", "monomer_key"]
+
+
+def multimer_to_monomer_rows(multimer_df: pd.DataFrame, monomer_df: pd.DataFrame, output_dir: str,
+                             optional_columns: Sequence[str] = ()) -> pd.DataFrame:
+    """
+    Map the chains of the multimers (:func:`extract_multimer_jobs`) to the data JSONs of their monomers
+    (:func:`extract_monomer_jobs`). Monomers with the same sequence and optional columns (MSAs,
+    templates) get the same ``monomer_key``, so that the rows can be written out without the sequences.
+
+    :return: rows with the columns :data:`MULTIMER_TO_MONOMER_COLUMNS`
+    """
+    rows = pd.merge(
+        multimer_df[["job_name", "id", "fold_input", "model_seeds"]],
+        monomer_df[["job_name", "id", "sequence", *optional_columns, "fold_input", "original_job_name", "original_id"]],
+        left_on="job_name",
+        right_on="original_job_name",
+        how="right",
+    )
+    rows["fold_input_mono"] = output_dir + "/rule_AF3_DATA_PIPELINE/" + rows.job_name_y + "_data.json"
+    key_columns = rows[["sequence", *optional_columns]].fillna("not_specified").astype(str)
+    rows["monomer_key"] = [hashlib.blake2b("\x1f".join(values).encode(), digest_size=16).hexdigest()
+                           for values in key_columns.itertuples(index=False)]
+    return rows[MULTIMER_TO_MONOMER_COLUMNS]
+
+
+def append_multimer_to_monomer_rows(rows: pd.DataFrame, path: str) -> None:
+    rows.to_csv(path, sep="\t", index=False, mode="a", header=not os.path.exists(path))
+
+
+def read_multimer_to_monomer_map(path: str, chunk_size: int = 100_000) -> Tuple[dict, dict]:
+    """
+    Stream the rows of :func:`multimer_to_monomer_rows` back from ``path``. Every chain is mapped to
+    the canonical data JSON (first by name) of the monomers that share its ``monomer_key``.
+
+    :return: ``{multimer fold input: {chain id: monomer data JSON}}`` and the model seeds of every
+        multimer fold input and monomer data JSON
+    """
+    chains, model_seeds, monomer_model_seeds = {}, {}, {}
+    canonical, key_of = {}, {}
+    if os.path.exists(path):
+        for rows in pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False, na_values=[""],
+                                chunksize=chunk_size):
+            for multimer, seeds, chain_id, monomer, key in rows[MULTIMER_TO_MONOMER_COLUMNS].itertuples(index=False):
+                key_of[monomer] = key
+                if key not in canonical or monomer < canonical[key]:
+                    canonical[key] = monomer
+                monomer_model_seeds[monomer] = seeds
+                if isinstance(multimer, str):
+                    chains.setdefault(multimer, {})[chain_id] = monomer
+                    model_seeds[multimer] = seeds
+    model_seeds.update(monomer_model_seeds)
+    inference_to_data_pipeline_map = {
+        multimer: {chain_id: canonical[key_of[monomer]] for chain_id, monomer in chain_monomers.items()}
+        for multimer, chain_monomers in chains.items()
+    }
+    return inference_to_data_pipeline_map, model_seeds
+
+
+def write_combined_jobs(
+        chunks: Iterable[pd.DataFrame],
+        output_dir: Union[str, Path],
+        map_rows_path: str,
+        optional_columns: Sequence[str] = (),
+        n_seeds: Optional[int] = None,
+        workers: int = 1,
+        **write_kwargs,
+) -> int:
+    """
+    Write the fold inputs of every chunk of combined (multimer) jobs, and of their monomers, as
+    soon as the chunk is produced, so that the combined jobs are never all held in memory. The
+    rows mapping their chains to monomers (:func:`multimer_to_monomer_rows`) are appended to
+    ``map_rows_path`` chunk by chunk.
+
+    :param optional_columns: optional sample sheet columns (MSAs, templates) that distinguish monomers
+    :return: number of multimer chains written
+    """
+    n_chains = 0
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        write_fold_inputs(chunk, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
+        multimer_chunk = extract_multimer_jobs(chunk, output_dir, n_seeds=n_seeds)
+        monomer_chunk = extract_monomer_jobs(multimer_chunk, output_dir, has_multimers=True)
+        write_fold_inputs(monomer_chunk, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
+        append_multimer_to_monomer_rows(
+            multimer_to_monomer_rows(multimer_chunk, monomer_chunk, output_dir, optional_columns), map_rows_path)
+        n_chains += len(multimer_chunk)
+    return n_chains
+
+
 def create_batch_task(
         job_name: str,
         entities: Sequence[Mapping[str, Any]],
@@ -680,7 +1002,7 @@ def create_batch_task(
     if user_ccd:
         alphafold_input["userCCD"] = user_ccd
 
-    logger.info(f"Created task for job: {job_name}")
+    logger.debug(f"Created task for job: {job_name}")
 
     return alphafold_input
 
@@ -730,6 +1052,7 @@ def create_protein_sequence_data(
         unpaired_msa: Optional[str] = None,
         paired_msa: Optional[str] = None,
         templates: Optional[str] = None,
+        template_cache_dir: str = prepare_af3_templates.DEFAULT_TEMPLATE_CACHE_DIR,
 ) -> dict[str, Any]:
     """
     Creates sequence data for a protein entity.
@@ -745,7 +1068,10 @@ def create_protein_sequence_data(
     :param paired_msa: Paired MSA (if msa_option is 'upload').
     :type paired_msa: str, optional
     :param templates: Optional list of template dicts. Use [] for template-free, None/null for auto template search.
+        A "path,chain" string is aligned to the sequence (see :func:`set_templates`).
     :type templates: list of dict, optional
+    :param template_cache_dir: Cache of prepared custom templates.
+    :type template_cache_dir: str
     :return: Sequence data dictionary.
     :rtype: dict
     """
@@ -770,14 +1096,14 @@ def create_protein_sequence_data(
         # - [] for template-free with auto MSA
         protein_entry["unpairedMsa"] = None
         protein_entry["pairedMsa"] = None
-        protein_entry = set_templates(protein_entry, templates)
+        protein_entry = set_templates(protein_entry, templates, template_cache_dir)
 
     elif msa_option == 'none':
         # Both MSAs set to empty string - completely MSA-free
         protein_entry["unpairedMsa"] = ""
         protein_entry["pairedMsa"] = ""
         # Templates defaults to [] if not provided (template-free)
-        protein_entry = set_templates(protein_entry, templates)
+        protein_entry = set_templates(protein_entry, templates, template_cache_dir)
 
 
     elif msa_option == 'upload':
@@ -787,11 +1113,15 @@ def create_protein_sequence_data(
         protein_entry["unpairedMsaPath"] =     "" if pd.isna(unpaired_msa) else unpaired_msa #unpaired_msa if unpaired_msa is not None else ""
         protein_entry["pairedMsaPath"] =     "" if pd.isna(paired_msa) else paired_msa  #paired_msa if paired_msa is not None else ""
         protein_entry["pairedMsa"] =     "" if pd.isna(paired_msa) else paired_msa  #paired_msa if paired_msa is not None else ""
+        # Stockholm MSAs (e.g. jackhmmer outputs) are converted to A3M and inlined
+        if not pd.isna(unpaired_msa) and a3m.is_stockholm(unpaired_msa):
+            del protein_entry["unpairedMsaPath"]
+            protein_entry["unpairedMsa"] = a3m.to_text(*a3m.read(unpaired_msa))
         # Templates can be:
         # - Unset (null) to let AF3 search for templates using the provided MSA
         # - [] for template-free with custom MSA
         # - List of template dicts for custom templates
-        protein_entry = set_templates(protein_entry, templates)
+        protein_entry = set_templates(protein_entry, templates, template_cache_dir)
 
     else:
         logger.error(f"Invalid msa_option: {msa_option}")
@@ -816,39 +1146,34 @@ def is_template_path(value):
         and not is_json_like(value)
     )
 
-def set_templates(protein_entry: dict[str, str], templates: str | None, extra_align_flags: str  = "") -> dict[str, Any]:
+def set_templates(protein_entry: dict[str, str], templates: str | None,
+                  cache_dir: str = prepare_af3_templates.DEFAULT_TEMPLATE_CACHE_DIR,
+                  align_tool: str = "blast") -> dict[str, Any]:
+    """
+    Set the templates of a protein entry. A "path,chain" template is aligned to the entry's
+    sequence in-process; results are memoized, see :func:`prepare_af3_templates.prepare_template`.
+    """
     if templates is None:
         protein_entry["templates"] = None
     elif templates == []:
         protein_entry["templates"] = []
     else:
         if is_template_path(templates):
-            template_path=templates.split(",")[0]
-            template_chain=templates.split(",")[1]
-            protein_entry_ = deepcopy(protein_entry)
-            with open("temp.fasta","w") as temp:
-                temp.write(">"+protein_entry_["id"]+"\n"+protein_entry_["sequence"]+"\n")
-            #
-            sys.argv = [
-                "prepare_templates_af3.py",
-                "--target", "temp.fasta",
-                "--template", template_path,
-                "--target_chains", protein_entry_["id"],
-                "--template_chains", template_chain,
-                "--align",
-                "--output_dir", "tmp", "--noinpaint_clashes",
-                *extra_align_flags.split()
-            ]
-            # python /app/alphafold/prepare_templates_af3.py --target ns5_tom.fasta --template input/modeller_models/5qj0_A_natan.pdb --target_chains A --template_chains A --output_dir test_del --align --noinpaint_clashes
-            protein_entry_ = prepare_af3_templates.main()
-            #run_custom_template(protein_entry_,protein_entry_["id"], template_path,template_chain,output_json=None,to_file=False)
-            protein_entry["templates"] = protein_entry_["sequences"][0]["protein"]["templates"]
-#            protein_entry["templates"] = af3_json =
-            #print(af3_json["name"])
+            template_path, template_chain = templates.split(",")[:2]
+            protein_entry["templates"] = prepare_af3_templates.prepare_template(
+                template_path, template_chain, protein_entry["sequence"], cache_dir=cache_dir, align_tool=align_tool)
         else:
             protein_entry["templates"] = templates
     return protein_entry
 
+
+def template_tasks(df: pd.DataFrame) -> set[Tuple[str, str, str]]:
+    """Distinct (template path, template chain, target sequence) of the "path,chain" templates of protein rows."""
+    if "templates" not in df.columns:
+        return set()
+    rows = df.loc[(df["type"] == "protein") & df["templates"].map(is_template_path), ["templates", "sequence"]]
+    return {(*templates.split(",")[:2], sequence) for templates, sequence in rows.drop_duplicates().itertuples(index=False)}
+
 def create_dna_sequence_data(sequence, modifications=None):
     """
     Creates sequence data for a DNA entity.
@@ -939,33 +1264,107 @@ def parse_list_field(value, data_type=str):
     return [data_type(item.strip()) for item in value.split(',') if item.strip()]
 
 
-def remove_duplicate_jobs_scalable(df, cols_to_compare, log_file=f'duplicate_jobs_summary.json'):
+def job_signatures(df: pd.DataFrame, cols_to_compare, chain_id_col: str = "id") -> pd.Series:
+    """
+    Stable, chain-permutation-invariant signature of every job.
+
+    Each row is hashed column-wise over ``cols_to_compare`` (chain IDs excluded), the row hashes
+    of a job are sorted and digested with blake2b. Two jobs therefore share a signature iff they
+    contain the same multiset of chains, regardless of chain order or chain IDs. Chain IDs are
+    only part of a row when the row carries ``bonded_atom_pairs``, which refer to them.
+
+    :param df: jobs DataFrame
+    :param cols_to_compare: columns describing a chain
+    :param chain_id_col: column holding the chain IDs referenced by ``bonded_atom_pairs``
+    :return: hex digests indexed by job name (sorted)
+    """
+    cols = [c for c in cols_to_compare if c in df.columns and c not in ("job_name", "id", chain_id_col)]
+    rows = df[cols].astype(str)
+    if "bonded_atom_pairs" in df.columns and chain_id_col in df.columns:
+        bonded = df["bonded_atom_pairs"].notna() & df["bonded_atom_pairs"].astype(str).str.strip().ne("")
+        rows["__chain_id"] = df[chain_id_col].astype(str).where(bonded, "")
+    row_hash = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+    return _digest_jobs(df["job_name"], row_hash, permutation_invariant=True)
+
+
+def job_input_digests(df: pd.DataFrame) -> pd.Series:
+    """
+    Digest of all columns of every job, in row order. Unlike :func:`job_signatures` this changes
+    whenever anything that ends up in the job's fold inputs changes, including chain IDs and order.
+
+    :return: hex digests indexed by job name (sorted)
+    """
+    row_hash = pd.util.hash_pandas_object(df.astype(str), index=False).to_numpy()
+    return _digest_jobs(df["job_name"], row_hash, permutation_invariant=False)
+
+
+def _digest_jobs(job_name: pd.Series, row_hash: np.ndarray, permutation_invariant: bool) -> pd.Series:
+    """blake2b of the row hashes of every job (sorted first if ``permutation_invariant``)."""
+    codes, job_names = pd.factorize(job_name, sort=True)
+    order = np.lexsort((row_hash, codes)) if permutation_invariant else np.argsort(codes, kind="stable")
+    buffer = memoryview(np.ascontiguousarray(row_hash[order], dtype="<u8").tobytes())
+    ends = np.cumsum(np.bincount(codes, minlength=len(job_names))) * 8
+    starts = np.concatenate([[0], ends[:-1]])
+    digests = [hashlib.blake2b(buffer[start:end], digest_size=16).hexdigest() for start, end in zip(starts, ends)]
+    return pd.Series(digests, index=pd.Index(job_names, name="job_name"))
+
+
+def remove_duplicate_jobs_scalable(df, cols_to_compare, log_file=f'duplicate_jobs_summary.json', chain_id_col="id"):
     """
     Scalable approach for thousands of duplicates.
     Logs summary statistics instead of all duplicate pairs.
 
+    Jobs are compared with :func:`job_signatures`, so jobs that only differ in the order or
+    the IDs of their chains are duplicates. The first job (by name) of every group is kept.
+
     :param df: Input dataframe
     :param cols_to_compare: Columns to use for comparison
     :param log_file: Path to write summary (JSON format)
+    :param chain_id_col: Column holding the chain IDs referenced by ``bonded_atom_pairs``
     :return: Deduplicated dataframe
     """
 
     # Create signatures for each job
-    job_sigs = df.groupby('job_name').apply(
-        lambda x: hash(x[cols_to_compare]
-                       .sort_values(by=['type', 'id', 'sequence'])
-                       .reset_index(drop=True)
-                       .to_json(orient='records'))
-    )
+    job_sigs = job_signatures(df, cols_to_compare, chain_id_col=chain_id_col)
 
     # Group jobs by signature (O(n) memory)
     sig_to_jobs = defaultdict(list)
     for job_name, signature in job_sigs.items():
         sig_to_jobs[signature].append(job_name)
+    log_duplicate_summary(sig_to_jobs, log_file)
 
+    # Return deduplicated dataframe
+    unique_job_names = [jobs[0] for jobs in sig_to_jobs.values()]
+    return df[df['job_name'].isin(unique_job_names)]
+
+
+def iter_deduplicated_jobs(make_chunks: Callable[[], Iterable[pd.DataFrame]], cols_to_compare,
+                           log_file=f'duplicate_jobs_summary.json', chain_id_col="id") -> Iterator[pd.DataFrame]:
+    """
+    :func:`remove_duplicate_jobs_scalable` over the jobs of the chunks of ``make_chunks()``, holding
+    one chunk at a time.
+
+    The chunks are generated twice: the first pass collects the job signatures, the second yields
+    the kept jobs of every chunk. As in :func:`remove_duplicate_jobs_scalable`, the first job (by
+    name) of every group is kept.
+    """
+    sig_to_jobs = defaultdict(list)
+    for chunk in make_chunks():
+        for job_name, signature in job_signatures(chunk, cols_to_compare, chain_id_col=chain_id_col).items():
+            sig_to_jobs[signature].append(job_name)
+    sig_to_jobs = dict(sorted(((sig, sorted(jobs)) for sig, jobs in sig_to_jobs.items()), key=lambda item: item[1][0]))
+    log_duplicate_summary(sig_to_jobs, log_file)
+
+    kept = {jobs[0] for jobs in sig_to_jobs.values()}
+    for chunk in make_chunks():
+        yield chunk[chunk["job_name"].isin(kept)].reset_index(drop=True)
+
+
+def log_duplicate_summary(sig_to_jobs: Mapping[str, list], log_file: str) -> None:
+    """Log and save (JSON) the summary of the duplicate groups of :func:`remove_duplicate_jobs_scalable`."""
     # Calculate statistics
     duplicate_groups = {sig: jobs for sig, jobs in sig_to_jobs.items() if len(jobs) > 1}
-    total_jobs = len(job_sigs)
+    total_jobs = sum(len(jobs) for jobs in sig_to_jobs.values())
     unique_jobs = len(sig_to_jobs)
     total_duplicates = total_jobs - unique_jobs
 
@@ -1039,11 +1438,7 @@ def remove_duplicate_jobs_scalable(df, cols_to_compare, log_file=f'duplicate_job
         with open(log_file, 'w') as f:
             json.dump(summary, f, indent=2)
 
-    # Return deduplicated dataframe
-    unique_job_names = [jobs[0] for jobs in sig_to_jobs.values()]
-    return df[df['job_name'].isin(unique_job_names)]
-
-def separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir):
+def separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir, workers=1, **write_kwargs):
     #
     grouped = df_dedup.groupby("job_name")["type"]
     multimer_jobs = grouped.filter(is_multimer).index.unique()
@@ -1054,7 +1449,7 @@ def separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir):
     if not pd.DataFrame(job_name_not_part_of_multimers).empty:
         df_dedup_not_part_of_multimers = df_dedup[
             df_dedup.job_name.isin(job_name_not_part_of_multimers)].reset_index(drop=True)
-        write_fold_inputs(df_dedup_not_part_of_multimers, output_dir, n_seeds=n_seeds, is_fold_independent=True)
+        write_fold_inputs(df_dedup_not_part_of_multimers, output_dir, n_seeds=n_seeds, is_fold_independent=True, workers=workers, **write_kwargs)
         independent_monomers_df = extract_monomer_jobs(df_dedup_not_part_of_multimers,output_dir,n_seeds=n_seeds,independent_monomers=True)
         independent_monomers_as_multimers_df = extract_multimer_jobs(df_dedup_not_part_of_multimers,output_dir,n_seeds=n_seeds,independent_monomers=True)
 
@@ -1063,6 +1458,198 @@ def separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir):
 
 
 
+def link_cached_data_pipeline_outputs(data_pipeline_df: pd.DataFrame, cache_dir: str, db_version: str,
+                                      metadata_dir: str, campaign: str = "") -> pd.DataFrame:
+    """
+    Look up every monomer of the data pipeline in the persistent MSA cache and link hits into
+    their expected ``rule_AF3_DATA_PIPELINE/<mono>/<mono>_data.json`` location, so that Snakemake
+    does not schedule a data-pipeline job for them.
+
+    :param campaign: identifies the run in the cache statistics (see :func:`msa_cache.lookup`)
+
+    :return: table of (sample_id, cache_key, cache_hit), also written to ``msa_cache_keys.tsv``
+    """
+    conn = msa_cache.connect(cache_dir)
+    records = []
+    for row in data_pipeline_df.itertuples(index=False):
+        key = msa_cache.cache_key_from_fold_input(row.file, db_version)
+        cached = msa_cache.lookup(conn, cache_dir, key, campaign)
+        if cached is not None:
+            msa_cache.link_into(cached, row.expected_output)
+        records.append({"sample_id": row.sample_id, "cache_key": key, "cache_hit": cached is not None})
+    conn.close()
+
+    cache_df = pd.DataFrame(records, columns=["sample_id", "cache_key", "cache_hit"])
+    cache_df.to_csv(os.path.join(metadata_dir, "msa_cache_keys.tsv"), sep="\t", index=False)
+    logger.info(f"MSA cache {cache_dir}: {int(cache_df.cache_hit.sum())}/{len(cache_df)} monomers were cache hits")
+    return cache_df
+
+
+
+def load_sample_groups(path: str, group_column: str) -> dict[str, str]:
+    """
+    Group of every sample of a previous ``inference_batches.tsv`` (``batch_id``) or ``merge_chunks.tsv``
+    (``chunk_id``); empty if it does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+    groups_df = pd.read_csv(path, sep="\t", dtype=str, keep_default_na=False)
+    return dict(zip(groups_df.sample_id, groups_df[group_column]))
+
+
+def assign_inference_batches(sample_tokens: Mapping[str, int], batch_size: int,
+                             previous_batch_of: Optional[Mapping[str, str]] = None) -> pd.DataFrame:
+    """
+    Group inference samples by the AF3 token bucket they will be padded to, in chunks of at most
+    ``batch_size``, so that one ``run_alphafold.py`` process compiles each bucket once for many jobs.
+
+    :param sample_tokens: estimated tokens of every inference sample
+    :param previous_batch_of: batches of a previous run (:func:`load_sample_groups`). Samples stay
+        in their batch while their bucket is unchanged, and the other samples fill new batches numbered
+        after the previous ones, so that adding samples does not rerun the batches of earlier ones.
+    :return: table of (batch_id, sample_id, bucket, n_tokens)
+    """
+    previous_batch_of = previous_batch_of or {}
+    batches_df = pd.DataFrame(sorted(sample_tokens.items()), columns=["sample_id", "n_tokens"])
+    batches_df["bucket"] = batches_df["n_tokens"].map(token_estimator.bucket_of)
+    batches_df = batches_df.sort_values(["bucket", "sample_id"], kind="stable").reset_index(drop=True)
+
+    last_batch = defaultdict(lambda: -1)
+    for batch_id in previous_batch_of.values():
+        bucket, _, index = batch_id.removeprefix("bucket-").partition("_batch-")
+        last_batch[int(bucket)] = max(last_batch[int(bucket)], int(index))
+    batches_df["batch_id"] = [
+        previous_batch_of[sample_id]
+        if previous_batch_of.get(sample_id, "").startswith(f"bucket-{bucket}_batch-") else None
+        for sample_id, bucket in zip(batches_df["sample_id"], batches_df["bucket"])
+    ]
+    new = batches_df["batch_id"].isna()
+    new_df = batches_df.loc[new]
+    position = new_df.groupby("bucket").cumcount()
+    first_batch = new_df["bucket"].map(lambda bucket: last_batch[bucket] + 1)
+    batches_df.loc[new, "batch_id"] = ("bucket-" + new_df["bucket"].astype(str)
+                                       + "_batch-" + (first_batch + position // batch_size).astype(str))
+    return batches_df[["batch_id", "sample_id", "bucket", "n_tokens"]]
+
+
+def assign_merge_chunks(multimer_monomers: Mapping[str, Sequence[str]], chunk_size: int,
+                        previous_chunk_of: Optional[Mapping[str, str]] = None) -> pd.DataFrame:
+    """
+    Group multimers into chunks of at most ``chunk_size`` that are merged with their monomer JSONs
+    in one process (MERGE_MONO_AND_MULTI_JSON_CHUNK). Multimers sharing monomers are put next to each
+    other so that a chunk parses as few monomer JSONs as possible.
+
+    :param multimer_monomers: monomer data JSONs of every multimer
+    :param previous_chunk_of: chunks of a previous run (:func:`load_sample_groups`). Multimers stay in
+        their chunk and new multimers fill new chunks numbered after the previous ones, so that adding
+        multimers does not rerun the merges (and the inference) of earlier ones.
+    :return: table of (chunk_id, sample_id)
+    """
+    previous_chunk_of = previous_chunk_of or {}
+    last_chunk = max((int(chunk_id.removeprefix("merge-")) for chunk_id in previous_chunk_of.values()), default=-1)
+    kept = sorted((previous_chunk_of[multi], multi) for multi in multimer_monomers if multi in previous_chunk_of)
+    new = sorted((multi for multi in multimer_monomers if multi not in previous_chunk_of),
+                 key=lambda multi: (sorted(multimer_monomers[multi]), multi))
+    rows = kept + [(f"merge-{last_chunk + 1 + position // chunk_size}", multi) for position, multi in enumerate(new)]
+    return pd.DataFrame(rows, columns=["chunk_id", "sample_id"])
+
+
+def plan_seed_packs(job_seeds: Mapping[str, Sequence[int]], job_tokens: Mapping[str, int],
+                    target_minutes: float, max_seeds_per_job: int, n_gpus: int = 0) -> dict[str, list[list[int]]]:
+    """
+    Decide which seeds of every job are predicted together in one inference job.
+
+    A job gets as many seeds as fit in ``target_minutes`` (estimated from its token count), at most
+    ``max_seeds_per_job``. If that leaves fewer inference jobs than ``n_gpus``, packs are halved until
+    every GPU has work (or every pack holds a single seed).
+
+    :param job_seeds: model seeds of every job
+    :param job_tokens: estimated tokens of every job
+    :return: the seed packs of every job, in seed order
+    """
+    pack_sizes = {
+        job: max(1, min(max_seeds_per_job, len(seeds),
+                        int(target_minutes * 60 // token_estimator.seconds_per_seed(job_tokens.get(job, 0)))))
+        for job, seeds in job_seeds.items()
+    }
+
+    def n_packs():
+        return sum(math.ceil(len(job_seeds[job]) / size) for job, size in pack_sizes.items())
+
+    while n_gpus and n_packs() < n_gpus and any(size > 1 for size in pack_sizes.values()):
+        pack_sizes = {job: (size + 1) // 2 for job, size in pack_sizes.items()}
+
+    return {
+        job: [seeds[i:i + pack_sizes[job]] for i in range(0, len(seeds), pack_sizes[job])]
+        for job, seeds in ((job, sorted(seeds)) for job, seeds in job_seeds.items())
+    }
+
+
+def pack_seeds(output_dir: str, multimer_files: Iterable[str], token_counts: dict, manifest: dict,
+               target_minutes: float, max_seeds_per_job: int, n_gpus: int = 0) -> dict[str, str]:
+    """
+    Replace the one-seed fold inputs ``rule_PREPROCESSING/multimers/<job>_seed-<s>.json`` of every job
+    by packs of seeds (:func:`plan_seed_packs`) named ``<job>_seeds-<first>-to-<last>.json``.
+    Packs of a single seed keep their name. AF3 still writes one ``seed-<s>_sample-<i>`` directory per
+    seed of a pack.
+
+    ``token_counts`` and ``manifest`` are updated to the packed fold inputs, so that incremental runs
+    keep (and do not rewrite) unchanged packs.
+
+    :return: map of every packed one-seed fold input to its pack
+    """
+    multimers_dir = os.path.normpath(os.path.join(output_dir, "rule_PREPROCESSING", "multimers"))
+    seed_files = defaultdict(dict)
+    for fold_input in multimer_files:
+        stem, _, seed = Path(fold_input).stem.rpartition("_seed-")
+        if os.path.normpath(os.path.dirname(fold_input)) == multimers_dir and stem and seed.isdigit():
+            seed_files[stem][int(seed)] = fold_input
+
+    # Fold inputs of unchanged jobs in incremental runs are earlier packs, not one-seed files
+    known_fold_inputs, known_tokens = defaultdict(list), {}
+    for (job_name, _), (_, fold_inputs, n_tokens) in manifest.items():
+        known_fold_inputs[job_name].extend(fold_inputs)
+        known_tokens[job_name] = n_tokens
+
+    job_tokens = {job: token_counts.get(next(iter(files.values())), known_tokens.get(job, 0))
+                  for job, files in seed_files.items()}
+    plan = plan_seed_packs({job: list(files) for job, files in seed_files.items()}, job_tokens,
+                           target_minutes, max_seeds_per_job, n_gpus)
+
+    packed, job_fold_inputs = {}, {}
+    for job, packs in plan.items():
+        files = seed_files[job]
+        job_fold_inputs[job] = [files[pack[0]] for pack in packs]
+        source = next((f for f in [*files.values(), *known_fold_inputs[job]] if os.path.exists(f)), None)
+        if source is None or all(len(pack) == 1 for pack in packs):
+            continue
+        task = json_io.load(source)
+        for pack in packs:
+            if len(pack) == 1:
+                continue
+            pack_name = f"{job}_seeds-{pack[0]}-to-{pack[-1]}"
+            pack_file = os.path.join(os.path.dirname(files[pack[0]]), f"{pack_name}.json")
+            text = dump_compact_json({**task, "name": pack_name, "modelSeeds": pack})
+            if not os.path.exists(pack_file) or Path(pack_file).read_text() != text:
+                Path(pack_file).write_text(text)
+            token_counts[pack_file] = job_tokens[job]
+            for seed in pack:
+                packed[files[seed]] = pack_file
+        job_fold_inputs[job] = [packed.get(f, f) for f in job_fold_inputs[job]]
+
+    for fold_input in packed:
+        Path(fold_input).unlink(missing_ok=True)
+        token_counts.pop(fold_input, None)
+    for (job_name, call), (digest, fold_inputs, n_tokens) in manifest.items():
+        if job_name in job_fold_inputs and all(
+                os.path.normpath(os.path.dirname(f)) == multimers_dir for f in fold_inputs):
+            manifest[(job_name, call)] = (digest, job_fold_inputs[job_name], n_tokens)
+
+    n_packs = len(set(packed.values()))
+    logger.info(f"Seed packing: {len(packed)} one-seed fold inputs were packed into {n_packs} inference jobs")
+    return packed
+
+
 @click.command()
 @click.argument('sample_sheet', type=click.Path(exists=True))
 @click.argument('output_dir', type=click.Path())
@@ -1074,7 +1661,41 @@ def separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir):
               help="Number of random seeds. Useful for massive sampling. If specified, the model_seeds column in the sample sheet is ignored")
 @click.option('--n-samples', type=int, default=5,
               help="Number of models per seed. Useful for massive sampling")
-def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds, n_samples): #TODO support "count" column for homooligomers in the samplesheet
+@click.option('--workers', type=int, default=1,
+              help="Number of processes used to build and serialize fold inputs")
+@click.option('--max-chains', type=int, default=None,
+              help="stoichio-screen: skip stoichiometries with more chains")
+@click.option('--max-tokens', type=int, default=None,
+              help="stoichio-screen: skip stoichiometries with more (estimated) tokens")
+@click.option('--max-ligand-copies', type=int, default=None,
+              help="stoichio-screen: maximum number of copies of each ligand")
+@click.option('--inference-batch-size', type=int, default=0,
+              help="Group inference samples of the same token bucket into batches of this size "
+                   "(metadata/inference_batches.tsv); 0 disables batching")
+@click.option('--merge-chunk-size', type=int, default=0,
+              help="Group multimers into chunks of this size that are merged in one process "
+                   "(metadata/merge_chunks.tsv); 0 or 1 merges every multimer separately")
+@click.option('--seed-pack-minutes', type=float, default=0,
+              help="Pack several seeds of a job into one inference job of about this many minutes "
+                   "(estimated from its token count); 0 keeps one seed per inference job")
+@click.option('--seed-pack-max-seeds', type=int, default=50,
+              help="Maximum number of seeds per inference job when packing seeds")
+@click.option('--seed-pack-gpus', type=int, default=0,
+              help="Number of GPUs to keep busy: seed packs are made smaller if there would be fewer inference jobs")
+@click.option('--incremental', is_flag=True,
+              help="Only rewrite fold inputs of new or changed jobs (compared to the manifest of the previous run) "
+                   "and remove those of jobs no longer in the sample sheet")
+@click.option('--template-cache-dir', type=click.Path(), default=prepare_af3_templates.DEFAULT_TEMPLATE_CACHE_DIR,
+              show_default=True, help="Cache of custom templates aligned to the target sequences, reused across jobs and runs")
+@click.option('--msa-cache-dir', type=click.Path(), default=None,
+              help="Persistent MSA cache. Data pipeline outputs of cached monomers are linked instead of recomputed")
+@click.option('--msa-cache-db-version', type=str, default="",
+              help="Version tag of the genetic databases, part of the MSA cache key")
+@click.option('--json-compression', type=click.Choice(["none", *json_io.COMPRESSION_SUFFIXES]), default="none",
+              show_default=True, help="Compression of the merged inference inputs, recorded in metadata/inference_samples.tsv")
+def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds, n_samples, workers, max_chains,
+         max_tokens, max_ligand_copies, inference_batch_size, merge_chunk_size, seed_pack_minutes, seed_pack_max_seeds,
+         seed_pack_gpus, incremental, template_cache_dir, msa_cache_dir, msa_cache_db_version, json_compression): #TODO support "count" column for homooligomers in the samplesheet
     """
     Creates batch tasks from a DataFrame.
 
@@ -1107,11 +1728,27 @@ def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds,
     logger.info(f"PREDICT_INDIVIDUAL_COMPONENTS = {predict_individual_components}")
     logger.info(f"#SEEDS = {n_seeds}")
     logger.info(f"#SAMPLES = {n_samples}")
+    logger.info(f"WORKERS = {workers}")
+    logger.info(f"INCREMENTAL = {incremental}")
+    logger.info(f"MSA_CACHE_DIR = {msa_cache_dir}")
 
 
     metadata_dir = os.path.join(f"{output_dir}","rule_PREPROCESSING","metadata")
     os.makedirs(metadata_dir, exist_ok=True)
 
+    manifest_file = os.path.join(metadata_dir, "fold_input_manifest.tsv")
+    previous_manifest = load_fold_input_manifest(manifest_file) if incremental else {}
+    manifest = {}
+    token_counts = {}
+    # One process pool serializes the fold inputs of all write_fold_inputs calls
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    write_kwargs = dict(executor=executor, manifest=manifest, previous_manifest=previous_manifest,
+                        token_counts=token_counts, template_cache_dir=template_cache_dir)
+    # Multimer chain -> monomer rows, written out as the multimers are produced
+    map_rows_path = os.path.join(metadata_dir, "multimer_to_monomer_rows.tsv")
+    if os.path.exists(map_rows_path):
+        os.remove(map_rows_path)
+
     df = pd.read_csv(sample_sheet, sep="\t")
     if "roi" in df.columns:
         df["sequence"] = df.apply(lambda row: slice_sequence_by_range(row["sequence"], row["roi"], row["type"]), axis=1)
@@ -1125,6 +1762,14 @@ def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds,
 
     df["job_name"] = df["job_name"].apply(lambda x: sanitised_name(x))
 
+    # Align every distinct custom template once, in parallel; fold inputs then read the cached results
+    tasks = template_tasks(df)
+    if tasks:
+        failed = prepare_af3_templates.prepare_templates(tasks, cache_dir=template_cache_dir, workers=workers)
+        for (template_path, template_chain, _), error in failed.items():
+            logger.warning(f"Could not prepare template {template_path},{template_chain}:\n{error}")
+        logger.info(f"Prepared {len(tasks) - len(failed)} distinct custom templates in {template_cache_dir}")
+
     cols_to_compare = df.columns.difference(['job_name'])
     df_dedup = remove_duplicate_jobs_scalable(df, cols_to_compare,log_file=os.path.join(metadata_dir,"duplicate_job_summary.json"))
     has_multimers_ = has_multimers(df_dedup)
@@ -1134,13 +1779,15 @@ def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds,
         pd.DataFrame([]),
         pd.DataFrame([])
     )
+    # Monomer fold inputs of the pair modes are written together with their pairs
+    monomers_written = False
     if mode != 'virtual-drug-screen' and mode != 'stoichio-screen' and mode != "pulldown":
 
-        df_dedup_dependent, df_dedup_independent_as_monomers, df_dedup_independent_as_multimers = separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir)
+        df_dedup_dependent, df_dedup_independent_as_monomers, df_dedup_independent_as_multimers = separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir, workers=workers, **write_kwargs)
     if mode == "custom":
         # write originals
 
-        write_fold_inputs(df_dedup_dependent, output_dir, n_seeds=n_seeds)
+        write_fold_inputs(df_dedup_dependent, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
 
         # derive + write monomers from multimers
         multimer_df = extract_multimer_jobs(df_dedup_dependent, output_dir,n_seeds=n_seeds) if not df_dedup_dependent.empty else pd.DataFrame([])
@@ -1152,107 +1799,84 @@ def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds,
             monomer_df = extract_monomer_jobs(df_dedup_dependent, output_dir, has_multimers=False)
 
     elif mode == "all-vs-all":
-        write_fold_inputs(df_dedup, output_dir, n_seeds=n_seeds)
+        write_fold_inputs(df_dedup, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
 
-        combined_df = create_all_vs_all_df(df_dedup)
-        write_fold_inputs(combined_df, output_dir, n_seeds=n_seeds)
-
-        multimer_df = extract_multimer_jobs(combined_df, output_dir)
-        monomer_df = extract_monomer_jobs(multimer_df, output_dir, has_multimers=True)
+        # Pairs are expanded and written chunk by chunk, together with their monomers
+        write_combined_jobs(iter_all_vs_all_dfs(df_dedup), output_dir, map_rows_path, existing_optional_cols,
+                            n_seeds=n_seeds, workers=workers, **write_kwargs)
+        multimer_df, monomer_df = pd.DataFrame([]), pd.DataFrame([])
+        monomers_written = True
 
     elif mode == "pulldown":
-        combined_df = create_pulldown_df(df_dedup)
-        write_fold_inputs(combined_df, output_dir, n_seeds=n_seeds)
-        multimer_df = extract_multimer_jobs(combined_df, output_dir,n_seeds=n_seeds)
-        monomer_df = extract_monomer_jobs(multimer_df, output_dir, has_multimers=True)
+        # Collapse symmetric pairs (X_Y vs. Y_X) of jobs that appear in both groups
+        pair_cols_to_compare = df_dedup.columns.difference(["job_name", "id", "bait_or_target"])
+        pairs = iter_deduplicated_jobs(
+            partial(iter_pulldown_dfs, df_dedup), pair_cols_to_compare,
+            log_file=os.path.join(metadata_dir, "duplicate_pair_summary.json"), chain_id_col="original_id")
+        # Pairs are expanded and written chunk by chunk, together with their monomers
+        write_combined_jobs(pairs, output_dir, map_rows_path, existing_optional_cols,
+                            n_seeds=n_seeds, workers=workers, **write_kwargs)
+        multimer_df, monomer_df = pd.DataFrame([]), pd.DataFrame([])
+        monomers_written = True
 
     elif mode == "virtual-drug-screen":
         df = transform_vds_to_af3(df)
         cols_to_compare = df.columns.difference(['job_name'])
 
         df_dedup = remove_duplicate_jobs_scalable(df, cols_to_compare,log_file=os.path.join(metadata_dir,"duplicate_job_summary.json"))
-        df_dedup_dependent, df_dedup_independent_as_monomers, df_dedup_independent_as_multimers = separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir)
+        df_dedup_dependent, df_dedup_independent_as_monomers, df_dedup_independent_as_multimers = separate_to_dependent_and_independent_jobs(df_dedup, n_seeds, output_dir, workers=workers, **write_kwargs)
         has_multimers_ = has_multimers(df_dedup_dependent)
 
-        write_fold_inputs(df_dedup_dependent, output_dir, n_seeds=n_seeds)
+        write_fold_inputs(df_dedup_dependent, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
 
         combined_df = df_dedup_dependent
-        write_fold_inputs(combined_df, output_dir, n_seeds=n_seeds)
+        write_fold_inputs(combined_df, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
 
         multimer_df = extract_multimer_jobs(combined_df, output_dir)
         monomer_df = extract_monomer_jobs(multimer_df, output_dir, has_multimers=True)
 
     elif mode == "stoichio-screen":
-        df, summary = transform_stoichio_screen_to_af3(df,n_seeds=n_seeds)
-        summary.to_csv(os.path.join(output_dir,"rule_PREPROCESSING","metadata","stoichio_screen.csv"), index=False)
-        cols_to_compare = df.columns.difference(['job_name'])
-
-        df_dedup = remove_duplicate_jobs_scalable(df, cols_to_compare,log_file=os.path.join(metadata_dir,"duplicate_job_summary.json"))
-        has_multimers_ = has_multimers(df_dedup)
-
-        write_fold_inputs(df_dedup, output_dir, n_seeds=n_seeds)
-
-        multimer_df = extract_multimer_jobs(df_dedup, output_dir)
-        monomer_df = extract_monomer_jobs(multimer_df, output_dir, has_multimers=True)
-
+        stoichiometries = partial(transform_stoichio_screen_to_af3, df, os.path.join(metadata_dir, "stoichio_screen.csv"),
+                                  n_seeds=n_seeds, max_chains=max_chains, max_tokens=max_tokens,
+                                  max_ligand_copies=max_ligand_copies)
+        cols_to_compare = pd.Index(STOICHIO_ROW_COLUMNS).difference(['job_name'])
+        jobs = iter_deduplicated_jobs(stoichiometries, cols_to_compare,
+                                      log_file=os.path.join(metadata_dir, "duplicate_job_summary.json"))
+
+        # Combinations are enumerated and written chunk by chunk, together with their monomers
+        n_chains = write_combined_jobs(jobs, output_dir, map_rows_path, existing_optional_cols,
+                                       n_seeds=n_seeds, workers=workers, **write_kwargs)
+        multimer_df, monomer_df = pd.DataFrame([]), pd.DataFrame([])
+        monomers_written = True
+        has_multimers_ = n_chains > 0
+
+    unwritten_monomer_df = pd.DataFrame() if monomers_written else monomer_df
     if not df_dedup_independent_as_monomers.empty and not df_dedup_independent_as_multimers.empty:
 
         multimer_df = pd.concat([multimer_df, df_dedup_independent_as_multimers], ignore_index=True)
         monomer_df = pd.concat([monomer_df, df_dedup_independent_as_monomers], ignore_index=True)
+        unwritten_monomer_df = pd.concat([unwritten_monomer_df, df_dedup_independent_as_monomers], ignore_index=True)
 
+    model_seeds_of = {}
     if has_multimers_ or df_dedup_dependent.empty:
 
-        write_fold_inputs(monomer_df, output_dir, n_seeds=n_seeds)
-
-        multimer_to_monomer_df = pd.merge(
-            multimer_df[["job_name", "id", "fold_input", "model_seeds"]],
-            monomer_df[
-                ["job_name", "id", "sequence", *existing_optional_cols,"fold_input",
-                 "original_job_name", "original_id"]
-            ],
-            left_on="job_name",
-            right_on="original_job_name",
-            how="right",
-        )
-
-        multimer_to_monomer_df["fold_input_mono"] = (
-                output_dir
-                + "/rule_AF3_DATA_PIPELINE/"
-                + multimer_to_monomer_df.job_name_y
-                + "_data.json"
-        )
-
-        replicate_monomer_groups = (
-            multimer_to_monomer_df.fillna("not_specified")
-            .groupby(["sequence", *existing_optional_cols])["fold_input_mono"]
-            .apply(set)
-            .tolist()
-        )
-
-        canonical_monomer_map = {
-            m: canonical
-            for group in replicate_monomer_groups
-            for canonical in [sorted(group)[0]]
-            for m in group
-        }
-
+        write_fold_inputs(unwritten_monomer_df, output_dir, n_seeds=n_seeds, workers=workers, **write_kwargs)
 
-
-        inference_to_data_pipeline_map = (
-            multimer_to_monomer_df
-            .groupby("fold_input_x", sort=False)[["id_y", "fold_input_mono"]]
-            .apply(lambda g: {
-                chain_id: canonical_monomer_map[file]
-                for chain_id, file in zip(g["id_y"], g["fold_input_mono"])
-            })
-            .to_dict()
-        )
+        if not multimer_df.empty and not monomer_df.empty:
+            append_multimer_to_monomer_rows(
+                multimer_to_monomer_rows(multimer_df, monomer_df, output_dir, existing_optional_cols), map_rows_path)
+        inference_to_data_pipeline_map, model_seeds_of = read_multimer_to_monomer_map(map_rows_path)
     else:
         inference_to_data_pipeline_map = {
             row.fold_input: {row.id: row.fold_input}
             for _, row in monomer_df.iterrows()
         }
 
+    if executor is not None:
+        executor.shutdown()
+    if os.path.exists(map_rows_path):
+        os.remove(map_rows_path)
+
     referenced_monomer_files = {
         monomer_file
         for mapping in inference_to_data_pipeline_map.values()
@@ -1322,20 +1946,11 @@ def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds,
                 long_inference_to_data_pipeline_df.monomer_file.str.split(".").str[-2].str.split("_").str[0]
     if n_seeds is None:
 
-        fold_input_to_model_seeds_map = dict(
-            zip(multimer_to_monomer_df[["fold_input_x", "model_seeds"]].drop_duplicates().fold_input_x,
-                multimer_to_monomer_df[
-                    ["fold_input_x", "model_seeds"]].drop_duplicates().model_seeds))
-
-        fold_input_to_model_seeds_map = {**fold_input_to_model_seeds_map, **dict(
-            zip(multimer_to_monomer_df[["fold_input_mono", "model_seeds"]].drop_duplicates().fold_input_mono,
-                multimer_to_monomer_df[["fold_input_mono", "model_seeds"]].drop_duplicates().model_seeds))}
-
         fold_input_to_model_seeds_map = {k.replace("_data.json" if "_data.json" in k else ".json", ".json" if "_data.json" in k else "_data.json").replace("rule_PREPROCESSING/multimers",
                                                                                   "rule_MERGE_MONOMERS_TO_MULTIMERS").replace(
             "rule_PREPROCESSING/multimers", "rule_MERGE_MONOMERS_TO_MULTIMERS").replace("rule_AF3_DATA_PIPELINE",
                                                                                         "rule_MERGE_MONOMERS_TO_MULTIMERS"):v
-        for k, v in fold_input_to_model_seeds_map.items()}
+        for k, v in model_seeds_of.items()}
 
     inference_df = pd.concat([inference_df,
                               inference_df["inference_samples"].map(
@@ -1380,15 +1995,82 @@ def main(sample_sheet, output_dir, mode, predict_individual_components, n_seeds,
     long_inference_to_data_pipeline_df["monomer_file"] = long_inference_to_data_pipeline_df["monomer_file"].apply(lambda x: os.path.join(os.path.dirname(x), os.path.basename(x).split("_data.json")[0], os.path.basename(x)))
     long_inference_to_data_pipeline_df["sample_id"] = long_inference_to_data_pipeline_df["multimer_file"].apply(lambda x: Path(x).stem)
 
+    seeds_per_fold_input = {}
+    if seed_pack_minutes > 0:
+        packed = pack_seeds(output_dir, long_inference_to_data_pipeline_df["multimer_file"].unique(), token_counts,
+                            manifest, seed_pack_minutes, seed_pack_max_seeds, seed_pack_gpus)
+        seeds_per_fold_input = Counter(packed.values())
+        pack_of = {Path(fold_input).stem: Path(pack_file).stem for fold_input, pack_file in packed.items()}
+        long_inference_to_data_pipeline_df["multimer_file"] = long_inference_to_data_pipeline_df["multimer_file"].replace(packed)
+        long_inference_to_data_pipeline_df["sample_id"] = long_inference_to_data_pipeline_df["multimer_file"].apply(lambda x: Path(x).stem)
+        long_inference_to_data_pipeline_df = long_inference_to_data_pipeline_df.drop_duplicates().reset_index(drop=True)
+        # Per-seed outputs keep their seed-<s>_sample-<i> directories, inside the directory of the pack
+        is_packed = inference_df["job_name"].isin(pack_of)
+        packed_rows = inference_df.loc[is_packed]
+        inference_df.loc[is_packed, "inference_samples"] = [
+            file.replace(f"/{job}_data.json", f"/{pack_of[job]}_data.json")
+            for file, job in zip(packed_rows["inference_samples"], packed_rows["job_name"])]
+        inference_df.loc[is_packed, "expected_output"] = [
+            file.replace(f"/rule_AF3_INFERENCE/{job}/", f"/rule_AF3_INFERENCE/{pack_of[job]}/")
+            for file, job in zip(packed_rows["expected_output"], packed_rows["job_name"])]
+        inference_df.loc[is_packed, "job_name"] = packed_rows["job_name"].map(pack_of)
+
+    if incremental:
+        remove_stale_fold_inputs(output_dir, previous_manifest, manifest,
+                                 log_file=os.path.join(metadata_dir, "removed_fold_inputs.tsv"))
+
     long_inference_to_data_pipeline_df.to_csv(f"{metadata_dir}/inference_to_data_pipeline_map.tsv",
                                               sep="\t", index=False)
 
     data_pipeline_df.to_csv(f"{metadata_dir}/data_pipeline_samples.tsv", sep="\t", index=False)
 
+    job_tokens_df = pd.DataFrame(
+        [(Path(fold_input).stem, fold_input, n_tokens, seeds_per_fold_input.get(fold_input, 1))
+         for fold_input, n_tokens in sorted(token_counts.items()) if os.path.exists(fold_input)],
+        columns=["sample_id", "fold_input", "n_tokens", "n_seeds"])
+    job_tokens_df.to_csv(f"{metadata_dir}/job_tokens.tsv", sep="\t", index=False)
+
+    inference_batches_df = None
+    if inference_batch_size > 0:
+        tokens_by_sample = dict(zip(job_tokens_df.sample_id, job_tokens_df.n_tokens))
+        batches_file = os.path.join(metadata_dir, "inference_batches.tsv")
+        inference_batches_df = assign_inference_batches(
+            {sample_id: tokens_by_sample.get(sample_id, 0) for sample_id in inference_df["job_name"].unique()},
+            inference_batch_size,
+            previous_batch_of=load_sample_groups(batches_file, "batch_id") if incremental else None)
+        inference_batches_df.to_csv(batches_file, sep="\t", index=False)
+        logger.info(f"{len(inference_batches_df)} inference samples were grouped into "
+                    f"{inference_batches_df.batch_id.nunique()} batches")
+
+    merge_chunks_df = None
+    if merge_chunk_size > 1:
+        monomers_of = long_inference_to_data_pipeline_df.groupby("sample_id")["monomer_file"].agg(list).to_dict()
+        chunks_file = os.path.join(metadata_dir, "merge_chunks.tsv")
+        merge_chunks_df = assign_merge_chunks(
+            {multi: monomers_of.get(multi, []) for multi in
+             fold_input_names(os.path.join(output_dir, "rule_PREPROCESSING", "multimers"))},
+            merge_chunk_size, previous_chunk_of=load_sample_groups(chunks_file, "chunk_id") if incremental else None)
+        merge_chunks_df.to_csv(chunks_file, sep="\t", index=False)
+        logger.info(f"{len(merge_chunks_df)} multimers were grouped into "
+                    f"{merge_chunks_df.chunk_id.nunique()} merge chunks")
+
+    msa_cache_df = None
+    if msa_cache_dir:
+        msa_cache_df = link_cached_data_pipeline_outputs(data_pipeline_df, msa_cache_dir, msa_cache_db_version,
+                                                         metadata_dir, campaign=os.path.abspath(output_dir))
+
+    merged_inputs = inference_df["inference_samples"].str.contains("rule_MERGE_MONOMERS_TO_MULTIMERS")
+    inference_df.loc[merged_inputs, "inference_samples"] = inference_df.loc[merged_inputs, "inference_samples"].map(
+        lambda x: json_io.with_compression(x, json_compression))
     inference_df.sort_values(["job_name", "seed", "sample"])[
         ["job_name", "inference_samples", "expected_output"]].rename(columns={"job_name":"sample_id","inference_samples":"file"}).to_csv(
         f"{metadata_dir}/inference_samples.tsv", sep="\t", index=False)
 
+    save_fold_input_manifest(manifest_file, manifest)
+    write_preprocessing_manifest(os.path.join(metadata_dir, "preprocessing_manifest.json"), output_dir,
+                                 long_inference_to_data_pipeline_df, job_tokens_df, inference_batches_df,
+                                 msa_cache_df, merge_chunks_df)
+
     logger.info(f"Rule PREPROCESSING was completed successfully!")
     logger.info(
         f"Fold input files were saved to {output_dir}/rule_PREPROCESSING/monomers and {output_dir}/rule_PREPROCESSING/multimers")
@@ -0,0 +1,184 @@
+"""
+Cheap estimate of the number of AF3 tokens of a chain or a fold input.
+
+AlphaFold 3 uses one token per standard residue / nucleotide and one token per heavy atom
+of ligands and of modified residues. The estimate is computed from the sample sheet or the
+fold input JSON only: ligand sizes come from the SMILES, the user-provided CCD, or a table of
+common CCD components, without resolving the full CCD.
+"""
+import os
+import re
+from typing import Any, Iterable, Mapping, Optional
+
+# Organic-subset atoms outside brackets (two-letter symbols first), or any bracket atom
+SMILES_ATOM = re.compile(r"\[([^\]]+)\]|Br|Cl|[BCNOPSFI]|[bcnops]")
+BRACKET_ELEMENT = re.compile(r"[A-Z][a-z]?|[bcnops]")
+CIF_TOKEN = re.compile(r"'[^']*'|\"[^\"]*\"|\S+")
+
+# Heavy atoms of common CCD components (ligands, ions, glycans, modified residues / nucleotides)
+CCD_HEAVY_ATOMS = {
+    # nucleotides and cofactors
+    "ATP": 31, "ADP": 27, "AMP": 23, "ANP": 31, "GTP": 32, "GDP": 28, "GNP": 32, "5GP": 24,
+    "NAD": 44, "NAI": 44, "NAP": 48, "NDP": 48, "FAD": 53, "FMN": 31, "HEM": 43, "HEC": 43,
+    "SAM": 27, "SAH": 26, "COA": 48, "ACO": 51, "PLP": 16, "TPP": 26, "CLA": 65, "RET": 21,
+    # glycans
+    "NAG": 15, "NDG": 15, "FUC": 11, "MAN": 12, "BMA": 12, "GAL": 12, "GLC": 12, "SIA": 21,
+    # ions
+    "MG": 1, "ZN": 1, "CA": 1, "NA": 1, "K": 1, "CL": 1, "MN": 1, "FE": 1, "FE2": 1, "CO": 1,
+    "NI": 1, "CU": 1, "CD": 1, "IOD": 1, "BR": 1, "HOH": 1,
+    # buffers and additives
+    "SO4": 5, "PO4": 5, "NO3": 4, "GOL": 6, "EDO": 4, "ACT": 4, "FMT": 3, "PEG": 7, "MPD": 8,
+    "DMS": 4, "CIT": 13, "TRS": 8, "EPE": 15, "MES": 12,
+    # modified amino acids
+    "SEP": 11, "TPO": 12, "PTR": 17, "MSE": 8, "HYP": 9, "HY3": 9, "MLY": 12, "M3L": 13,
+    "ALY": 13, "CSO": 8, "P1L": 24,
+    # modified nucleotides
+    "PSU": 21, "5MC": 22, "6MA": 23, "2MG": 25, "6OG": 23, "5MU": 21, "1MA": 23, "OMG": 25,
+}
+
+# Used for CCD components that are neither user-defined nor in the table above
+DEFAULT_CCD_TOKENS = 30
+DEFAULT_MODIFIED_RESIDUE_TOKENS = 12
+
+POLYMER_TYPES = {"protein", "rna", "dna"}
+
+# Token buckets AF3 pads inputs to (run_alphafold.py --buckets default); one JIT compilation per bucket
+AF3_BUCKETS = (256, 512, 768, 1024, 1280, 1536, 2048, 2560, 3072, 3584, 4096, 4608, 5120)
+
+# Inference seconds per seed (5 diffusion samples) on one A100 80GB, by bucket. 1024-5120 are the
+# timings of the AF3 performance documentation; the other buckets are interpolated.
+AF3_SECONDS_PER_SEED = {
+    256: 10, 512: 20, 768: 40, 1024: 62, 1280: 100, 1536: 145, 2048: 275, 2560: 460,
+    3072: 703, 3584: 1040, 4096: 1434, 4608: 1950, 5120: 2547,
+}
+
+
+def smiles_heavy_atoms(smiles: str) -> int:
+    """Number of heavy (non-hydrogen) atoms in a SMILES string."""
+    n_atoms = 0
+    for match in SMILES_ATOM.finditer(smiles):
+        bracket = match.group(1)
+        if bracket is None:
+            n_atoms += 1
+            continue
+        element = BRACKET_ELEMENT.search(bracket.lstrip("0123456789"))
+        if element is not None and element.group(0) != "H":
+            n_atoms += 1
+    return n_atoms
+
+
+def user_ccd_heavy_atoms(user_ccd: Optional[str]) -> dict[str, int]:
+    """
+    Heavy atoms of every component of a user-provided CCD (mmCIF text, or a path to it),
+    counted from the ``_chem_comp_atom`` loop of each ``data_<code>`` block.
+    """
+    if not user_ccd or not isinstance(user_ccd, str):
+        return {}
+    if "\n" not in user_ccd and os.path.isfile(user_ccd):
+        with open(user_ccd) as f:
+            user_ccd = f.read()
+
+    heavy_atoms = {}
+    code = None
+    columns = []
+    in_atom_loop = False
+    for line in user_ccd.splitlines():
+        line = line.strip()
+        if line.startswith("data_"):
+            code, in_atom_loop, columns = line[5:], False, []
+        elif line == "loop_" or line.startswith("#"):
+            in_atom_loop, columns = False, []
+        elif line.startswith("_chem_comp_atom."):
+            in_atom_loop = True
+            columns.append(line.split()[0].split(".", 1)[1])
+        elif line.startswith("_"):
+            in_atom_loop = False
+        elif in_atom_loop and line and code is not None:
+            values = CIF_TOKEN.findall(line)
+            symbol = values[columns.index("type_symbol")] if "type_symbol" in columns and len(values) == len(columns) else ""
+            if symbol.strip("'\"").upper() not in ("H", "D"):
+                heavy_atoms[code] = heavy_atoms.get(code, 0) + 1
+    return heavy_atoms
+
+
+def ccd_tokens(ccd_codes: Any, user_ccd_atoms: Optional[Mapping[str, int]] = None) -> int:
+    """Tokens of a ligand given as one or more CCD codes (list or comma separated string)."""
+    if isinstance(ccd_codes, str):
+        ccd_codes = ccd_codes.replace(" ", "").split(",")
+    user_ccd_atoms = user_ccd_atoms or {}
+    return sum(
+        user_ccd_atoms.get(code, CCD_HEAVY_ATOMS.get(code.upper(), DEFAULT_CCD_TOKENS))
+        for code in ccd_codes if code
+    )
+
+
+def modification_tokens(modifications: Optional[Iterable[Mapping[str, Any]]],
+                        user_ccd_atoms: Optional[Mapping[str, int]] = None) -> int:
+    """
+    Extra tokens of modified residues: a modified residue is tokenized per atom, so it adds its
+    heavy atoms minus the one token the standard residue would have had.
+    """
+    user_ccd_atoms = user_ccd_atoms or {}
+    extra = 0
+    for modification in modifications or []:
+        code = modification.get("ptmType") or modification.get("modificationType")
+        if not code:
+            continue
+        atoms = user_ccd_atoms.get(code, CCD_HEAVY_ATOMS.get(code.upper(), DEFAULT_MODIFIED_RESIDUE_TOKENS))
+        extra += atoms - 1
+    return extra
+
+
+def estimate_tokens(entity_type: str, sequence: Optional[str] = None, smiles: Optional[str] = None,
+                    ccd_codes: Optional[Any] = None, modifications: Optional[Iterable[Mapping[str, Any]]] = None,
+                    user_ccd_atoms: Optional[Mapping[str, int]] = None) -> int:
+    """
+    Estimated number of tokens of one copy of an entity.
+
+    :param entity_type: 'protein', 'rna', 'dna' or 'ligand'
+    :param sequence: polymer sequence
+    :param smiles: ligand SMILES
+    :param ccd_codes: ligand CCD codes (list or comma separated)
+    :param modifications: AF3 modifications of a polymer (``ptmType`` / ``modificationType`` dicts)
+    :param user_ccd_atoms: output of :func:`user_ccd_heavy_atoms` for the job
+    """
+    if entity_type in POLYMER_TYPES:
+        return len(sequence or "") + modification_tokens(modifications, user_ccd_atoms)
+    if smiles:
+        return smiles_heavy_atoms(smiles)
+    if ccd_codes:
+        return ccd_tokens(ccd_codes, user_ccd_atoms)
+    return 0
+
+
+def fold_input_tokens(fold_input: Mapping[str, Any]) -> int:
+    """Estimated number of tokens of an AF3 fold input (JSON dict), counting every copy of every entity."""
+    user_ccd_atoms = user_ccd_heavy_atoms(fold_input.get("userCCD") or fold_input.get("userCCDPath"))
+    n_tokens = 0
+    for sequence in fold_input.get("sequences", []):
+        for entity_type, entity in sequence.items():
+            ids = entity.get("id", [])
+            n_copies = len(ids) if isinstance(ids, list) else 1
+            n_tokens += n_copies * estimate_tokens(
+                entity_type,
+                sequence=entity.get("sequence"),
+                smiles=entity.get("smiles"),
+                ccd_codes=entity.get("ccdCodes"),
+                modifications=entity.get("modifications"),
+                user_ccd_atoms=user_ccd_atoms,
+            )
+    return n_tokens
+
+
+def bucket_of(n_tokens: int, buckets: Iterable[int] = AF3_BUCKETS) -> int:
+    """Padded size AF3 compiles for an input of ``n_tokens`` tokens (inputs above the largest bucket are not padded)."""
+    return next((bucket for bucket in sorted(buckets) if n_tokens <= bucket), n_tokens)
+
+
+def seconds_per_seed(n_tokens: int) -> float:
+    """Approximate inference time of one seed, extrapolated quadratically beyond the largest bucket."""
+    bucket = bucket_of(n_tokens)
+    if bucket in AF3_SECONDS_PER_SEED:
+        return AF3_SECONDS_PER_SEED[bucket]
+    largest = max(AF3_SECONDS_PER_SEED)
+    return AF3_SECONDS_PER_SEED[largest] * (n_tokens / largest) ** 2